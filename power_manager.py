@@ -14,6 +14,34 @@
 =============================================================================
 """
 
+import functools
+import heapq
+import http.client
+import http.server
+import json as json_module
+import itertools
+import math
+import os
+import re
+import socket
+import stat
+import struct
+import threading
+import time
+import urllib.parse
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from enum import Enum
+
+import appdaemon.plugins.hass.hassapi as hass
+
+try:
+    import paho.mqtt.client as mqtt  # solo per power_source mqtt
+except ImportError:
+    mqtt = None
+
+
 class PowerZone(Enum):
     GREEN = "green"
     YELLOW = "yellow"
@@ -28,6 +56,15 @@ class DeviceState(Enum):
 
 
 class ManagedDevice:
+    __slots__ = (
+        "entity_id", "name", "priority", "estimated_power", "power_sensor",
+        "domain", "turn_off_service", "turn_on_service", "shed_in_yellow",
+        "shed_in_red", "auto_restore", "needs_manual_restart", "inverted",
+        "controllable", "enabled", "dashboard_prefix", "_state",
+        "shed_time", "pre_shed_state", "last_known_power", "profile",
+        "history", "_registry",
+    )
+
     def __init__(self, entity_id, name, priority, estimated_power,
                  power_sensor=None, domain="switch",
                  turn_off_service=None, turn_on_service=None,
@@ -35,6 +72,7 @@ class ManagedDevice:
                  auto_restore=True, needs_manual_restart=False,
                  inverted=False, controllable=True, enabled=True,
                  dashboard_prefix=None):
+        self._registry = None
         self.entity_id = entity_id
         self.name = name
         self.priority = priority
@@ -51,23 +89,2580 @@ class ManagedDevice:
         self.controllable = controllable
         self.enabled = enabled
         self.dashboard_prefix = dashboard_prefix
-        self.state = DeviceState.UNKNOWN
+        self._state = DeviceState.UNKNOWN
         self.shed_time = None
         self.pre_shed_state = None
         self.last_known_power = 0.0  # v6: consumo reale pre-shed
+        self.profile = PowerProfile()
+        self.history = RestoreHistory()
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        old = self._state
+        self._state = value
+        if self._registry is not None and old is not value:
+            self._registry._moved(self, old, value)
+
+
+class PowerProfile:
+    """
+    Profilo di consumo di un device appreso dal suo sensore di potenza,
+    in memoria costante (nessuno storico di campioni).
+
+    Un ciclo va dal primo campione sopra `threshold` al primo sotto.
+      surge   - picco nei primi `surge_window` secondi del ciclo (spunto)
+      mean    - media dei campioni a regime (dopo lo spunto)
+      peak    - picco dell'intero ciclo
+      cycle_s - durata tipica del ciclo
+    Le statistiche per ciclo sono medie esponenziali (peso CYCLE_ALPHA),
+    la media a regime e una EWMA per campione (peso ALPHA).
+    """
+
+    __slots__ = ("mean", "peak", "surge", "cycle_s", "cycles",
+                 "_on_since", "_cycle_peak", "_surge_peak")
+
+    ALPHA = 0.05
+    CYCLE_ALPHA = 0.2
+
+    def __init__(self):
+        self.mean = None
+        self.peak = None
+        self.surge = None
+        self.cycle_s = None
+        self.cycles = 0
+        self._on_since = None
+        self._cycle_peak = 0.0
+        self._surge_peak = 0.0
+
+    def trained(self, min_cycles):
+        return self.cycles >= min_cycles and self.mean is not None
+
+    def observe(self, t, power, threshold, surge_window):
+        """Aggiunge un campione; True se ha appena chiuso un ciclo."""
+        if power >= threshold:
+            if self._on_since is None:
+                self._on_since = t
+                self._cycle_peak = self._surge_peak = power
+                return False
+            self._cycle_peak = max(self._cycle_peak, power)
+            if t - self._on_since <= surge_window:
+                self._surge_peak = max(self._surge_peak, power)
+            elif self.mean is None:
+                self.mean = power
+            else:
+                self.mean += self.ALPHA * (power - self.mean)
+            return False
+
+        if self._on_since is None:
+            return False
+        duration = t - self._on_since
+        self._on_since = None
+        if duration < surge_window:
+            return False  # accensione troppo breve per essere un ciclo
+        self.cycles += 1
+        self.peak = self._ewma(self.peak, self._cycle_peak)
+        self.surge = self._ewma(self.surge, self._surge_peak)
+        self.cycle_s = self._ewma(self.cycle_s, duration)
+        return True
+
+    def abort(self):
+        """Ciclo interrotto da noi (shed): non entra nelle statistiche."""
+        self._on_since = None
+
+    def to_list(self):
+        return [self.mean, self.peak, self.surge, self.cycle_s, self.cycles]
+
+    def load(self, values):
+        try:
+            mean, peak, surge, cycle_s, cycles = values
+            self.cycles = int(cycles)
+        except (TypeError, ValueError):
+            return
+        self.mean, self.peak, self.surge, self.cycle_s = (
+            mean, peak, surge, cycle_s)
+
+    def stats(self):
+        def r(value):
+            return round(value) if value is not None else None
+        return {
+            "mean": r(self.mean),
+            "peak": r(self.peak),
+            "surge": r(self.surge),
+            "cycle_min": (round(self.cycle_s / 60, 1)
+                          if self.cycle_s is not None else None),
+            "cycles": self.cycles,
+        }
+
+    def _ewma(self, current, value):
+        if current is None:
+            return float(value)
+        return current + self.CYCLE_ALPHA * (value - current)
+
+
+class RestoreHistory:
+    """
+    Esiti dei restore automatici di un device.
+
+    Un restore fallisce se il device viene rispento entro `fail_window`
+    secondi (era tra quelli da spegnere per il nuovo supero), altrimenti
+    riesce. Dopo un fallimento il device non si riaccende prima di
+    `not_before`: il backoff raddoppia a ogni fallimento consecutivo,
+    si azzera al primo successo ed e allungato fino a 2x nelle ore del
+    giorno in cui i restore falliscono piu spesso.
+    """
+
+    __slots__ = ("successes", "failures", "streak", "not_before",
+                 "avoided", "hours", "_restored_at", "_restored_hour",
+                 "_held")
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.streak = 0
+        self.not_before = None
+        self.avoided = 0
+        self.hours = [[0, 0] for _ in range(24)]  # [successi, fallimenti]
+        self._restored_at = None
+        self._restored_hour = None
+        self._held = None
+
+    def restored(self, t, hour):
+        self._restored_at = t
+        self._restored_hour = hour
+
+    def settle(self, t, fail_window):
+        """Chiude come riuscito un restore rimasto acceso abbastanza."""
+        if self._restored_at is None or t - self._restored_at < fail_window:
+            return False
+        self.successes += 1
+        self.streak = 0
+        self.not_before = None
+        self.hours[self._restored_hour][0] += 1
+        self._restored_at = None
+        return True
+
+    def shed(self, t, fail_window, base, cap):
+        """Device rispento: True se chiude un restore come fallito."""
+        self.settle(t, fail_window)
+        if self._restored_at is None:
+            return False
+        hour = self._restored_hour
+        self._restored_at = None
+        self.failures += 1
+        self.streak += 1
+        self.hours[hour][1] += 1
+        self.not_before = t + self.backoff(base, cap, hour)
+        return True
+
+    def backoff(self, base, cap, hour):
+        ok, ko = self.hours[hour]
+        factor = 1.0 + ko / (ok + ko) if ok + ko >= 2 else 1.0
+        return min(base * 2 ** self.streak * factor, cap)
+
+    def hold(self, t):
+        """True se non va riacceso ora; conta un ciclo evitato per blocco."""
+        if self.not_before is None or t >= self.not_before:
+            return False
+        if self._held != self.not_before:
+            self._held = self.not_before
+            self.avoided += 1
+        return True
+
+    def to_list(self):
+        return [self.successes, self.failures, self.streak,
+                self.not_before, self.avoided, self.hours]
+
+    def load(self, values):
+        try:
+            successes, failures, streak, not_before, avoided, hours = values
+            hours = [[int(ok), int(ko)] for ok, ko in hours]
+        except (TypeError, ValueError):
+            return
+        if len(hours) != 24:
+            return
+        self.successes, self.failures = int(successes), int(failures)
+        self.streak, self.avoided = int(streak), int(avoided)
+        self.not_before = not_before
+        self.hours = hours
+
+    def stats(self):
+        return {
+            "ok": self.successes,
+            "failed": self.failures,
+            "streak": self.streak,
+            "not_before": (
+                datetime.fromtimestamp(self.not_before).isoformat(
+                    timespec="seconds") if self.not_before else None),
+            "avoided": self.avoided,
+        }
+
+
+class DeviceRegistry:
+    """
+    Elenco dei device controllabili con indici precalcolati.
+
+    - iterazione nell'ordine di apps.yaml
+    - by_priority / by_priority_desc: ordine di shed e di restore
+      (calcolati una volta, a parita di priorita vale l'ordine di
+      configurazione come con sorted())
+    - lookup O(1) per name, entity_id, power_sensor, dashboard_prefix
+    - insiemi per DeviceState aggiornati a ogni cambio di stato
+
+    entity_id e power_sensor si cambiano con set_field() per tenere
+    allineati gli indici.
+    """
+
+    _INDEXED = ("name", "entity_id", "power_sensor", "dashboard_prefix")
+
+    def __init__(self, devices):
+        self._devices = tuple(devices)
+        self.by_priority = tuple(
+            sorted(self._devices, key=lambda d: d.priority))
+        self.by_priority_desc = tuple(
+            sorted(self._devices, key=lambda d: -d.priority))
+        self._rank = {d: i for i, d in enumerate(self.by_priority)}
+        self._rank_desc = {d: i for i, d in enumerate(self.by_priority_desc)}
+        self._index = {field: {} for field in self._INDEXED}
+        self._by_state = {state: set() for state in DeviceState}
+        for d in self._devices:
+            for field in self._INDEXED:
+                self._add_index(field, d)
+            self._by_state[d.state].add(d)
+            d._registry = self
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def get(self, name):
+        return self._index["name"].get(name)
+
+    def by_entity(self, entity_id):
+        return self._index["entity_id"].get(entity_id)
+
+    def by_power_sensor(self, power_sensor):
+        return self._index["power_sensor"].get(power_sensor)
+
+    def by_prefix(self, prefix):
+        return self._index["dashboard_prefix"].get(prefix)
+
+    def in_state(self, state, reverse=False):
+        """Device nello stato indicato, in ordine di priorita."""
+        rank = self._rank_desc if reverse else self._rank
+        return sorted(self._by_state[state], key=rank.__getitem__)
+
+    def count(self, state):
+        return len(self._by_state[state])
+
+    def set_field(self, device, field, value):
+        """Cambia un campo indicizzato aggiornando l'indice."""
+        if field in self._INDEXED:
+            index = self._index[field]
+            if index.get(getattr(device, field)) is device:
+                del index[getattr(device, field)]
+            setattr(device, field, value)
+            self._add_index(field, device)
+        else:
+            setattr(device, field, value)
+
+    def _add_index(self, field, device):
+        key = getattr(device, field)
+        if key:
+            # In caso di duplicati vince il primo in configurazione
+            self._index[field].setdefault(key, device)
+
+    def _moved(self, device, old, new):
+        self._by_state[old].discard(device)
+        self._by_state[new].add(device)
+
+
+class RuntimeSettings(namedtuple("RuntimeSettings", (
+        "contract_power", "hysteresis", "available_power", "red_threshold",
+        "green_threshold", "shed_target", "min_active_power",
+        "restore_interval", "max_shed_time", "dnd_periods",
+        "climate_mode"))):
+    """
+    Parametri di runtime compilati una volta: helper della dashboard
+    (input_number / input_datetime / input_select) con fallback su
+    apps.yaml, gia convertiti e validati, piu le soglie derivate.
+
+    Immutabile: quando un helper cambia si compila un nuovo oggetto e
+    lo si sostituisce con un solo assegnamento, quindi chi legge vede
+    sempre un insieme coerente. Orari DND in secondi dalla mezzanotte,
+    max_shed_time in secondi.
+    """
+
+    __slots__ = ()
+
+    # nome -> (helper, chiave apps.yaml, default, minimo, massimo, scala)
+    NUMBERS = {
+        "contract_power": ("input_number.pm_contract_power",
+                           "contract_power", 4500, 500, 100000, 1),
+        "min_active_power": ("input_number.pm_min_active_power",
+                             "min_active_power", 100, 0, 10000, 1),
+        "restore_interval": ("input_number.pm_restore_interval",
+                             "restore_interval", 180, 1, 86400, 1),
+        "max_shed_time": ("input_number.pm_max_shed_time",
+                          "max_shed_time", 30, 1, 1440, 60),  # minuti
+    }
+    DND = (
+        ("input_datetime.pm_dnd1_start", "input_datetime.pm_dnd1_end",
+         "23:00", "08:00"),
+        ("input_datetime.pm_dnd2_start", "input_datetime.pm_dnd2_end",
+         "14:00", "16:00"),
+    )
+    CLIMATE_MODE = "input_select.pm_altherma_restore_mode"
+    UNSET = (None, "", "unknown", "unavailable")
+    TRANSIENT = ("unknown", "unavailable")
+
+    @classmethod
+    def helpers(cls):
+        """Helper da cui dipendono le impostazioni (nomi senza sito)."""
+        entities = [spec[0] for spec in cls.NUMBERS.values()]
+        for start, end, _, _ in cls.DND:
+            entities += [start, end]
+        entities.append(cls.CLIMATE_MODE)
+        return entities
+
+    @classmethod
+    def compile(cls, read, args, warn=None, previous=None):
+        """
+        `read(helper)` restituisce lo stato dell'helper (None se non
+        esiste). Valori illeggibili o fuori range ripiegano su apps.yaml
+        o sul default, segnalati a `warn`; un helper momentaneamente
+        unknown/unavailable mantiene il valore di `previous`.
+        """
+        values = {}
+        for name, spec in cls.NUMBERS.items():
+            helper, key, default, low, high, scale = spec
+            fallback = float(args.get(key, default)) * scale
+            raw = read(helper)
+            if raw in cls.TRANSIENT and previous is not None:
+                values[name] = getattr(previous, name)
+                continue
+            if raw in cls.UNSET:
+                values[name] = fallback
+                continue
+            try:
+                value = float(raw)
+            except (ValueError, TypeError):
+                value = None
+            if value is None or not low <= value <= high:
+                if warn is not None:
+                    warn(f"{helper} = {raw} non valido ({low}-{high}): "
+                         f"uso {fallback / scale:g}")
+                values[name] = fallback
+            else:
+                values[name] = value * scale
+
+        yaml_dnd = args.get("dnd_periods") or ()
+        periods = []
+        for i, (start_helper, end_helper, start, end) in enumerate(cls.DND):
+            if i < len(yaml_dnd):
+                start, end = yaml_dnd[i]
+            if (previous is not None and i < len(previous.dnd_periods)
+                    and {read(start_helper), read(end_helper)}
+                    & set(cls.TRANSIENT)):
+                periods.append(previous.dnd_periods[i])
+                continue
+            period = []
+            for helper, fallback in ((start_helper, start), (end_helper, end)):
+                seconds = cls._parse_time(read(helper))
+                if seconds is None:
+                    seconds = cls._parse_time(fallback)
+                period.append(seconds)
+            if None not in period:
+                periods.append(tuple(period))
+
+        mode = read(cls.CLIMATE_MODE)
+        if mode in cls.TRANSIENT and previous is not None:
+            mode = previous.climate_mode
+        elif mode in cls.UNSET:
+            mode = args.get("climate_restore_mode")
+
+        contract = values["contract_power"]
+        hysteresis = float(args.get("hysteresis", 200))
+        available = contract * 1.10
+        return cls(
+            contract_power=contract,
+            hysteresis=hysteresis,
+            available_power=available,
+            red_threshold=contract * 1.33,
+            green_threshold=available - hysteresis,
+            shed_target=contract,
+            min_active_power=values["min_active_power"],
+            restore_interval=values["restore_interval"],
+            max_shed_time=values["max_shed_time"],
+            dnd_periods=tuple(periods),
+            climate_mode=mode,
+        )
+
+    @classmethod
+    def _parse_time(cls, value):
+        """"HH:MM[:SS]" -> secondi dalla mezzanotte (secondi ignorati)."""
+        if value in cls.UNSET:
+            return None
+        try:
+            hours, minutes = (int(p) for p in str(value).split(":")[:2])
+        except ValueError:
+            return None
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            return None
+        return hours * 3600 + minutes * 60
+
+    def dnd_active(self, now):
+        """True se `now` (datetime) cade in un periodo DND."""
+        t = (now.hour * 3600 + now.minute * 60 + now.second
+             + now.microsecond / 1e6)
+        for start, end in self.dnd_periods:
+            if start <= end:
+                if start <= t <= end:
+                    return True
+            elif t >= start or t <= end:
+                # Attraversa mezzanotte (es. 23:00 -> 08:00)
+                return True
+        return False
+
+    def dnd_labels(self):
+        return [f"{s // 3600:02d}:{s % 3600 // 60:02d}-"
+                f"{e // 3600:02d}:{e % 3600 // 60:02d}"
+                for s, e in self.dnd_periods]
+
+    def climate_restore_mode(self, month):
+        if self.climate_mode:
+            return self.climate_mode
+        return "heat" if month in (11, 12, 1, 2, 3, 4) else "cool"
+
+
+class StateCache:
+    """
+    Cache in-process degli stati HA.
+    Riempita da listen_state: nel percorso caldo le letture non
+    fanno round-trip verso HA. Un miss carica lo stato una volta
+    tramite `loader` e da quel momento l'entity resta in cache.
+    Un'entity inesistente si ricontrolla dopo `retry` secondi: un
+    helper creato dopo l'avvio (reload dei package) viene visto senza
+    riavviare l'app.
+    """
+
+    MISSING = object()  # entity inesistente in HA
+
+    def __init__(self, loader, clock, retry=60.0):
+        self._loader = loader
+        self._clock = clock
+        self.retry = float(retry)
+        self._values = {}
+        self._missing = {}  # entity -> istante del prossimo controllo
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, entity_id):
+        return entity_id in self._values or entity_id in self._missing
+
+    def get(self, entity_id):
+        """Stato dell'entity (None se inesistente), come get_state."""
+        try:
+            value = self._values[entity_id]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        if self._load(entity_id):
+            return self._values[entity_id]
+        return None
+
+    def exists(self, entity_id):
+        if entity_id in self._values:
+            self.hits += 1
+            return True
+        return self._load(entity_id)
+
+    def prime(self, entity_id):
+        """Carica l'entity senza contare hit/miss (solo all'avvio)."""
+        if entity_id in self._values:
+            return True
+        return self._load(entity_id, count=False)
+
+    def update(self, entity_id, value):
+        self._missing.pop(entity_id, None)
+        self._values[entity_id] = value
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entities": len(self._values),
+            "missing": len(self._missing),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+    def _load(self, entity_id, count=True):
+        """True se l'entity esiste; le inesistenti non si rileggono
+        prima di `retry` secondi."""
+        now = self._clock()
+        retry_at = self._missing.get(entity_id)
+        if retry_at is not None and now < retry_at:
+            if count:
+                self.hits += 1
+            return False
+        if count:
+            self.misses += 1
+        value = self._loader(entity_id)
+        if value is StateCache.MISSING:
+            self._missing[entity_id] = now + self.retry
+            return False
+        self._missing.pop(entity_id, None)
+        self._values[entity_id] = value
+        return True
+
+
+class StatePublisher:
+    """
+    Pubblicazione di un sensore HA con rilevamento modifiche.
+
+    Ogni payload viene confrontato con l'ultimo scritto (campi
+    annidati indicati come "a.b.c"):
+      - campi critici o stato cambiati  -> scrittura immediata
+      - campi numerici oltre la deadband -> scrittura rate-limited
+        (se troppo presto resta in attesa del flush)
+      - solo rumore entro deadband       -> nessuna scrittura
+    Le deadband si cercano per chiave completa, poi per radice,
+    poi per ultimo componente (es. "power" per device_details.*.power).
+    """
+
+    DEFAULT_DEADBANDS = {
+        "grid_power": 50.0,
+        "excess_percent": 1.0,
+        "zone_duration_min": 1.0,
+        "stable_in_green_min": 1.0,
+        "non_controllable_active": 50.0,
+        "power": 20.0,
+        "luna2000_actual_power": 50.0,
+        "luna2000_configured_power": 50.0,
+        "yellow_used_s": 30.0,
+        "red_used_s": 5.0,
+        "remaining_s": 30.0,
+        "mean": 20.0,
+        "peak": 50.0,
+        "surge": 50.0,
+        "cycle_min": 1.0,
+        "output": 50.0,
+    }
+
+    DEFAULT_CRITICAL = frozenset({
+        "shed_active", "shed_devices", "current_check",
+        "came_from_yellow", "restore_in_progress", "restore_queue",
+        "shed_cycle_count", "state", "enabled",
+        "luna2000_charging", "luna2000_reduced",
+        "test_mode", "dry_run", "contract_power",
+    })
+
+    def __init__(self, writer, clock, min_interval=10.0, deadbands=None,
+                 critical=None, volatile=()):
+        self._writer = writer
+        self._clock = clock
+        self.min_interval = float(min_interval)
+        self.deadbands = dict(self.DEFAULT_DEADBANDS)
+        self.deadbands.update(deadbands or {})
+        self.critical = (frozenset(critical) if critical is not None
+                         else self.DEFAULT_CRITICAL)
+        self.volatile = frozenset(volatile)
+        self._last_state = None
+        self._last_attributes = None
+        self._last_write = None
+        self._pending = None
+        self.writes = 0
+        self.deferred = 0
+        self.skipped = 0
+
+    @property
+    def pending(self):
+        return self._pending is not None
+
+    def stats(self):
+        return {"writes": self.writes, "deferred": self.deferred,
+                "skipped": self.skipped}
+
+    def next_flush_in(self):
+        """Secondi mancanti alla prossima scrittura consentita."""
+        if self._last_write is None:
+            return 0.0
+        return max(self.min_interval
+                   - (self._clock() - self._last_write), 0.0)
+
+    def offer(self, state, attributes, force=False):
+        """Ritorna "written", "deferred" oppure "skipped"."""
+        change = "critical" if force else self._classify(state, attributes)
+        if change == "critical" or (
+                change == "significant" and self.next_flush_in() <= 0):
+            self._write(state, attributes)
+            return "written"
+        if change == "significant":
+            self._pending = (state, attributes)
+            self.deferred += 1
+            return "deferred"
+        # Solo rumore rispetto all'ultimo scritto: niente da recuperare
+        self._pending = None
+        self.skipped += 1
+        return "skipped"
+
+    def flush(self):
+        """Scrive il payload in attesa. Ritorna True se ha scritto."""
+        if self._pending is None:
+            return False
+        self._write(*self._pending)
+        return True
+
+    def _write(self, state, attributes):
+        self._pending = None
+        self._last_state = state
+        self._last_attributes = attributes
+        self._last_write = self._clock()
+        self.writes += 1
+        self._writer(state, attributes)
+
+    def _classify(self, state, attributes):
+        if self._last_attributes is None or state != self._last_state:
+            return "critical"
+        return self._compare(self._last_attributes, attributes, "")
+
+    def _compare(self, old, new, prefix):
+        """
+        Confronto ricorsivo: i sotto-dizionari uguali (la gran parte)
+        vengono scartati con un solo confronto; le chiavi "a.b.c" si
+        costruiscono solo per i campi effettivamente cambiati.
+        """
+        change = None
+        keys = new.keys()
+        if old.keys() != keys:
+            keys = keys | old.keys()
+        for key in keys:
+            value = new.get(key)
+            previous = old.get(key)
+            if value == previous:
+                continue
+            path = f"{prefix}{key}"
+            root = path.partition(".")[0]
+            if root in self.volatile:
+                continue
+            if isinstance(value, dict) and isinstance(previous, dict):
+                sub = self._compare(previous, value, f"{path}.")
+                if sub == "critical":
+                    return sub
+                change = change or sub
+                continue
+            if root in self.critical or key in self.critical:
+                return "critical"
+            band = self._deadband(path, root, key)
+            if (band is not None and self._is_number(previous)
+                    and self._is_number(value)
+                    and abs(value - previous) < band):
+                continue
+            change = "significant"
+        return change
+
+    def _deadband(self, path, root, leaf):
+        for k in (path, root, leaf):
+            if k in self.deadbands:
+                return self.deadbands[k]
+        return None
+
+    @staticmethod
+    def _is_number(value):
+        return (isinstance(value, (int, float))
+                and not isinstance(value, bool))
+
+
+class ActionBatcher:
+    """
+    Raccoglie le chiamate di servizio decise in una valutazione
+    (begin ... flush, annidabili) e le invia insieme:
+      - stesso servizio e stessi dati -> una sola chiamata con la
+        lista di entity_id (es. switch/turn_off su 6 prese)
+      - servizi diversi -> in parallelo con `workers` > 1
+    Fuori da begin/flush la chiamata parte subito. Un errore su una
+    chiamata viene registrato e non blocca le altre.
+    """
+
+    def __init__(self, call, log=None, workers=1):
+        self._call = call
+        self._log = log
+        self.workers = max(int(workers), 1)
+        self._executor = None
+        self._pending = {}
+        self._depth = 0
+        self.flushes = 0
+        self.actions = 0
+        self.calls = 0
+        self.errors = 0
+
+    def begin(self):
+        self._depth += 1
+
+    def add(self, service, **data):
+        self.actions += 1
+        if not self._depth:
+            self._send(service, data)
+            return
+        entity = data.pop("entity_id", None)
+        if isinstance(entity, str):
+            key = (service, repr(sorted(data.items())))
+        else:
+            # Senza entity_id singola (servizi custom): non si unisce
+            if entity is not None:
+                data["entity_id"] = entity
+            entity = None
+            key = (service, len(self._pending))
+        group = self._pending.get(key)
+        if group is None:
+            group = self._pending[key] = (service, data, [])
+        if entity is not None and entity not in group[2]:
+            group[2].append(entity)
+
+    def flush(self):
+        """Chiude un begin; al livello esterno invia. Ritorna le chiamate."""
+        self._depth = max(self._depth - 1, 0)
+        if self._depth or not self._pending:
+            return 0
+        calls = []
+        for service, data, entities in self._pending.values():
+            if entities:
+                data = dict(data, entity_id=(
+                    entities[0] if len(entities) == 1 else entities))
+            calls.append((service, data))
+        self._pending = {}
+        self.flushes += 1
+        if self.workers > 1 and len(calls) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="pm-actions")
+            futures = [self._executor.submit(self._send, service, data)
+                       for service, data in calls]
+            for future in futures:
+                future.result()
+        else:
+            for service, data in calls:
+                self._send(service, data)
+        return len(calls)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self):
+        return {"flushes": self.flushes, "actions": self.actions,
+                "calls": self.calls, "errors": self.errors}
+
+    def _send(self, service, data):
+        self.calls += 1
+        try:
+            self._call(service, **data)
+        except Exception as e:
+            self.errors += 1
+            if self._log:
+                self._log(f"Servizio {service}: {e}", level="WARNING")
+
+
+class NotificationRouter:
+    """
+    Filtro davanti ai canali di notifica (Alexa, Telegram).
+
+    Per ogni coppia (canale, categoria):
+      - dedup: un messaggio uguale a uno gia inviato negli ultimi
+        `dedup_window` secondi, al netto delle misure (potenze e
+        percentuali cambiano di poco durante un ping-pong), si scarta;
+      - token bucket: `burst` messaggi subito, poi uno ogni `refill`
+        secondi (`limits` li sovrascrive per categoria);
+      - digest: i messaggi oltre il bucket si accumulano e dopo
+        `digest_window` secondi dal primo parte un solo riepilogo,
+        costruito da `formatter(canale, categoria, n, finestra, ultimo)`.
+    I messaggi critici (zona rossa, distacco imminente) saltano bucket e
+    digest ma non il dedup: in rossa lo stesso avviso si ripete a ogni
+    campione.
+    `deliver(canale, messaggio)` esegue l'invio vero e proprio.
+    """
+
+    # Solo le misure (W, %, durate): i numeri nei nomi dei device restano
+    MEASURES = re.compile(
+        r"\d+(?:[.,]\d+)?(?=\s*(?:W|%|s\b|min|sec|or[ae]\b|percento))")
+
+    def __init__(self, deliver, clock, formatter, burst=3, refill=300,
+                 dedup_window=600, digest_window=300, limits=None):
+        self._deliver = deliver
+        self._clock = clock
+        self._formatter = formatter
+        self.burst = burst
+        self.refill = refill
+        self.dedup_window = dedup_window
+        self.digest_window = digest_window
+        self.limits = dict(limits or {})
+        self._buckets = {}
+        self._recent = {}
+        self._pending = {}
+        self.sent = 0
+        self.bypassed = 0
+        self.duplicates = 0
+        self.deferred = 0
+        self.digests = 0
+
+    def submit(self, channel, category, message, critical=False):
+        """Esito: "sent", "duplicate" o "deferred" (finira nel digest)."""
+        now = self._clock()
+        key = (channel, category)
+        fingerprint = hash((key, self.MEASURES.sub("#", message)))
+        seen = self._recent.get(fingerprint)
+        if seen is not None and now - seen < self.dedup_window:
+            self.duplicates += 1
+            return "duplicate"
+        self._recent[fingerprint] = now
+        if len(self._recent) > 256:
+            self._recent = {f: t for f, t in self._recent.items()
+                            if now - t < self.dedup_window}
+        if critical:
+            self.bypassed += 1
+            self._deliver(channel, message)
+            return "sent"
+        if self._take(key, now):
+            self.sent += 1
+            self._deliver(channel, message)
+            return "sent"
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = [now + self.digest_window, 0, None]
+        pending[1] += 1
+        pending[2] = message
+        self.deferred += 1
+        return "deferred"
+
+    def flush(self):
+        """Invia i digest scaduti; ritorna quanti."""
+        now = self._clock()
+        due = [key for key, pending in self._pending.items()
+               if pending[0] <= now]
+        for key in due:
+            _, count, last = self._pending.pop(key)
+            channel, category = key
+            self.digests += 1
+            self._deliver(channel, self._formatter(
+                channel, category, count, self.digest_window, last))
+        return len(due)
+
+    def next_flush_in(self):
+        if not self._pending:
+            return None
+        return max(min(p[0] for p in self._pending.values())
+                   - self._clock(), 0.0)
+
+    def stats(self):
+        return {"sent": self.sent, "bypassed": self.bypassed,
+                "duplicates": self.duplicates, "deferred": self.deferred,
+                "digests": self.digests,
+                "pending": sum(p[1] for p in self._pending.values())}
+
+    def _take(self, key, now):
+        burst, refill = self.limits.get(key[1], (self.burst, self.refill))
+        if not refill or refill <= 0:
+            return True
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = float(burst)
+        else:
+            tokens = min(float(burst), bucket[0] + (now - bucket[1]) / refill)
+        if tokens < 1:
+            self._buckets[key] = [tokens, now]
+            return False
+        self._buckets[key] = [tokens - 1, now]
+        return True
+
+
+class TelegramSender:
+    """
+    Invio Telegram in background con coda limitata.
+
+    send() accoda e ritorna subito: il thread dedicato riusa una
+    connessione HTTP(S) persistente, unisce in un solo messaggio quelli
+    accodati entro `coalesce_window` secondi, riprova con backoff
+    esponenziale (rispetta retry_after su HTTP 429) e, se la coda e
+    piena, scarta il messaggio piu vecchio.
+    """
+
+    MAX_MESSAGE_LEN = 4096
+    SEPARATOR = "\n\n"
+
+    def __init__(self, token, chat_id, api_url="https://api.telegram.org",
+                 max_queue=50, coalesce_window=1.0, max_retries=4,
+                 backoff_base=1.0, backoff_max=30.0, timeout=10.0,
+                 log=None):
+        url = urllib.parse.urlsplit(api_url)
+        self.use_tls = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.path = f"{url.path.rstrip('/')}/bot{token}/sendMessage"
+        self.chat_id = chat_id
+        self.max_queue = max_queue
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self._log = log or (lambda msg, level="INFO": None)
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._conn = None
+        self._thread = None
+        self._stopping = False
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.requests = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="pm-telegram", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Svuota la coda (senza attese di backoff) e ferma il thread."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def send(self, message):
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((time.monotonic(), message))
+            self.enqueued += 1
+            self._cond.notify()
+
+    def stats(self):
+        return {"queued": len(self._queue), "sent": self.sent,
+                "failed": self.failed, "dropped": self.dropped,
+                "requests": self.requests}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                # Attende la finestra di coalescenza del primo messaggio
+                deadline = self._queue[0][0] + self.coalesce_window
+                while not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                text = self._take_batch(deadline)
+            try:
+                self._deliver(text)
+            except Exception as e:
+                self.failed += 1
+                self._log(f"TG errore: {e}", level="WARNING")
+        self._close()
+
+    def _take_batch(self, deadline):
+        parts = []
+        size = 0
+        while self._queue and self._queue[0][0] <= deadline:
+            message = self._queue[0][1][:self.MAX_MESSAGE_LEN]
+            extra = len(message) + (len(self.SEPARATOR) if parts else 0)
+            if parts and size + extra > self.MAX_MESSAGE_LEN:
+                break
+            self._queue.popleft()
+            parts.append(message)
+            size += extra
+        return self.SEPARATOR.join(parts)
+
+    def _deliver(self, text):
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                status, body = self._post(text)
+            except (OSError, http.client.HTTPException) as e:
+                self._close()
+                self._log(f"TG errore: {e}", level="WARNING")
+            else:
+                if status == 200:
+                    self.sent += 1
+                    self._log(f"  TG: {text[:60]}...")
+                    return True
+                self._log(f"TG HTTP {status}", level="WARNING")
+                if status == 429:
+                    retry_after = self._retry_after(body)
+                elif 400 <= status < 500:
+                    break  # errore definitivo (token, chat_id, markdown)
+            if attempt == self.max_retries:
+                break
+            delay = retry_after or min(
+                self.backoff_base * (2 ** attempt), self.backoff_max)
+            with self._cond:
+                if self._stopping:
+                    break
+                self._cond.wait(delay)
+        self.failed += 1
+        return False
+
+    def _post(self, text):
+        payload = json_module.dumps({
+            "chat_id": self.chat_id,
+            "text": text,
+            "parse_mode": "Markdown",
+        }).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        reused = self._conn is not None
+        try:
+            return self._request(payload, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError,
+                BrokenPipeError):
+            if not reused:
+                raise
+            # Connessione keep-alive chiusa dal server: riapri subito
+            self._close()
+            return self._request(payload, headers)
+
+    def _request(self, payload, headers):
+        if self._conn is None:
+            cls = (http.client.HTTPSConnection if self.use_tls
+                   else http.client.HTTPConnection)
+            self._conn = cls(self.host, self.port, timeout=self.timeout)
+        self.requests += 1
+        self._conn.request("POST", self.path, body=payload, headers=headers)
+        response = self._conn.getresponse()
+        return response.status, response.read()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    @staticmethod
+    def _retry_after(body):
+        try:
+            return float(json_module.loads(body)["parameters"]["retry_after"])
+        except (ValueError, TypeError, KeyError):
+            return None
+
+
+class MetricsExporter:
+    """
+    Endpoint HTTP con le metriche in formato testo Prometheus.
+
+    Il thread HTTP non legge mai lo stato dell'app ne HA: l'app
+    incrementa i contatori (count) e consegna i gauge gia calcolati a
+    ogni pubblicazione (set_gauges, per sorgente: un sito). La pagina
+    viene riformattata solo se qualcosa e cambiato dall'ultima
+    richiesta, altrimenti si serve quella gia pronta.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    METRICS = {
+        "grid_power_watts": ("gauge", "Potenza prelevata dalla rete"),
+        "zone": ("gauge", "Zona corrente (1 sulla zona attiva)"),
+        "excess_percent": ("gauge", "Supero del contratto in percentuale"),
+        "shed_devices": ("gauge", "Device spenti dal Power Manager"),
+        "shed_cycles": ("gauge", "Cicli di shed consecutivi"),
+        "restore_queue_length": ("gauge", "Device in coda di restore"),
+        "luna_reduced_watts": ("gauge", "Carica Luna2000 tolta dallo shed"),
+        "device_power_watts": ("gauge", "Potenza per device"),
+        "sheds_total": ("counter", "Spegnimenti"),
+        "restores_total": ("counter", "Riaccensioni"),
+        "reshed_after_restore_total": (
+            "counter", "Device rispenti subito dopo un restore"),
+        "max_shed_timeouts_total": (
+            "counter", "Riaccensioni forzate per timeout massimo"),
+        "notifications_total": ("counter", "Notifiche inviate"),
+        "zone_changes_total": ("counter", "Cambi di zona"),
+        "luna_actions_total": ("counter", "Comandi alla carica Luna2000"),
+    }
+
+    def __init__(self, port, host="0.0.0.0", prefix="power_manager",
+                 log=None):
+        self.port = port
+        self.host = host
+        self.prefix = prefix
+        self._log = log or (lambda msg, level="INFO": None)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._version = 0
+        self._page = (None, b"")
+        self._server = None
+        self._thread = None
+        self.scrapes = 0
+
+    def start(self):
+        if self._server is not None:
+            return
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.render()
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = http.server.ThreadingHTTPServer(
+                (self.host, self.port), Handler)
+        except OSError as e:
+            self._log(f"Metriche: porta {self.port} non disponibile: {e}",
+                      level="WARNING")
+            return
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="pm-metrics",
+            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join(5)
+        self._server = None
+        self._thread = None
+
+    def count(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._version += 1
+
+    def set_gauges(self, source, gauges):
+        """gauges: lista di (nome, labels, valore), sostituisce la sorgente."""
+        with self._lock:
+            if self._gauges.get(source) == gauges:
+                return  # pagina in cache ancora valida
+            self._gauges[source] = gauges
+            self._version += 1
+
+    def render(self):
+        with self._lock:
+            self.scrapes += 1
+            if self._page[0] == self._version:
+                return self._page[1]
+            version = self._version
+            samples = [(name, labels, value) for (name, labels), value
+                       in sorted(self._counters.items())]
+            for source in sorted(self._gauges, key=str):
+                samples.extend(self._gauges[source])
+
+        series = defaultdict(list)
+        for name, labels, value in samples:
+            series[name].append((labels, value))
+        lines = []
+        for name, (kind, text) in self.METRICS.items():
+            if name not in series:
+                continue
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full} {text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, value in series[name]:
+                lines.append(f"{full}{self._labels(labels)} "
+                             f"{format(value, '.10g')}")
+        page = ("\n".join(lines) + "\n").encode("utf-8")
+        with self._lock:
+            self._page = (version, page)
+        return page
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        pairs = []
+        for key, value in labels:
+            value = (str(value).replace("\\", "\\\\").replace('"', '\\"')
+                     .replace("\n", "\\n"))
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+
+class SampleDecimator:
+    """
+    Riduce i campioni di una sorgente veloce a un valore per giro del
+    loop di controllo.
+
+    push() arriva dal thread della sorgente, drain() dal thread
+    AppDaemon: il lock copre solo lo scambio dei campioni del giro.
+    `mode` sceglie il valore del giro: mean (toglie il rumore), max
+    (non perde i picchi), median (ignora i campioni isolati) o last.
+    """
+
+    MODES = ("mean", "max", "median", "last")
+
+    def __init__(self, mode="mean", max_samples=1000):
+        if mode not in self.MODES:
+            raise ValueError(f"decimazione sconosciuta: {mode}")
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=max_samples)
+        self.last_at = None  # time.monotonic() dell'ultimo campione
+        self.samples = 0
+        self.emitted = 0
+        self.dropped = 0
+
+    def push(self, value):
+        with self._lock:
+            if len(self._samples) == self._samples.maxlen:
+                self.dropped += 1
+            self._samples.append(value)
+            self.samples += 1
+            self.last_at = time.monotonic()
+
+    def drain(self):
+        """(valore del giro, campioni usati); (None, 0) senza campioni."""
+        with self._lock:
+            if not self._samples:
+                return None, 0
+            batch = list(self._samples)
+            self._samples.clear()
+        self.emitted += 1
+        if self.mode == "max":
+            value = max(batch)
+        elif self.mode == "median":
+            value = sorted(batch)[len(batch) // 2]
+        elif self.mode == "last":
+            value = batch[-1]
+        else:
+            value = sum(batch) / len(batch)
+        return value, len(batch)
+
+    def age(self):
+        """Secondi dall'ultimo campione, None se non ne e mai arrivato."""
+        last_at = self.last_at
+        return None if last_at is None else time.monotonic() - last_at
+
+    def stats(self):
+        age = self.age()
+        return {"mode": self.mode, "samples": self.samples,
+                "emitted": self.emitted, "dropped": self.dropped,
+                "age_s": None if age is None else round(age, 1)}
+
+
+class PowerSource:
+    """
+    Sorgente diretta della potenza di rete, alternativa al sensore HA.
+
+    Ogni sorgente ha un thread che legge i campioni alla propria
+    frequenza (anche sotto il secondo) e li consegna al SampleDecimator:
+    non tocca mai lo stato dell'app ne HA. Se la connessione cade il
+    thread riprova con attesa crescente fino a `max_backoff` secondi.
+    Le sottoclassi implementano _run_once(): connette e legge finche
+    la sorgente non viene fermata o una lettura fallisce.
+
+    Il payload e un numero oppure JSON con il valore in `json_key`
+    (anche annidato, "a.b"); `scale` converte in W e con -1 inverte il
+    segno (es. inverter che riportano il prelievo come negativo).
+    """
+
+    KIND = None
+
+    def __init__(self, decimator, scale=1.0, json_key=None,
+                 max_backoff=30, log=None):
+        self.decimator = decimator
+        self.scale = float(scale)
+        self.json_key = json_key
+        self.max_backoff = max_backoff
+        self._log = log or (lambda msg, level="INFO": None)
+        self._stopping = threading.Event()
+        self._thread = None
+        self.connects = 0
+        self.errors = 0
+        self.invalid = 0
+        self.last_error = None
+
+    @staticmethod
+    def create(kind, decimator, options, log=None):
+        """Sorgente del tipo `kind` con le opzioni di `power_source`."""
+        classes = {cls.KIND: cls for cls in (
+            ModbusPowerSource, MqttPowerSource, UnixSocketPowerSource)}
+        if kind not in classes:
+            raise ValueError(f"tipo sconosciuto: {kind}")
+        return classes[kind](decimator, log=log, **options)
+
+    def describe(self):
+        return self.KIND
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=f"pm-source-{self.KIND}",
+                daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        stats = {"source": self.describe(), "connects": self.connects,
+                 "errors": self.errors, "invalid": self.invalid,
+                 "last_error": self.last_error}
+        stats.update(self.decimator.stats())
+        return stats
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stopping.is_set():
+            received = self.decimator.samples
+            self.connects += 1
+            try:
+                self._run_once()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                if self.decimator.samples > received:
+                    backoff = 1.0
+                self._log(f"Sorgente {self.describe()}: {e}, nuovo "
+                          f"tentativo tra {backoff:.0f}s", level="WARNING")
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def _run_once(self):
+        raise NotImplementedError
+
+    def _offer(self, payload):
+        """Payload testuale (o JSON) dalla sorgente -> campione."""
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8", "replace")
+        try:
+            if self.json_key:
+                value = json_module.loads(payload)
+                for key in self.json_key.split("."):
+                    value = value[key]
+            else:
+                value = payload
+            value = float(value)
+        except (ValueError, TypeError, KeyError, IndexError):
+            self.invalid += 1
+            return
+        if math.isfinite(value):
+            self.decimator.push(value * self.scale)
+        else:
+            self.invalid += 1
+
+
+class ModbusTcpClient:
+    """
+    Client Modbus-TCP minimo, senza dipendenze: solo lettura registri
+    (funzioni 3 holding e 4 input), una richiesta alla volta.
+    """
+
+    def __init__(self, host, port=502, unit=1, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.timeout = timeout
+        self._sock = None
+        self._tid = 0
+
+    def connect(self):
+        self._sock = socket.create_connection(
+            (self.host, self.port), self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def read_registers(self, address, count, function=3):
+        self._tid = (self._tid + 1) & 0xFFFF
+        self._sock.sendall(struct.pack(
+            ">HHHBBHH", self._tid, 0, 6, self.unit, function, address,
+            count))
+        tid, protocol, length, _ = struct.unpack(">HHHB", self._recv(7))
+        body = self._recv(length - 1)
+        if tid != self._tid or protocol != 0:
+            raise ValueError(f"risposta Modbus inattesa (tid {tid})")
+        if body[0] == function | 0x80:
+            raise ValueError(f"eccezione Modbus {body[1]}")
+        if body[0] != function or body[1] != 2 * count:
+            raise ValueError("risposta Modbus malformata")
+        return struct.unpack(f">{count}H", body[2:2 + 2 * count])
+
+    def _recv(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("connessione Modbus chiusa")
+            data += chunk
+        return data
+
+
+class ModbusPowerSource(PowerSource):
+    """
+    Registro di un meter/inverter letto in polling via Modbus-TCP ogni
+    `poll_interval` secondi (es. Huawei SUN2000: 37113, int32, W, con
+    scale -1 perche il prelievo e negativo).
+    """
+
+    KIND = "modbus"
+    FORMATS = {
+        "int16": (1, "h"), "uint16": (1, "H"),
+        "int32": (2, "i"), "uint32": (2, "I"), "float32": (2, "f"),
+    }
+
+    def __init__(self, decimator, host, address, port=502, unit=1,
+                 function=3, format="int16", word_order="big",
+                 poll_interval=0.5, timeout=2.0, **kwargs):
+        super().__init__(decimator, **kwargs)
+        if format not in self.FORMATS:
+            raise ValueError(f"formato Modbus sconosciuto: {format}")
+        if function not in (3, 4):
+            raise ValueError(f"funzione Modbus non supportata: {function}")
+        self.client = ModbusTcpClient(host, port, unit, timeout)
+        self.address = address
+        self.function = function
+        self.format = format
+        self.word_order = word_order
+        self.poll_interval = poll_interval
+
+    def describe(self):
+        return (f"modbus {self.client.host}:{self.client.port}"
+                f"/{self.client.unit}@{self.address}")
+
+    def _run_once(self):
+        count, code = self.FORMATS[self.format]
+        self.client.connect()
+        try:
+            while not self._stopping.is_set():
+                started = time.monotonic()
+                words = self.client.read_registers(
+                    self.address, count, self.function)
+                if self.word_order == "little":
+                    words = words[::-1]
+                value = struct.unpack(
+                    ">" + code, struct.pack(f">{count}H", *words))[0]
+                self._offer(str(value))
+                self._stopping.wait(max(
+                    self.poll_interval - (time.monotonic() - started), 0))
+        finally:
+            self.client.close()
+
+
+class MqttPowerSource(PowerSource):
+    """
+    Topic MQTT con la potenza (richiede paho-mqtt). La sottoscrizione
+    viene rifatta a ogni connessione; il loop di rete gira nel thread
+    della sorgente.
+    """
+
+    KIND = "mqtt"
+
+    def __init__(self, decimator, topic, host="localhost", port=1883,
+                 username=None, password=None, keepalive=30, **kwargs):
+        super().__init__(decimator, **kwargs)
+        if mqtt is None:
+            raise RuntimeError("paho-mqtt non installato")
+        self.topic = topic
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+
+    def describe(self):
+        return f"mqtt {self.host}:{self.port}/{self.topic}"
+
+    def _run_once(self):
+        api = getattr(mqtt, "CallbackAPIVersion", None)
+        client = mqtt.Client(api.VERSION2) if api else mqtt.Client()
+        if self.username:
+            client.username_pw_set(self.username, self.password)
+        client.on_connect = lambda c, *args: c.subscribe(self.topic)
+        client.on_message = lambda c, userdata, msg: self._offer(
+            msg.payload)
+        client.connect(self.host, self.port, self.keepalive)
+        try:
+            while not self._stopping.is_set():
+                rc = client.loop(timeout=1.0)
+                if rc != 0:
+                    raise ConnectionError(f"MQTT: {mqtt.error_string(rc)}")
+        finally:
+            client.disconnect()
+
+
+class UnixSocketPowerSource(PowerSource):
+    """
+    Socket UNIX datagram creato in `path`: ogni datagramma porta uno o
+    piu campioni, uno per riga (es. da un lettore seriale locale).
+    """
+
+    KIND = "unix"
+
+    def __init__(self, decimator, path, **kwargs):
+        super().__init__(decimator, **kwargs)
+        self.path = path
+
+    def describe(self):
+        return f"unix {self.path}"
+
+    def _run_once(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            try:
+                if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    os.remove(self.path)  # lasciato da un avvio precedente
+            except FileNotFoundError:
+                pass
+            sock.bind(self.path)
+            sock.settimeout(1.0)
+            while not self._stopping.is_set():
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    continue
+                for line in data.splitlines():
+                    if line.strip():
+                        self._offer(line)
+        finally:
+            sock.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def solve_shed_set(candidates, excess_watts, priority_weight=50.0,
+                   max_buckets=1000):
+    """
+    Sceglie i device da spegnere con la minima sovra-riduzione.
+
+    candidates: lista di (device, potenza_W) gia filtrata.
+    Minimizza  (somma potenze - eccesso) + priority_weight * somma
+    priorita  tra i sottoinsiemi che coprono l'eccesso (0/1 knapsack
+    su potenze quantizzate in `max_buckets` fasce). Ogni fascia tiene
+    il costo e la somma reale in W del suo insieme migliore: obiettivo
+    e copertura si valutano sulle somme reali, non sulle fasce. Gli
+    insiemi con somma oltre eccesso + max(potenza) sono dominati e non
+    vengono esplorati: il costo e O(n * max_buckets) anche con decine
+    di device.
+
+    Ritorna i candidati scelti in ordine di priorita, oppure tutti i
+    candidati se neppure insieme coprono l'eccesso.
+    """
+    if excess_watts <= 0 or not candidates:
+        return []
+    if sum(pw for _, pw in candidates) < excess_watts:
+        return list(candidates)
+
+    cap_watts = excess_watts + max(pw for _, pw in candidates)
+    step = max(cap_watts / max_buckets, 1.0)
+    size = int(cap_watts / step) + 1
+    weights = [int(pw / step) for _, pw in candidates]
+
+    inf = float("inf")
+    # Per fascia: somma W + costo priorita minimi e somma W reale
+    best = [inf] * size
+    real = [0.0] * size
+    best[0] = 0.0
+    keep = []
+    for (device, pw), w in zip(candidates, weights):
+        took = bytearray(size)
+        cost = pw + priority_weight * device.priority
+        for s in range(size - 1, w - 1, -1):
+            c = best[s - w] + cost
+            if c < best[s]:
+                best[s] = c
+                real[s] = real[s - w] + pw
+                took[s] = 1
+        keep.append(took)
+
+    target = None
+    target_cost = inf
+    covered = excess_watts - 1e-6  # tolleranza somme float
+    for s in range(size):
+        if best[s] < target_cost and real[s] >= covered:
+            target, target_cost = s, best[s]
+    if target is None:
+        # Nessuna fascia copre con il suo insieme migliore: prima
+        # copertura in ordine di priorita
+        chosen, total = [], 0.0
+        for candidate in candidates:
+            chosen.append(candidate)
+            total += candidate[1]
+            if total >= covered:
+                break
+        return chosen
+
+    chosen = []
+    s = target
+    for i in range(len(candidates) - 1, -1, -1):
+        if keep[i][s]:
+            chosen.append(candidates[i])
+            s -= weights[i]
+    chosen.reverse()
+    return chosen
+
+
+class PowerTrend:
+    """
+    Finestra circolare degli ultimi `size` campioni di rete con stima
+    incrementale O(1) di pendenza (regressione lineare, W/s) e media
+    esponenziale (EWMA) della potenza.
+
+    Le somme della regressione usano tempi relativi a un'origine che
+    viene spostata ogni `size` inserimenti, ricalcolando le somme
+    dalla finestra: niente perdita di precisione con timestamp epoch
+    e niente deriva da sottrazioni ripetute (costo ammortizzato O(1)).
+    """
+
+    def __init__(self, size=30, alpha=0.3):
+        self.size = max(int(size), 2)
+        self.alpha = alpha
+        self._t = [0.0] * self.size
+        self._p = [0.0] * self.size
+        self._head = 0
+        self._count = 0
+        self._origin = None
+        self._since_rebase = 0
+        self._st = self._sp = self._stt = self._stp = 0.0
+        self.ewma = None
+        self.last_time = None
+
+    def __len__(self):
+        return self._count
+
+    def add(self, t, power):
+        if self._origin is None:
+            self._origin = t
+        x = t - self._origin
+        if self._count == self.size:
+            ox, op = self._t[self._head], self._p[self._head]
+            self._st -= ox
+            self._sp -= op
+            self._stt -= ox * ox
+            self._stp -= ox * op
+        else:
+            self._count += 1
+        self._t[self._head] = x
+        self._p[self._head] = power
+        self._head = (self._head + 1) % self.size
+        self._st += x
+        self._sp += power
+        self._stt += x * x
+        self._stp += x * power
+        self.ewma = (power if self.ewma is None
+                     else self.ewma + self.alpha * (power - self.ewma))
+        self.last_time = t
+        self._since_rebase += 1
+        if self._since_rebase >= self.size:
+            self._rebase(t)
+
+    def slope(self):
+        """Pendenza della retta di regressione sulla finestra (W/s)."""
+        n = self._count
+        if n < 2:
+            return 0.0
+        den = n * self._stt - self._st * self._st
+        if den <= 1e-9:
+            return 0.0
+        return (n * self._stp - self._st * self._sp) / den
+
+    def project(self, horizon):
+        """Potenza attesa tra `horizon` secondi (EWMA + pendenza)."""
+        if self.ewma is None:
+            return None
+        return self.ewma + self.slope() * horizon
+
+    def _rebase(self, t):
+        shift = t - self._origin
+        self._origin = t
+        self._since_rebase = 0
+        self._st = self._sp = self._stt = self._stp = 0.0
+        for i in range(self._count):
+            x = self._t[i] - shift
+            p = self._p[i]
+            self._t[i] = x
+            self._st += x
+            self._sp += p
+            self._stt += x * x
+            self._stp += x * p
+
+
+class OverloadPredictor:
+    """
+    Previsione di zona rossa da PowerTrend e verifica a posteriori.
+
+    observe() ritorna la potenza proiettata quando scatta una nuova
+    previsione (proiezione a `horizon` secondi oltre la soglia rossa
+    con pendenza almeno `min_slope` W/s), altrimenti None. Ogni
+    previsione resta aperta per `horizon` secondi e si chiude come:
+      hit         - la zona rossa arriva davvero
+      averted     - nessun rosso dopo uno shed preventivo
+      false_alarm - nessun rosso e nessuno shed
+    Un ingresso in rosso senza previsione aperta e "unpredicted".
+    """
+
+    def __init__(self, horizon=30.0, size=30, alpha=0.3, min_slope=20.0,
+                 min_samples=5):
+        self.horizon = float(horizon)
+        self.min_slope = float(min_slope)
+        self.min_samples = max(int(min_samples), 2)
+        self.trend = PowerTrend(size, alpha)
+        self._pending = None  # [inizio, scadenza, preempted]
+        self._was_red = False
+        self._lead_total = 0.0
+        self.last_projection = None
+        self.counters = {"predictions": 0, "hits": 0, "averted": 0,
+                         "false_alarms": 0, "unpredicted": 0}
+
+    def observe(self, t, power, red_threshold, in_red):
+        self.trend.add(t, power)
+        pending = self._pending
+        if pending is not None and not in_red and t > pending[1]:
+            self.counters["averted" if pending[2] else "false_alarms"] += 1
+            self._pending = pending = None
+        if in_red:
+            if not self._was_red:
+                if pending is not None:
+                    self.counters["hits"] += 1
+                    self._lead_total += t - pending[0]
+                else:
+                    self.counters["unpredicted"] += 1
+            self._pending = None
+            self._was_red = True
+            return None
+        self._was_red = False
+
+        if len(self.trend) < self.min_samples:
+            return None
+        projected = self.trend.project(self.horizon)
+        self.last_projection = projected
+        if (pending is None and projected >= red_threshold
+                and self.trend.slope() >= self.min_slope):
+            self._pending = [t, t + self.horizon, False]
+            self.counters["predictions"] += 1
+            return projected
+        return None
+
+    def mark_preempted(self):
+        """Registra che la previsione aperta ha prodotto uno shed."""
+        if self._pending is not None:
+            self._pending[2] = True
+
+    def stats(self):
+        hits = self.counters["hits"]
+        closed = hits + self.counters["averted"] + self.counters[
+            "false_alarms"]
+        return dict(
+            self.counters,
+            pending=self._pending is not None,
+            precision=(round((hits + self.counters["averted"]) / closed, 3)
+                       if closed else None),
+            mean_lead_s=round(self._lead_total / hits, 1) if hits else None,
+            slope_w_s=round(self.trend.slope(), 1),
+            projected_w=(round(self.last_projection)
+                         if self.last_projection is not None else None),
+        )
+
+
+class ChargeController:
+    """
+    Regolatore PI della potenza di carica forzata dell'accumulo.
+
+    Errore = target - potenza di rete (positivo = margine libero):
+    l'uscita (potenza di carica) sale col margine e scende col supero.
+      - anti-windup: l'integrale non accumula quando l'uscita e gia
+        satura (0 o `ceiling`) nella direzione dell'errore
+      - rate limit: variazione massima rate_up / rate_down W/s
+      - l'uscita e arrotondata per difetto a `step`; `changed` dice
+        se va scritta: solo variazioni di almeno `min_change` W (o
+        arrivo a 0), cosi il rumore della rete non genera chiamate
+    """
+
+    __slots__ = ("kp", "ki", "rate_up", "rate_down", "step", "min_change",
+                 "output", "integral", "written", "updates", "writes",
+                 "_last_t")
+
+    def __init__(self, kp=0.1, ki=0.01, rate_up=20.0, rate_down=500.0,
+                 step=100, min_change=None):
+        self.kp = float(kp)
+        self.ki = float(ki)
+        self.rate_up = float(rate_up)
+        self.rate_down = float(rate_down)
+        self.step = step
+        self.min_change = 2 * step if min_change is None else min_change
+        self.output = 0.0
+        self.integral = 0.0
+        self.written = None
+        self.updates = 0
+        self.writes = 0
+        self._last_t = None
+
+    def reset(self, t, output, written=None):
+        """Allinea il regolatore a un valore impostato dall'esterno."""
+        self.output = self.integral = float(output)
+        self.written = self._quantize(
+            output if written is None else written)
+        self._last_t = t
+
+    def update(self, t, grid_power, target, ceiling, allow_increase=True):
+        """Nuova uscita quantizzata (W) per la potenza di rete misurata."""
+        dt = 0.0 if self._last_t is None else max(t - self._last_t, 0.0)
+        self._last_t = t
+        self.updates += 1
+        error = target - grid_power
+        high = ceiling if allow_increase else min(self.output, ceiling)
+
+        candidate = self.integral + self.ki * error * dt
+        saturated = ((error > 0 and candidate + self.kp * error > high)
+                     or (error < 0 and candidate + self.kp * error < 0))
+        if not saturated:
+            self.integral = candidate
+        self.integral = min(max(self.integral, 0.0), high)
+
+        wanted = min(max(self.integral + self.kp * error, 0.0), high)
+        lo = self.output - self.rate_down * dt
+        hi = self.output + self.rate_up * dt
+        self.output = min(max(wanted, lo), hi)
+        return self._quantize(self.output)
+
+    def changed(self, value):
+        if value == self.written or (
+                value and self.written is not None
+                and abs(value - self.written) < self.min_change):
+            return False
+        self.written = value
+        self.writes += 1
+        return True
+
+    def stats(self):
+        return {
+            "output": round(self.output),
+            "written": self.written,
+            "updates": self.updates,
+            "writes": self.writes,
+        }
+
+    def _quantize(self, watts):
+        return max(int(watts / self.step) * self.step, 0)
+
+
+class MeterBudget:
+    """
+    Emulazione della tolleranza del contatore Open Meter (GEMIS).
+
+    Il contatore non usa timer fissi: accumula il tempo trascorso
+    sopra ciascuna soglia e stacca quando il tempo accumulato esaurisce
+    la tolleranza della fascia:
+      gialla  (>= 110%): yellow_budget secondi (default 3 ore)
+      rossa   (>= 133%): red_budget secondi (default 2 minuti)
+    Il tempo in rosso conta anche per la fascia gialla. Sotto soglia
+    il consumo recupera `recovery_rate` secondi per secondo, quindi
+    rientri brevi non azzerano il conto e le escursioni ripetute si
+    sommano.
+
+    La potenza e costante a tratti: update() integra l'intervallo
+    dall'ultimo campione con la fascia precedente, advance() porta il
+    conto a un istante senza nuovo campione (timer).
+    """
+
+    NONE = 0
+    YELLOW = 1
+    RED = 2
+
+    def __init__(self, yellow_budget=10800.0, red_budget=120.0,
+                 recovery_rate=1.0):
+        self.yellow_budget = float(yellow_budget)
+        self.red_budget = float(red_budget)
+        self.recovery_rate = float(recovery_rate)
+        self.yellow_used = 0.0
+        self.red_used = 0.0
+        self.band = self.NONE
+        self.trips = 0
+        self._last_t = None
+
+    @classmethod
+    def classify(cls, power, yellow_w, red_w):
+        if power >= red_w:
+            return cls.RED
+        if power >= yellow_w:
+            return cls.YELLOW
+        return cls.NONE
+
+    def update(self, t, power, yellow_w, red_w):
+        self.advance(t)
+        self.band = self.classify(power, yellow_w, red_w)
+
+    def advance(self, t):
+        last = self._last_t
+        self._last_t = t
+        if last is None or t <= last:
+            return
+        dt = t - last
+        recovered = dt * self.recovery_rate
+        exhausted = (self.yellow_used >= self.yellow_budget
+                     or self.red_used >= self.red_budget)
+        if self.band >= self.YELLOW:
+            self.yellow_used += dt
+        else:
+            self.yellow_used = max(self.yellow_used - recovered, 0.0)
+        if self.band == self.RED:
+            self.red_used += dt
+        else:
+            self.red_used = max(self.red_used - recovered, 0.0)
+        if (self.yellow_used >= self.yellow_budget
+                or self.red_used >= self.red_budget):
+            # Qui il contatore avrebbe staccato
+            if not exhausted:
+                self.trips += 1
+            self.yellow_used = min(self.yellow_used, self.yellow_budget)
+            self.red_used = min(self.red_used, self.red_budget)
+
+    def remaining(self):
+        """Secondi al distacco restando nella fascia attuale (o None)."""
+        if self.band == self.NONE:
+            return None
+        left = self.yellow_budget - self.yellow_used
+        if self.band == self.RED:
+            left = min(left, self.red_budget - self.red_used)
+        return max(left, 0.0)
+
+    def to_list(self):
+        return [round(self.yellow_used), round(self.red_used), self._last_t]
+
+    def load(self, values, t):
+        """
+        Riprende il consumo salvato all'istante values[2]: il tempo
+        passato da allora (app ferma) conta come recupero sotto soglia.
+        """
+        try:
+            yellow_used, red_used, saved_t = values
+            downtime = max(t - float(saved_t), 0.0)
+        except (TypeError, ValueError):
+            return
+        recovered = downtime * self.recovery_rate
+        self.yellow_used = max(float(yellow_used) - recovered, 0.0)
+        self.red_used = max(float(red_used) - recovered, 0.0)
+        self._last_t = t
+
+    def stats(self):
+        remaining = self.remaining()
+        return {
+            "band": ("none", "yellow", "red")[self.band],
+            "yellow_used_s": round(self.yellow_used),
+            "red_used_s": round(self.red_used),
+            "remaining_s": (round(remaining)
+                            if remaining is not None else None),
+            "trips": self.trips,
+        }
+
+
+class SnapshotStore:
+    """
+    Snapshot dello stato su disco (JSON compatto) per il riavvio a caldo.
+
+    save() scrive solo se i dati sono cambiati e non piu spesso di
+    `min_interval` secondi (altrimenti "deferred": il chiamante
+    pianifica flush()). La scrittura e atomica: file temporaneo nella
+    stessa directory, fsync, os.replace. Un file corrotto o assente
+    al load() equivale a nessuno snapshot.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, clock, min_interval=5.0, log=None):
+        self.path = path
+        self._clock = clock
+        self.min_interval = float(min_interval)
+        self._log = log
+        self._last = None
+        self._last_write = None
+        self._pending = None
+        self.writes = 0
+        self.errors = 0
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json_module.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self._warn(f"Snapshot illeggibile ({self.path}): {e}")
+            return None
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            return None
+        return data
+
+    def save(self, data, force=False):
+        if data == self._last:
+            self._pending = None
+            return "skipped"
+        now = self._clock()
+        if (not force and self._last_write is not None
+                and now - self._last_write < self.min_interval):
+            self._pending = data
+            return "deferred"
+        self._write(data, now)
+        return "written"
+
+    def flush(self):
+        if self._pending is not None:
+            self._write(self._pending, self._clock())
+
+    def next_write_in(self):
+        if self._last_write is None:
+            return 0.0
+        return max(self.min_interval - (self._clock() - self._last_write),
+                   0.0)
+
+    def stats(self):
+        return {"writes": self.writes, "errors": self.errors,
+                "pending": self._pending is not None}
+
+    def _write(self, data, now):
+        self._pending = None
+        payload = dict(data, version=self.VERSION, saved_at=now)
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json_module.dump(payload, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.errors += 1
+            self._warn(f"Snapshot non salvato ({self.path}): {e}")
+            return
+        self._last = data
+        self._last_write = now
+        self.writes += 1
+
+    def _warn(self, message):
+        if self._log is not None:
+            self._log(message, level="WARNING")
+
+
+class DecisionJournal:
+    """
+    Giornale append-only delle decisioni: un record a schema fisso per
+    riga, array JSON nell'ordine di FIELDS.
+
+    record() accoda in memoria e ritorna subito; il thread del giornale
+    scrive a blocchi ogni `flush_interval` secondi (o appena si
+    accumulano `batch_size` record), quindi il percorso di controllo non
+    tocca mai il disco. La coda e limitata: se il disco non tiene il
+    passo si perdono i record piu vecchi. Oltre `max_bytes` il file
+    ruota in .1 ... .<backups>; read() rilegge in streaming dal file
+    ruotato piu vecchio al corrente.
+    """
+
+    FIELDS = ("t", "kind", "zone", "power", "device", "value", "detail")
+    KINDS = ("zone", "shed", "restore", "luna", "notify", "timeout")
+
+    def __init__(self, path, max_bytes=1048576, backups=3,
+                 flush_interval=2.0, batch_size=200, max_queue=10000,
+                 log=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self._log = log or (lambda msg, level="INFO": None)
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._size = None
+        self.records = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.rotations = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="pm-journal", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Scrive i record in coda e ferma il thread."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def record(self, t, kind, zone=None, power=None, device=None,
+               value=None, detail=None):
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((t, kind, zone, power, device, value, detail))
+            self.records += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+
+    def stats(self):
+        return {"records": self.records, "written": self.written,
+                "queued": len(self._queue), "dropped": self.dropped,
+                "errors": self.errors, "rotations": self.rotations}
+
+    @classmethod
+    def read(cls, path, kinds=None, since=None):
+        """
+        Record come dict, dal piu vecchio. Le righe illeggibili (es.
+        troncate da uno spegnimento brusco) vengono saltate.
+        """
+        folder = os.path.dirname(path) or "."
+        prefix = os.path.basename(path) + "."
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            return
+        rotated = sorted((int(n[len(prefix):]) for n in names
+                          if n.startswith(prefix)
+                          and n[len(prefix):].isdigit()), reverse=True)
+        paths = [f"{path}.{i}" for i in rotated] + [path]
+        for file_path in paths:
+            try:
+                f = open(file_path, encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        values = json_module.loads(line)
+                    except ValueError:
+                        continue
+                    if (not isinstance(values, list)
+                            or len(values) != len(cls.FIELDS)):
+                        continue
+                    record = dict(zip(cls.FIELDS, values))
+                    if kinds and record["kind"] not in kinds:
+                        continue
+                    if since is not None and record["t"] < since:
+                        continue
+                    yield record
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if (not self._stopping
+                        and len(self._queue) < self.batch_size):
+                    self._cond.wait(self.flush_interval)
+                batch = list(self._queue)
+                self._queue.clear()
+                stopping = self._stopping
+            if batch:
+                self._write(batch)
+            if stopping:
+                break
+
+    def _write(self, batch):
+        data = "".join(
+            json_module.dumps(r, separators=(",", ":"), ensure_ascii=False)
+            + "\n" for r in batch).encode("utf-8")
+        try:
+            if self._size is None:
+                try:
+                    self._size = os.path.getsize(self.path)
+                except FileNotFoundError:
+                    self._size = 0
+            if self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "ab") as f:
+                f.write(data)
+        except OSError as e:
+            self.errors += 1
+            self._log(f"Giornale non scritto ({self.path}): {e}",
+                      level="WARNING")
+            return
+        self._size += len(data)
+        self.written += len(batch)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._size = 0
+        self.rotations += 1
+
+
+class DeadlineScheduler:
+    """
+    Scadenze nominate in un heap, servite da un solo timer AppDaemon.
+
+    Ogni scadenza ha un nome unico ("restore", "max_shed:Forno", ...):
+    riprogrammare un nome sostituisce la scadenza precedente. Inserimento
+    O(log n); la cancellazione e O(1) (la voce nell'heap resta come
+    scaduta e viene scartata all'estrazione, con compattazione quando
+    le voci morte superano la meta). `interval` rende la scadenza
+    periodica.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+        self._dead = 0
+        self.fired = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def schedule(self, name, when, callback, kwargs=None, interval=None):
+        if name in self._entries:
+            self.cancel(name)
+        entry = [when, next(self._seq), name, callback, kwargs or {},
+                 interval, True]
+        self._entries[name] = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return False
+        entry[6] = False
+        self._dead += 1
+        if self._dead > len(self._heap) // 2:
+            self._heap = [e for e in self._heap if e[6]]
+            heapq.heapify(self._heap)
+            self._dead = 0
+        return True
+
+    def cancel_prefix(self, prefix):
+        names = self.names(prefix)
+        for name in names:
+            self.cancel(name)
+        return len(names)
+
+    def names(self, prefix=""):
+        return [n for n in self._entries if n.startswith(prefix)]
+
+    def next_due(self):
+        while self._heap and not self._heap[0][6]:
+            heapq.heappop(self._heap)
+            self._dead -= 1
+        return self._heap[0][0] if self._heap else None
+
+    def peek(self):
+        """(nome, istante) della prossima scadenza, o None."""
+        due = self.next_due()
+        return None if due is None else (self._heap[0][2], due)
+
+    def due_in(self, name, now):
+        entry = self._entries.get(name)
+        return None if entry is None else entry[0] - now
+
+    def pop_due(self, now):
+        """Prossima scadenza raggiunta: (nome, callback, kwargs) o None."""
+        due = self.next_due()
+        if due is None or due > now:
+            return None
+        when, _, name, callback, kwargs, interval, _ = heapq.heappop(
+            self._heap)
+        del self._entries[name]
+        if interval:
+            after = when + interval
+            self.schedule(name, after if after > now else now + interval,
+                          callback, kwargs, interval)
+        self.fired += 1
+        return name, callback, kwargs
+
+    def pending(self, now):
+        """Scadenze in attesa, ordinate: {nome: secondi mancanti}."""
+        return {e[2]: round(e[0] - now, 1)
+                for e in sorted(self._entries.values())}
+
+
+class SiteDeadlines:
+    """
+    Le scadenze di un sito nello scheduler condiviso dell'ospite.
+
+    Stessa interfaccia di DeadlineScheduler per il codice del sito, con
+    i nomi prefissati ("casa:restore"): un solo heap e un solo timer
+    AppDaemon per tutti i siti. Estrazione e tick restano all'ospite;
+    `fired` e il totale condiviso.
+    """
+
+    def __init__(self, scheduler, site_id):
+        self._scheduler = scheduler
+        self.prefix = f"{site_id}:"
+
+    def __len__(self):
+        return len(self._scheduler.names(self.prefix))
+
+    def __contains__(self, name):
+        return self.prefix + name in self._scheduler
+
+    @property
+    def fired(self):
+        return self._scheduler.fired
+
+    def schedule(self, name, when, callback, kwargs=None, interval=None):
+        self._scheduler.schedule(
+            self.prefix + name, when, callback, kwargs, interval)
+
+    def cancel(self, name):
+        return self._scheduler.cancel(self.prefix + name)
+
+    def cancel_prefix(self, prefix):
+        return self._scheduler.cancel_prefix(self.prefix + prefix)
+
+    def next_due(self):
+        return self._scheduler.next_due()
+
+    def peek(self):
+        """(nome, istante) della prossima scadenza del sito, o None."""
+        names = self._scheduler.names(self.prefix)
+        if not names:
+            return None
+        when, name = min((self._scheduler.due_in(n, 0), n) for n in names)
+        return name[len(self.prefix):], when
+
+    def due_in(self, name, now):
+        return self._scheduler.due_in(self.prefix + name, now)
+
+    def pending(self, now):
+        size = len(self.prefix)
+        return {name[size:]: left for name, left
+                in self._scheduler.pending(now).items()
+                if name.startswith(self.prefix)}
+
+
+class LatencyHistogram:
+    """
+    Istogramma di latenze in microsecondi, a precisione relativa fissa
+    (stile HDR): sotto 2^SUB_BITS us un bucket per valore, sopra
+    2^SUB_BITS bucket per ogni potenza di 2. Memoria limitata (qualche
+    centinaio di bucket fino a ore) e percentili con errore relativo
+    inferiore a 1/2^SUB_BITS, senza tenere i singoli campioni.
+    """
+
+    SUB_BITS = 5
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        shift = max(value.bit_length() - cls.SUB_BITS - 1, 0)
+        return (shift << cls.SUB_BITS) + (value >> shift)
+
+    @classmethod
+    def _upper(cls, index):
+        """Valore piu alto che cade nel bucket `index`."""
+        shift = max((index >> cls.SUB_BITS) - 1, 0)
+        mantissa = index - (shift << cls.SUB_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value_us):
+        value = max(int(value_us), 0)
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0
+        target = max(math.ceil(self.count * pct / 100), 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+
+class CallProfiler:
+    """
+    Strumentazione opzionale dei punti d'ingresso dell'app.
+
+    `wrap` avvolge un callback: conta le invocazioni, ne registra la
+    durata in un LatencyHistogram e attribuisce all'invocazione le
+    chiamate fatte nel frattempo (get_state, call_service, set_state,
+    messaggi Telegram), contate dai wrapper di `counting`. I conteggi
+    sono inclusivi: se un callback strumentato ne chiama un altro, le
+    chiamate valgono per entrambi. Invocazioni piu lente di `slow_ms`
+    vengono passate a `on_slow(nome, ms, conteggi)`.
+    """
+
+    COUNTERS = ("get_state", "call_service", "set_state", "http")
+
+    def __init__(self, slow_ms=0, on_slow=None, clock=time.perf_counter):
+        self.totals = [0] * len(self.COUNTERS)
+        self.entries = {}
+        self.slow_ms = slow_ms
+        self._on_slow = on_slow
+        self._clock = clock
+
+    def counting(self, counter, fn):
+        totals = self.totals
+        slot = self.COUNTERS.index(counter)
+
+        @functools.wraps(fn)
+        def counted(*args, **kwargs):
+            totals[slot] += 1
+            return fn(*args, **kwargs)
+        return counted
+
+    def wrap(self, name, fn):
+        entry = self.entries.setdefault(name, {
+            "calls": 0, "latency": LatencyHistogram(),
+            "sums": [0] * len(self.COUNTERS),
+            "peaks": [0] * len(self.COUNTERS),
+        })
+        totals = self.totals
+        clock = self._clock
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            before = list(totals)
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed_ms = (clock() - start) * 1000
+                entry["calls"] += 1
+                entry["latency"].record(elapsed_ms * 1000)
+                deltas = [a - b for a, b in zip(totals, before)]
+                for i, delta in enumerate(deltas):
+                    entry["sums"][i] += delta
+                    if delta > entry["peaks"][i]:
+                        entry["peaks"][i] = delta
+                if self.slow_ms and elapsed_ms >= self.slow_ms \
+                        and self._on_slow is not None:
+                    self._on_slow(name, elapsed_ms,
+                                  dict(zip(self.COUNTERS, deltas)))
+        return timed
+
+    def stats(self):
+        """Riepilogo per callback: latenze in ms, chiamate per invocazione."""
+        summary = {}
+        for name, entry in sorted(self.entries.items()):
+            calls = entry["calls"]
+            if not calls:
+                continue
+            hist = entry["latency"]
+            item = {
+                "calls": calls,
+                "p50_ms": round(hist.percentile(50) / 1000, 2),
+                "p90_ms": round(hist.percentile(90) / 1000, 2),
+                "p99_ms": round(hist.percentile(99) / 1000, 2),
+                "max_ms": round(hist.max / 1000, 2),
+                "mean_ms": round(hist.mean() / 1000, 2),
+            }
+            for counter, total, peak in zip(self.COUNTERS, entry["sums"],
+                                            entry["peaks"]):
+                item[counter] = round(total / calls, 2)
+                item[f"{counter}_max"] = peak
+            summary[name] = item
+        return summary
 
 
 class PowerManager(hass.Hass):
 
+    # Punti d'ingresso AppDaemon strumentati con `profiling: true`
+    PROFILED_CALLBACKS = (
+        "on_power_change", "_on_deadline_tick",
+        "_yellow_check2_callback", "_yellow_check3_callback",
+        "_yellow_check4_callback", "_yellow_recheck_callback",
+        "_check_stability_then_restore", "_restore_next_in_queue",
+        "_on_restore_verify", "_on_max_shed_timeout",
+        "_on_settings_change", "_on_dashboard_change",
+        "_on_dashboard_enable_change", "_on_test_toggle",
+        "_on_test_power_change", "_on_device_power",
+        "_on_cached_state_change", "_on_power_source_tick",
+    )
+
     def initialize(self):
+        # Cache stati HA: va creata prima di qualsiasi lettura
+        self.state_cache = StateCache(
+            self._load_entity_state, self._clock,
+            retry=self.args.get("state_cache_retry", 60))
+        self.telegram_senders = {}
+        self.metrics_exporters = {}
+        self.site_id = None
+        self.sites = []
+        # Tutte le scadenze dell'app (anche dei siti) passano da qui:
+        # un solo timer AppDaemon
+        self.deadlines = DeadlineScheduler()
+        self.deadline_handle = None
+        self.deadline_armed = None
+
+        # Multi-sito: ogni voce di `sites` e un contatore indipendente
+        sites = self.args.get("sites")
+        if sites:
+            self._init_sites(sites)
+            return
+        self._setup()
+
+    def _setup(self):
+        """Configura e avvia la gestione di un contatore."""
+        # Prima dei listener: registrano i metodi gia strumentati
+        self._setup_profiling()
+
         # =================================================================
         # CONFIGURAZIONE
         # =================================================================
         self.power_sensor = self.args.get(
             "power_sensor", "sensor.power_meter"
         )
-        self.hysteresis = self.args.get("hysteresis", 200)
-        self._recalculate_thresholds()
+        # Sorgente diretta opzionale (power_source): vedi _setup_power_source
+        self.power_source = None
+        self.source_power = None
+        self.settings = None
+        self._compile_settings()
 
         # =================================================================
         # NOTIFICHE
@@ -77,21 +2672,112 @@ class PowerManager(hass.Hass):
         )
         self.telegram_chat_id = self.args.get("telegram_chat_id", 0)
         self.telegram_bot_token = self.args.get("telegram_bot_token", "")
+        self.telegram_sender = None
+        if self.telegram_bot_token:
+            self.telegram_sender = self._get_telegram_sender(
+                self.telegram_bot_token, self.telegram_chat_id)
+        # Dedup, limiti per categoria e digest; i messaggi critici passano
+        self.notifications = NotificationRouter(
+            deliver=self._deliver_notification,
+            clock=self._clock,
+            formatter=self._format_digest,
+            burst=self.args.get("notify_burst", 3),
+            refill=self.args.get("notify_refill", 300),
+            dedup_window=self.args.get("notify_dedup_window", 600),
+            digest_window=self.args.get("notify_digest_window", 300),
+            limits={category: tuple(limit) for category, limit in
+                    (self.args.get("notify_limits") or {}).items()},
+        )
 
         # =================================================================
-        # ACCUMULO DOMESTICO (es. Huawei Luna2000)
+        # PUBBLICAZIONE sensor.power_manager_zone
         # =================================================================
-        self.luna_switch = self.args.get(
-            "luna_charge_switch", self.luna_switch
-        )
-        self.luna_power_slider = self.args.get(
-            "luna_power_slider", self.luna_power_slider
-        )
-        self.luna_power_sensor = self.args.get(
-            "luna_power_sensor", self.luna_power_sensor
+        # Scrive solo se qualcosa e cambiato oltre le deadband; zona e
+        # stato shed forzano la scrittura, il resto e rate-limited.
+        self.zone_publisher = StatePublisher(
+            writer=self._write_zone_sensor,
+            clock=self._clock,
+            min_interval=self.args.get("publish_min_interval", 10),
+            deadbands=self.args.get("publish_deadbands"),
+            volatile=("state_cache", "publisher", "telegram", "prediction",
+                      "deadlines", "journal", "notifications",
+                      "power_source"),
         )
+
+        # =================================================================
+        # SNAPSHOT (riavvio a caldo)
+        # =================================================================
+        # snapshot_path assente = nessun file: all'avvio si riparte da
+        # zero come prima. In multi-sito il nome prende l'id del sito.
+        self.snapshot_store = None
+        snapshot_path = self._site_path(self.args.get("snapshot_path"))
+        if snapshot_path:
+            self.snapshot_store = SnapshotStore(
+                snapshot_path, self._clock,
+                min_interval=self.args.get("snapshot_min_interval", 5),
+                log=self.log,
+            )
+        # In fascia il contatore consuma tolleranza di continuo: oltre ai
+        # cambi di fascia lo si salva ogni snapshot_meter_interval secondi
+        self.snapshot_meter_interval = self.args.get(
+            "snapshot_meter_interval", 300)
+
+        # =================================================================
+        # GIORNALE DECISIONI
+        # =================================================================
+        # Un record per decisione (zona, shed, restore, Luna2000,
+        # notifica, timeout), scritto da un thread: niente I/O qui.
+        self.journal = None
+        journal_path = self._site_path(self.args.get("journal_path"))
+        if journal_path:
+            self.journal = DecisionJournal(
+                journal_path,
+                max_bytes=self.args.get("journal_max_bytes", 1048576),
+                backups=self.args.get("journal_backups", 3),
+                flush_interval=self.args.get("journal_flush_interval", 2),
+                log=self.log,
+            )
+            self.journal.start()
+
+        # =================================================================
+        # METRICHE (endpoint Prometheus)
+        # =================================================================
+        # Contatori aggiornati dalle decisioni, gauge da _publish_state:
+        # le richieste HTTP leggono solo questi valori, mai HA.
+        self.metrics = None
+        self.metric_labels = (("site", self.site_id),) if self.site_id else ()
+        metrics_port = self.args.get("metrics_port")
+        if metrics_port:
+            self.metrics = self._get_metrics_exporter(
+                self.args.get("metrics_host", "0.0.0.0"), int(metrics_port))
+
+        # =================================================================
+        # ACCUMULO DOMESTICO (es. Huawei Luna2000)
+        # =================================================================
+        # Chiavi assenti = nessun accumulo (entity vuote, logica saltata)
+        self.luna_switch = self.args.get("luna_charge_switch", "")
+        self.luna_power_slider = self.args.get("luna_power_slider", "")
+        self.luna_power_sensor = self.args.get("luna_power_sensor", "")
         self.luna_power_step = self.args.get("luna_power_step", 100)
 
+        # luna_controller: regolatore PI che modula la carica per tenere
+        # la rete luna_target_margin W sotto il 110%, al posto della
+        # riduzione una tantum e del ripristino a fine restore.
+        self.luna_controller = None
+        if self.args.get("luna_controller", False) and self.luna_power_slider:
+            self.luna_controller = ChargeController(
+                kp=self.args.get("luna_kp", 0.1),
+                ki=self.args.get("luna_ki", 0.01),
+                rate_up=self.args.get("luna_rate_up", 20),
+                rate_down=self.args.get("luna_rate_down", 500),
+                step=self.luna_power_step,
+                min_change=self.args.get(
+                    "luna_min_change", 2 * self.luna_power_step),
+            )
+        self.luna_target_margin = self.args.get("luna_target_margin", 400)
+        self.luna_control_interval = self.args.get("luna_control_interval", 5)
+        self.luna_control_last = None
+
         # =================================================================
         # ANTI PING-PONG
         # =================================================================
@@ -100,12 +2786,98 @@ class PowerManager(hass.Hass):
         )
         self.min_shed_duration = self.args.get("min_shed_duration", 300)
 
+        # Restore a gruppi: oltre al primo device in coda si riaccendono
+        # insieme quelli che stanno nel margine x restore_batch_safety.
+        # restore_batch_max: 1 = un device per volta (comportamento v6).
+        self.restore_batch_safety = self.args.get("restore_batch_safety", 0.8)
+        self.restore_batch_max = self.args.get("restore_batch_max", 0)
+
+        # Storico esiti restore per device: un device rispento entro
+        # restore_fail_window dal restore non si riaccende prima del
+        # suo backoff (raddoppia a ogni fallimento, max restore_backoff_max).
+        self.restore_fail_window = self.args.get("restore_fail_window", 600)
+        self.restore_backoff_max = self.args.get("restore_backoff_max", 3600)
+
+        # =================================================================
+        # TOLLERANZA CONTATORE (GEMIS)
+        # =================================================================
+        # I check in gialla scattano quando il tempo accumulato sopra
+        # il 110% raggiunge i valori di yellow_check_marks (2, 3, 4).
+        self.meter = MeterBudget(
+            yellow_budget=self.args.get("meter_yellow_budget", 10800),
+            red_budget=self.args.get("meter_red_budget", 120),
+            recovery_rate=self.args.get("meter_recovery_rate", 1.0),
+        )
+        self.yellow_check_marks = self.args.get(
+            "yellow_check_marks", [180, 3600, 9000])
+
+        # sensor.pm_elapsed_time pubblica l'istante di ingresso in zona
+        # (una scrittura per cambio zona). elapsed_refresh: true aggiunge
+        # un aggiornamento lato server ogni tolleranza residua / 10,
+        # tra elapsed_refresh_min e elapsed_refresh_max secondi.
+        self.elapsed_refresh = self.args.get("elapsed_refresh", False)
+        self.elapsed_refresh_min = self.args.get("elapsed_refresh_min", 5)
+        self.elapsed_refresh_max = self.args.get("elapsed_refresh_max", 300)
+
+        # =================================================================
+        # STRATEGIA SHED
+        # =================================================================
+        # greedy:  primo device che basta, altrimenti in ordine priorita
+        # optimal: insieme con minima sovra-riduzione (solve_shed_set)
+        self.shed_strategy = self.args.get("shed_strategy", "greedy")
+        self.shed_priority_weight = self.args.get("shed_priority_weight", 50)
+
+        # Comandi di shed/restore decisi insieme: una chiamata per
+        # servizio con lista di entity_id; dispatch_workers > 1 invia
+        # in parallelo i servizi diversi.
+        self.actions = ActionBatcher(
+            self.call_service, log=self.log,
+            workers=self.args.get("dispatch_workers", 1))
+        self.power_event_at = None
+        self.red_dispatch = {"count": 0, "last_ms": None, "max_ms": None,
+                             "last_calls": 0}
+
+        # =================================================================
+        # PREVISIONE SOVRACCARICO
+        # =================================================================
+        # predict_horizon > 0 attiva la stima di tendenza sulla rete;
+        # con predict_preemptive_shed lo shed parte prima del rosso.
+        self.overload_predictor = None
+        predict_horizon = self.args.get("predict_horizon", 0)
+        if predict_horizon and predict_horizon > 0:
+            self.overload_predictor = OverloadPredictor(
+                horizon=predict_horizon,
+                size=self.args.get("predict_window", 30),
+                alpha=self.args.get("predict_alpha", 0.3),
+                min_slope=self.args.get("predict_min_slope", 20),
+            )
+        self.predict_preemptive_shed = self.args.get(
+            "predict_preemptive_shed", False)
+
         # =================================================================
         # DISPOSITIVI
         # =================================================================
-        self.devices = self._init_devices()
+        self.devices = DeviceRegistry(self._init_devices())
         self.non_controllable = self._init_non_controllable()
 
+        # =================================================================
+        # PROFILI DI CONSUMO
+        # =================================================================
+        # Appresi dai sensori di potenza; con almeno profile_min_cycles
+        # cicli sostituiscono last_known_power/estimated_power nelle
+        # stime di restore. profile_path li conserva tra i riavvii.
+        self.profile_min_cycles = self.args.get("profile_min_cycles", 3)
+        self.profile_surge_window = self.args.get("profile_surge_window", 30)
+        self.profile_store = None
+        profile_path = self._site_path(self.args.get("profile_path"))
+        if profile_path:
+            self.profile_store = SnapshotStore(
+                profile_path, self._clock,
+                min_interval=self.args.get("profile_save_interval", 300),
+                log=self.log,
+            )
+            self._load_profiles()
+
         # =================================================================
         # STATO INTERNO
         # =================================================================
@@ -114,31 +2886,24 @@ class PowerManager(hass.Hass):
         self.shed_active = False
         self.green_stable_since = None
         self.restore_in_progress = False
-        self.restore_timer = None
-        self.restore_check_timer = None
         self.current_check = None
         self.came_from_yellow = False
+        self.shed_luna_watts = 0.0  # Luna2000 nell'ultimo _smart_shed
 
         # v6
         self.shed_cycle_count = 0
         self.restore_queue = []
-        self.last_restored_device = None
-        self.max_shed_timers = {}
+        self.last_restored_batch = []
+        self.restore_started_at = None
+        self.restore_stats = {"count": 0, "last_s": None, "mean_s": None,
+                              "last_steps": 0}
+        self.restore_steps = 0
 
         # v6: Luna2000 battery charging
         self.luna_was_charging = False
         self.luna_pre_shed_power = 0.0
         self.luna_reduced = False
 
-        # Timer zona gialla
-        self.yellow_check2_timer = None
-        self.yellow_check3_timer = None
-        self.yellow_check4_timer = None
-        self.yellow_recheck_timer = None
-
-        # Timer real-time
-        self.realtime_timer = None
-
         # =================================================================
         # TEST MODE
         # =================================================================
@@ -150,20 +2915,21 @@ class PowerManager(hass.Hass):
         # LISTENER
         # =================================================================
         self.listen_state(self.on_power_change, self.power_sensor)
+        self._setup_power_source()
 
-        if self.entity_exists("input_number.pm_contract_power"):
-            self.listen_state(
-                self._on_contract_power_change,
-                "input_number.pm_contract_power"
-            )
+        for helper in RuntimeSettings.helpers():
+            if self._cached_exists(self._ns(helper)):
+                self.listen_state(self._on_settings_change, self._ns(helper))
         self._setup_dashboard_listeners()
+        self._setup_profile_listeners()
+        self._prime_state_cache()
 
         # =================================================================
         # LOG
         # =================================================================
-        min_active = self._get_min_active_power()
-        restore_int = self._get_restore_interval()
-        max_shed_t = self._get_max_shed_time()
+        min_active = self.settings.min_active_power
+        restore_int = self.settings.restore_interval
+        max_shed_t = self.settings.max_shed_time
 
         self.log("=" * 65)
         self.log("POWER MANAGER v6 INIZIALIZZATO")
@@ -182,42 +2948,34 @@ class PowerManager(hass.Hass):
         self.log(f"  Telegram ID:    {self.telegram_chat_id}")
         tg_ok = "OK" if self.telegram_bot_token else "MANCA!"
         self.log(f"  Telegram Bot:   {tg_ok}")
-        dnd = self._get_dnd_periods()
-        self.log(f"  DND Alexa 1:    {dnd[0][0]}-{dnd[0][1]}")
-        self.log(f"  DND Alexa 2:    {dnd[1][0]}-{dnd[1][1]}")
-        luna_ok = "SI" if self.entity_exists(
-            self.luna_switch) else "NO"
+        for i, period in enumerate(self.settings.dnd_labels(), 1):
+            self.log(f"  DND Alexa {i}:    {period}")
+        luna_ok = "SI" if self._cached_exists(self.luna_switch) else "NO"
         self.log(f"  Luna2000:       {luna_ok}")
         self.log("  Priorita:")
         self.log("    P0: Luna2000 (riduzione/stop carica)")
-        for d in sorted(self.devices, key=lambda x: x.priority):
+        for d in self.devices.by_priority:
             inv = " [INV]" if d.inverted else ""
             self.log(f"    P{d.priority}: {d.name} "
                      f"(~{d.estimated_power}W){inv}")
         self.log("=" * 65)
 
         self._sync_device_states()
-        self._publish_state()
+        self._restore_snapshot()
+        self._publish_state(force=True)
 
-        # v6: stato iniziale per pm_elapsed_time (evita "unknown")
-        self.set_state(
-            "sensor.pm_elapsed_time",
-            state="00:00",
-            attributes={
-                "friendly_name": "PM Tempo in zona",
-                "icon": "mdi:timer-outline",
-                "zone": "green",
-                "elapsed_seconds": 0,
-                "elapsed_minutes": 0.0,
-            }
-        )
+        # v6: stato iniziale per pm_elapsed_time (evita "unknown"),
+        # nello stesso formato timestamp degli aggiornamenti
+        if self.zone_entry_time is None:
+            self.zone_entry_time = datetime.now()
+        self._update_elapsed({})
 
         # v6: inizializza DND defaults se non impostati
         dnd_defaults = {
-            "input_datetime.pm_dnd1_start": "23:00:00",
-            "input_datetime.pm_dnd1_end": "08:00:00",
-            "input_datetime.pm_dnd2_start": "14:00:00",
-            "input_datetime.pm_dnd2_end": "16:00:00",
+            self._ns("input_datetime.pm_dnd1_start"): "23:00:00",
+            self._ns("input_datetime.pm_dnd1_end"): "08:00:00",
+            self._ns("input_datetime.pm_dnd2_start"): "14:00:00",
+            self._ns("input_datetime.pm_dnd2_end"): "16:00:00",
         }
         for entity_id, default_time in dnd_defaults.items():
             if self.entity_exists(entity_id):
@@ -230,39 +2988,183 @@ class PowerManager(hass.Hass):
                     )
                     self.log(f"  DND init: {entity_id} = {default_time}")
 
+    def terminate(self):
+        for app in self.sites or [self]:
+            app._save_snapshot_now()
+            if app.profile_store is not None:
+                app.profile_store.save(app._profile_data(), force=True)
+            app.actions.stop()
+            if app.journal is not None:
+                app.journal.stop()
+            if app.power_source is not None:
+                app.power_source.stop()
+        for sender in self.telegram_senders.values():
+            sender.stop()
+        for exporter in self.metrics_exporters.values():
+            exporter.stop()
+
     # =====================================================================
-    # SOGLIE DINAMICHE
+    # MULTI-SITO
     # =====================================================================
-
-    def _recalculate_thresholds(self):
-        if self.entity_exists("input_number.pm_contract_power"):
+    # Con `sites:` questa app e solo l'ospite: ogni sito e un PowerSite
+    # con stato, soglie, device e notifiche propri. Scheduler, cache
+    # stati, listener HA e sender Telegram restano unici e condivisi.
+
+    def _init_sites(self, sites):
+        self._shared_listeners = {}
+        self._shared_seq = itertools.count()
+        shared = {k: v for k, v in self.args.items()
+                  if k not in ("sites", "module", "class")}
+        for index, cfg in enumerate(sites, 1):
+            site_id = cfg.get("id") or self._slug(cfg.get("name", ""))
+            if not site_id:
+                site_id = f"site{index}"
+            if any(site.site_id == site_id for site in self.sites):
+                self.log(f"Sito duplicato ignorato: {site_id}",
+                         level="WARNING")
+                continue
+            site_args = dict(shared)
+            site_args.update(cfg)
+            self.sites.append(PowerSite(self, site_id, site_args))
+
+        self.log(f"POWER MANAGER multi-sito: {len(self.sites)} siti "
+                 f"({', '.join(site.site_id for site in self.sites)})")
+        for site in self.sites:
+            site.initialize()
+
+    @staticmethod
+    def _slug(text):
+        return "".join(
+            c if c.isalnum() else "_" for c in text.lower()).strip("_")
+
+    def _ns(self, entity_id):
+        """Entity del sito: pm_x -> pm_<sito>_x (invariata senza siti)."""
+        if not self.site_id:
+            return entity_id
+        domain, _, obj = entity_id.partition(".")
+        for prefix in ("power_manager_", "pm_"):
+            if obj.startswith(prefix):
+                return (f"{domain}.{prefix}{self.site_id}_"
+                        f"{obj[len(prefix):]}")
+        return entity_id
+
+    def _site_path(self, path):
+        """File per sito: x.json -> x_<sito>.json (invariato senza siti)."""
+        if not path or not self.site_id:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}_{self.site_id}{ext}"
+
+    def _listen_shared(self, callback, entity_id, **kwargs):
+        """Un solo listener HA per entity, smistato a tutti i siti."""
+        handlers = self._shared_listeners.get(entity_id)
+        if handlers is None:
+            handlers = self._shared_listeners[entity_id] = {}
+            self.listen_state(self._dispatch_shared, entity_id)
+        key = next(self._shared_seq)
+        handlers[key] = (callback, kwargs)
+        return (entity_id, key)
+
+    def _cancel_shared(self, handle):
+        # Il listener HA resta: tiene aggiornata la cache condivisa
+        entity_id, key = handle
+        self._shared_listeners.get(entity_id, {}).pop(key, None)
+
+    def _dispatch_shared(self, entity, attribute, old, new, kwargs):
+        self.state_cache.update(entity, new)
+        for callback, cb_kwargs in list(
+                self._shared_listeners[entity].values()):
             try:
-                self.contract_power = float(
-                    self.get_state("input_number.pm_contract_power")
-                )
-            except (ValueError, TypeError):
-                self.contract_power = self.args.get("contract_power", 4500)
-        else:
-            self.contract_power = self.args.get("contract_power", 4500)
+                callback(entity, attribute, old, new, cb_kwargs)
+            except Exception as e:
+                # Un sito in errore non deve bloccare gli altri
+                self.log(f"Errore callback {entity}: {e!r}", level="ERROR")
+
+    def _get_telegram_sender(self, token, chat_id):
+        """Un sender (thread + connessione) per coppia bot/chat."""
+        key = (token, chat_id)
+        sender = self.telegram_senders.get(key)
+        if sender is None:
+            sender = TelegramSender(
+                token,
+                chat_id,
+                api_url=self.args.get(
+                    "telegram_api_url", "https://api.telegram.org"),
+                max_queue=self.args.get("telegram_queue_size", 50),
+                coalesce_window=self.args.get("telegram_coalesce_window", 1.0),
+                max_retries=self.args.get("telegram_max_retries", 4),
+                log=self.log,
+            )
+            sender.start()
+            self.telegram_senders[key] = sender
+        return sender
+
+    def _get_metrics_exporter(self, host, port):
+        """Un endpoint per porta, condiviso dai siti (label `site`)."""
+        exporter = self.metrics_exporters.get((host, port))
+        if exporter is None:
+            exporter = MetricsExporter(port, host=host, log=self.log)
+            exporter.start()
+            self.metrics_exporters[(host, port)] = exporter
+            self.log(f"Metriche su http://{host}:{port}/metrics")
+        return exporter
 
-        self.available_power = self.contract_power * 1.10
-        self.red_threshold = self.contract_power * 1.33
-        self.green_threshold = self.available_power - self.hysteresis
-        self.shed_target = self.contract_power
+    # =====================================================================
+    # IMPOSTAZIONI DI RUNTIME
+    # =====================================================================
+    # Helper dashboard + apps.yaml compilati in self.settings (immutabile),
+    # ricompilato solo quando un helper cambia: nel percorso caldo le
+    # soglie e i parametri sono semplici letture di attributi.
+
+    def _compile_settings(self):
+        self.settings = RuntimeSettings.compile(
+            lambda helper: self._cached_state(self._ns(helper)),
+            self.args,
+            warn=lambda msg: self.log(msg, level="WARNING"),
+            previous=self.settings,
+        )
+        return self.settings
 
-    def _on_contract_power_change(self, entity, attribute, old, new, kwargs):
-        try:
-            float(new)
-        except (ValueError, TypeError):
+    def _on_settings_change(self, entity, attribute, old, new, kwargs):
+        self.state_cache.update(entity, new)
+        previous = self.settings
+        settings = self._compile_settings()
+        if settings == previous:
             return
-        self._recalculate_thresholds()
-        self.log(
-            f"Contratto: {self.contract_power:.0f}W -> "
-            f"gialla={self.available_power:.0f}W, "
-            f"rossa={self.red_threshold:.0f}W"
-        )
+        if settings.contract_power != previous.contract_power:
+            self.log(
+                f"Contratto: {self.contract_power:.0f}W -> "
+                f"gialla={self.available_power:.0f}W, "
+                f"rossa={self.red_threshold:.0f}W"
+            )
+        else:
+            self.log(f"Impostazioni aggiornate: {entity} = {new}")
         self._publish_state()
 
+    @property
+    def contract_power(self):
+        return self.settings.contract_power
+
+    @property
+    def hysteresis(self):
+        return self.settings.hysteresis
+
+    @property
+    def available_power(self):
+        return self.settings.available_power
+
+    @property
+    def red_threshold(self):
+        return self.settings.red_threshold
+
+    @property
+    def green_threshold(self):
+        return self.settings.green_threshold
+
+    @property
+    def shed_target(self):
+        return self.settings.shed_target
+
     def _calc_excess_percent(self, power=None):
         if power is None:
             power = self._get_grid_power()
@@ -271,38 +3173,55 @@ class PowerManager(hass.Hass):
         return ((power - self.contract_power) / self.contract_power) * 100
 
     # =====================================================================
-    # PARAMETRI DASHBOARD v6
+    # CACHE STATI HA
     # =====================================================================
+    # Tutte le entity lette nel percorso caldo sono sottoscritte con
+    # listen_state: on_power_change e _publish_state leggono solo dalla
+    # cache. I contatori hit/miss sono pubblicati in
+    # sensor.power_manager_zone (attributo state_cache).
+
+    def _load_entity_state(self, entity_id):
+        """Loader della cache: unica lettura remota per entity."""
+        if not entity_id or not self.entity_exists(entity_id):
+            return StateCache.MISSING
+        self.listen_state(self._on_cached_state_change, entity_id)
+        return self.get_state(entity_id)
+
+    def _on_cached_state_change(self, entity, attribute, old, new, kwargs):
+        self.state_cache.update(entity, new)
+
+    def _cached_state(self, entity_id):
+        return self.state_cache.get(entity_id)
+
+    def _cached_exists(self, entity_id):
+        return self.state_cache.exists(entity_id)
+
+    def _referenced_entities(self):
+        """Tutte le entity lette da zone/shed/restore/publish."""
+        entities = [
+            self.power_sensor,
+            self.luna_switch,
+            self.luna_power_slider,
+            self.luna_power_sensor,
+            self._ns("input_number.pm_contract_power"),
+            self._ns("input_number.pm_test_power"),
+            self._ns("input_number.pm_min_active_power"),
+            self._ns("input_number.pm_restore_interval"),
+            self._ns("input_number.pm_max_shed_time"),
+            self._ns("input_select.pm_altherma_restore_mode"),
+            self._ns("input_datetime.pm_dnd1_start"),
+            self._ns("input_datetime.pm_dnd1_end"),
+            self._ns("input_datetime.pm_dnd2_start"),
+            self._ns("input_datetime.pm_dnd2_end"),
+        ]
+        for d in list(self.devices) + self.non_controllable:
+            entities.append(d.entity_id)
+            entities.append(d.power_sensor)
+        return [e for e in entities if e]
 
-    def _get_min_active_power(self):
-        if self.entity_exists("input_number.pm_min_active_power"):
-            try:
-                return float(
-                    self.get_state("input_number.pm_min_active_power")
-                )
-            except (ValueError, TypeError):
-                pass
-        return 100.0
-
-    def _get_restore_interval(self):
-        if self.entity_exists("input_number.pm_restore_interval"):
-            try:
-                return float(
-                    self.get_state("input_number.pm_restore_interval")
-                )
-            except (ValueError, TypeError):
-                pass
-        return 180.0
-
-    def _get_max_shed_time(self):
-        if self.entity_exists("input_number.pm_max_shed_time"):
-            try:
-                return float(
-                    self.get_state("input_number.pm_max_shed_time")
-                ) * 60  # dashboard in minuti -> secondi
-            except (ValueError, TypeError):
-                pass
-        return 1800.0
+    def _prime_state_cache(self):
+        for entity_id in self._referenced_entities():
+            self.state_cache.prime(entity_id)
 
     # =====================================================================
     # DISPOSITIVI (configurazione in apps.yaml → sezione "devices")
@@ -372,12 +3291,23 @@ class PowerManager(hass.Hass):
     # =====================================================================
 
     def on_power_change(self, entity, attribute, old, new, kwargs):
+        # L'ordine dei callback non e garantito: aggiorna subito la cache
+        self.state_cache.update(entity, new)
+        if self.source_power is not None and not self.test_mode:
+            return  # comanda la sorgente diretta, HA resta di riserva
+        self.power_event_at = time.perf_counter()
         try:
             raw_value = float(new)
         except (ValueError, TypeError):
             return
+        self._process_power(max(raw_value, 0.0))
 
-        power = max(raw_value, 0.0)
+    def _process_power(self, power, publish=True):
+        """Un campione di rete nel loop di controllo (zone, shed, Luna)."""
+        band = self.meter.band
+        self.meter.update(
+            self._clock(), power, self.available_power, self.red_threshold)
+        self._snapshot_meter(band)
 
         if power <= self.green_threshold:
             if self.green_stable_since is None:
@@ -402,12 +3332,29 @@ class PowerManager(hass.Hass):
 
             self.current_zone = new_zone
             self.zone_entry_time = datetime.now()
+            self._record_decision(
+                "zone", value=round(pct),
+                detail=f"{old_zone.value}->{new_zone.value}", power=power)
             self._on_zone_change(old_zone, new_zone, power)
+            # Il contatore si salva ai cambi zona (e a terminate)
+            self._request_snapshot()
+        elif (new_zone == PowerZone.YELLOW
+              and self.meter.band != band):
+            # Il contatore ha cambiato fascia restando in gialla:
+            # i check seguono il consumo di tolleranza, non l'orologio
+            self._schedule_yellow_checks()
 
         if new_zone == PowerZone.RED and not self.shed_active:
             self._red_zone_shed(power)
 
-        self._publish_state()
+        if self.overload_predictor is not None:
+            self._check_prediction(power, new_zone)
+
+        if self.luna_controller is not None:
+            self._luna_control(power)
+
+        if publish or new_zone != old_zone:
+            self._publish_state()
 
     def _classify_zone(self, power):
         if self.current_zone == PowerZone.GREEN:
@@ -451,77 +3398,149 @@ class PowerManager(hass.Hass):
             self._stop_realtime_timer()
             self.current_check = None
             self.came_from_yellow = False
+            self._update_elapsed({})
             if self.shed_active:
                 self._schedule_restore()
 
+    # =====================================================================
+    # PREVISIONE SOVRACCARICO
+    # =====================================================================
+
+    def _check_prediction(self, power, zone):
+        predictor = self.overload_predictor
+        projected = predictor.observe(
+            self._clock(), power, self.red_threshold,
+            zone == PowerZone.RED)
+        if projected is None:
+            return
+        slope = predictor.trend.slope()
+        self.log(f"PREVISIONE: rosso tra {predictor.horizon:.0f}s "
+                 f"(rete {power:.0f}W, +{slope:.0f}W/s, "
+                 f"attesi {projected:.0f}W)")
+        if self.predict_preemptive_shed:
+            self._preemptive_shed(power, projected)
+
+    def _preemptive_shed(self, power, projected):
+        """
+        Shed anticipato: riduce l'eccesso previsto prima del rosso. E
+        solo una previsione: valgono le regole della gialla, i device con
+        shed_in_yellow: false (es. needs_manual_restart) restano accesi.
+        """
+        self._cancel_restore()
+        excess = projected - self.shed_target
+        self.actions.begin()
+        try:
+            shed_names = self._smart_shed(excess, include_all=False)
+        finally:
+            self.actions.flush()
+        if not shed_names:
+            return
+        self.overload_predictor.mark_preempted()
+        self.log(f"  Shed preventivo: {', '.join(shed_names)}")
+        self._notify_telegram(
+            f"*Power Manager:* 📈 Shed preventivo\n"
+            f"Rete {power:.0f}W in salita, attesi {projected:.0f}W "
+            f"tra {self.overload_predictor.horizon:.0f}s.\n"
+            f"Spenti: {', '.join(shed_names)}",
+            "shed",
+        )
+        # In verde nessun cambio zona pianifichera il restore
+        if self.current_zone == PowerZone.GREEN:
+            self._schedule_restore()
+
     # =====================================================================
     # HA TIMER
     # =====================================================================
 
     def _start_ha_timer_yellow(self):
-        try:
-            self.call_service(
-                "timer/start",
-                entity_id="timer.pm_distacco_countdown",
-                duration="03:02:00"
-            )
-        except Exception as e:
-            self.log(f"Timer start: {e}", level="WARNING")
+        self._start_ha_countdown(self._meter_remaining())
 
     def _start_ha_timer_red(self):
-        if self.came_from_yellow:
-            duration = "00:04:00"
-            self.log("GIALLA->ROSSA: 4 minuti al distacco!")
-        else:
-            duration = "00:02:00"
-            self.log("Ingresso diretto ROSSA: 2 minuti al distacco!")
+        remaining = self._meter_remaining()
+        self.log(f"ROSSA: {self._format_remaining(remaining)} al distacco "
+                 f"(tolleranza rossa usata {self.meter.red_used:.0f}s)")
+        self._start_ha_countdown(remaining)
+
+    def _start_ha_countdown(self, seconds):
+        if seconds is None:
+            return
+        seconds = int(seconds)
+        duration = (f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:"
+                    f"{seconds % 60:02d}")
         try:
             self.call_service(
                 "timer/start",
-                entity_id="timer.pm_distacco_countdown",
+                entity_id=self._ns("timer.pm_distacco_countdown"),
                 duration=duration
             )
         except Exception as e:
             self.log(f"Timer start: {e}", level="WARNING")
 
+    def _meter_remaining(self):
+        """Secondi al distacco secondo la tolleranza del contatore."""
+        self.meter.advance(self._clock())
+        return self.meter.remaining()
+
+    @staticmethod
+    def _format_remaining(seconds):
+        if seconds is None:
+            return "nessun limite"
+        if seconds < 120:
+            return f"{seconds:.0f} secondi"
+        return f"{seconds / 60:.0f} minuti"
+
     def _stop_ha_timer(self):
         try:
             self.call_service(
                 "timer/cancel",
-                entity_id="timer.pm_distacco_countdown"
+                entity_id=self._ns("timer.pm_distacco_countdown")
             )
         except Exception:
             pass
 
     def _start_realtime_timer(self):
-        self._stop_realtime_timer()
-        self.realtime_timer = self.run_every(
-            self._update_elapsed, "now", 10
-        )
+        self._update_elapsed({})
 
     def _stop_realtime_timer(self):
-        if self.realtime_timer is not None:
-            try:
-                self.cancel_timer(self.realtime_timer)
-            except Exception:
-                pass
-            self.realtime_timer = None
+        self._cancel("realtime")
+
+    def _elapsed_refresh_delay(self):
+        """Piu vicino al distacco, piu frequente l'aggiornamento."""
+        remaining = self._meter_remaining()
+        if remaining is None:
+            return self.elapsed_refresh_max
+        return min(max(remaining / 10, self.elapsed_refresh_min),
+                   self.elapsed_refresh_max)
 
     def _update_elapsed(self, kwargs):
+        """
+        sensor.pm_elapsed_time: lo stato e l'istante di ingresso in zona
+        (device_class timestamp), il tempo trascorso lo calcola la
+        dashboard. Gli attributi elapsed_* valgono al momento della
+        scrittura.
+        """
         if self.zone_entry_time is None:
             return
         elapsed = (datetime.now() - self.zone_entry_time).total_seconds()
         minutes = int(elapsed // 60)
         seconds = int(elapsed % 60)
+        refresh = None
+        if self.elapsed_refresh and self.current_zone != PowerZone.GREEN:
+            refresh = round(self._elapsed_refresh_delay())
+            self._schedule("realtime", self._update_elapsed, refresh)
         self.set_state(
-            "sensor.pm_elapsed_time",
-            state=f"{minutes:02d}:{seconds:02d}",
+            self._ns("sensor.pm_elapsed_time"),
+            state=self.zone_entry_time.astimezone().isoformat(
+                timespec="seconds"),
             attributes={
                 "friendly_name": "PM Tempo in zona",
                 "icon": "mdi:timer-outline",
+                "device_class": "timestamp",
                 "zone": self.current_zone.value,
+                "elapsed": f"{minutes:02d}:{seconds:02d}",
                 "elapsed_seconds": int(elapsed),
                 "elapsed_minutes": round(elapsed / 60, 1),
+                "next_refresh_s": refresh,
             }
         )
 
@@ -530,13 +3549,16 @@ class PowerManager(hass.Hass):
     # =====================================================================
 
     def _get_grid_power(self):
-        if self.test_mode and self.entity_exists("input_number.pm_test_power"):
+        test_power = self._ns("input_number.pm_test_power")
+        if self.test_mode and self._cached_exists(test_power):
             try:
-                return float(self.get_state("input_number.pm_test_power"))
+                return float(self._cached_state(test_power))
             except (ValueError, TypeError):
                 pass
+        if self.source_power is not None:
+            return self.source_power
         try:
-            raw = float(self.get_state(self.power_sensor))
+            raw = float(self._cached_state(self.power_sensor))
         except (ValueError, TypeError):
             self.log("Sensore rete non leggibile!", level="WARNING")
             return 0.0
@@ -545,13 +3567,15 @@ class PowerManager(hass.Hass):
     def _get_device_power(self, device):
         if device.power_sensor:
             try:
-                raw = float(self.get_state(device.power_sensor))
+                raw = float(self._cached_state(device.power_sensor))
                 if raw < 0:
                     return 0.0
                 return raw  # include 0.0 — NON cadere nel fallback!
             except (ValueError, TypeError):
                 pass
         if device.controllable and self._is_device_on(device):
+            if device.profile.trained(self.profile_min_cycles):
+                return device.profile.mean
             return device.estimated_power
         return 0.0
 
@@ -563,6 +3587,73 @@ class PowerManager(hass.Hass):
                 result[d.name] = pw
         return result
 
+    # =====================================================================
+    # SORGENTE DIRETTA
+    # =====================================================================
+    # Con `power_source` la potenza arriva da Modbus-TCP, MQTT o socket
+    # UNIX senza passare da HA: il thread della sorgente raccoglie i
+    # campioni, un giro ogni `interval` secondi li decima e li porta nel
+    # loop di controllo. Il sensore zona viene ripubblicato al piu ogni
+    # `publish_interval` secondi (subito ai cambi di zona). Se la
+    # sorgente tace per `timeout` secondi comanda di nuovo power_sensor.
+
+    def _setup_power_source(self):
+        cfg = self.args.get("power_source") or {}
+        if isinstance(cfg, str):
+            cfg = {"type": cfg}
+        kind = cfg.get("type", "ha")
+        if kind == "ha":
+            return
+        options = {k: v for k, v in cfg.items() if k not in (
+            "type", "interval", "decimation", "timeout",
+            "publish_interval")}
+        try:
+            decimator = SampleDecimator(cfg.get("decimation", "mean"))
+            self.power_source = PowerSource.create(
+                kind, decimator, options, log=self.log)
+        except (ValueError, TypeError, RuntimeError) as e:
+            self.log(f"Sorgente potenza {kind} non valida: {e}; "
+                     f"uso {self.power_sensor}", level="ERROR")
+            return
+        self.source_interval = max(float(cfg.get("interval", 1)), 0.1)
+        self.source_timeout = float(cfg.get("timeout", 10))
+        self.source_publish_interval = float(cfg.get("publish_interval", 5))
+        self.source_published_at = None
+        self.power_source.start()
+        self._schedule("power_source", self._on_power_source_tick,
+                       self.source_interval, interval=self.source_interval)
+        self.log(f"Sorgente potenza: {self.power_source.describe()} "
+                 f"(giro {self.source_interval}s, decimazione "
+                 f"{decimator.mode}), riserva {self.power_sensor}")
+
+    def _on_power_source_tick(self, kwargs):
+        source = self.power_source
+        value, _ = source.decimator.drain()
+        if value is None:
+            age = source.decimator.age()
+            if self.source_power is not None and (
+                    age is None or age > self.source_timeout):
+                self.source_power = None
+                self.log(f"Sorgente {source.describe()} muta da "
+                         f"{age:.0f}s: torno a {self.power_sensor}",
+                         level="WARNING")
+                if not self.test_mode:
+                    self._process_power(self._get_grid_power())
+            return
+        if self.source_power is None:
+            self.log(f"Sorgente {source.describe()} attiva")
+        self.source_power = max(value, 0.0)
+        if self.test_mode:
+            return  # comanda input_number.pm_test_power
+        self.power_event_at = time.perf_counter()
+        now = self._clock()
+        publish = (self.source_published_at is None
+                   or now - self.source_published_at
+                   >= self.source_publish_interval)
+        if publish:
+            self.source_published_at = now
+        self._process_power(self.source_power, publish=publish)
+
     # =====================================================================
     # OPERAZIONI DISPOSITIVI
     # =====================================================================
@@ -570,7 +3661,7 @@ class PowerManager(hass.Hass):
     def _is_device_on(self, device):
         if not device.entity_id:
             return False
-        state = self.get_state(device.entity_id)
+        state = self._cached_state(device.entity_id)
         if state is None:
             return False
         s = state.lower()
@@ -584,9 +3675,18 @@ class PowerManager(hass.Hass):
             return
         # v6: salva consumo reale
         device.last_known_power = self._get_device_power(device)
-        device.pre_shed_state = self.get_state(device.entity_id)
+        device.profile.abort()
+        if device.history.shed(
+                self._clock(), self.restore_fail_window,
+                self.settings.restore_interval, self.restore_backoff_max):
+            self._on_restore_failed(device)
+        device.pre_shed_state = self._cached_state(device.entity_id)
         device.shed_time = datetime.now()
         device.state = DeviceState.SHED
+        self._request_snapshot()
+        self._record_decision(
+            "shed", device.name, round(device.last_known_power),
+            "dry_run" if self.dry_run else None)
 
         # v6: avvia timer timeout massimo
         self._start_max_shed_timer(device)
@@ -597,21 +3697,26 @@ class PowerManager(hass.Hass):
             return
 
         if device.inverted:
-            self.call_service(
+            self.actions.add(
                 f"{device.domain}/turn_on", entity_id=device.entity_id
             )
         elif device.turn_off_service:
             svc = device.turn_off_service["service"]
             data = device.turn_off_service.get("data", {})
-            self.call_service(svc, **data)
+            self.actions.add(svc, **data)
         else:
-            self.call_service(
+            self.actions.add(
                 f"{device.domain}/turn_off", entity_id=device.entity_id
             )
         self.log(f"  SPENTO: {device.name} ({device.last_known_power:.0f}W)")
 
     def _restore_device(self, device):
         self._cancel_max_shed_timer(device)
+        device.history.restored(self._clock(), datetime.now().hour)
+        self._request_snapshot()
+        self._record_decision(
+            "restore", device.name, round(device.last_known_power),
+            "dry_run" if self.dry_run else None)
 
         if self.dry_run:
             self.log(f"  DRY RUN: riaccenderei {device.name}")
@@ -620,12 +3725,12 @@ class PowerManager(hass.Hass):
             return
 
         if device.inverted:
-            self.call_service(
+            self.actions.add(
                 f"{device.domain}/turn_off", entity_id=device.entity_id
             )
         elif device.domain == "climate":
-            mode = self._get_climate_restore_mode()
-            self.call_service(
+            mode = self.settings.climate_restore_mode(datetime.now().month)
+            self.actions.add(
                 "climate/set_hvac_mode",
                 entity_id=device.entity_id,
                 hvac_mode=mode,
@@ -633,25 +3738,15 @@ class PowerManager(hass.Hass):
         elif device.turn_on_service:
             svc = device.turn_on_service["service"]
             data = device.turn_on_service.get("data", {})
-            self.call_service(svc, **data)
+            self.actions.add(svc, **data)
         else:
-            self.call_service(
+            self.actions.add(
                 f"{device.domain}/turn_on", entity_id=device.entity_id
             )
         device.state = DeviceState.ON_BY_USER
         device.shed_time = None
         self.log(f"  RIACCESO: {device.name}")
 
-    def _get_climate_restore_mode(self):
-        """Legge il modo di ripristino per dispositivi climate."""
-        helper = "input_select.pm_altherma_restore_mode"
-        if self.entity_exists(helper):
-            mode = self.get_state(helper)
-            if mode and mode not in ("unknown", "unavailable"):
-                return mode
-        month = datetime.now().month
-        return "heat" if month in (11, 12, 1, 2, 3, 4) else "cool"
-
     def _sync_device_states(self):
         for d in self.devices:
             if self._is_device_on(d):
@@ -663,64 +3758,51 @@ class PowerManager(hass.Hass):
     # v6: TIMEOUT MASSIMO SHED
     # =====================================================================
 
-    def _start_max_shed_timer(self, device):
-        max_time = self._get_max_shed_time()
-        timer_handle = self.run_in(
-            self._on_max_shed_timeout, max_time,
+    def _start_max_shed_timer(self, device, max_time=None):
+        if max_time is None:
+            max_time = self.settings.max_shed_time
+        self._schedule(
+            f"max_shed:{device.name}", self._on_max_shed_timeout, max_time,
             device_name=device.name
         )
-        self.max_shed_timers[device.name] = timer_handle
         self.log(f"  Timeout shed {device.name}: {max_time / 60:.0f} min")
 
     def _cancel_max_shed_timer(self, device):
-        timer = self.max_shed_timers.pop(device.name, None)
-        if timer is not None:
-            try:
-                self.cancel_timer(timer)
-            except Exception:
-                pass
+        self._cancel(f"max_shed:{device.name}")
 
     def _cancel_all_max_shed_timers(self):
-        for name, timer in list(self.max_shed_timers.items()):
-            try:
-                self.cancel_timer(timer)
-            except Exception:
-                pass
-        self.max_shed_timers.clear()
+        self.deadlines.cancel_prefix("max_shed:")
 
     def _on_max_shed_timeout(self, kwargs):
-        device_name = kwargs.get("device_name")
-        device = None
-        for d in self.devices:
-            if d.name == device_name:
-                device = d
-                break
+        device = self.devices.get(kwargs.get("device_name"))
         if device is None or device.state != DeviceState.SHED:
             return
 
-        max_min = self._get_max_shed_time() / 60
+        max_min = self.settings.max_shed_time / 60
         self.log(f"TIMEOUT {max_min:.0f} min per {device.name}! "
                  f"Riaccensione forzata.")
+        self._record_decision(
+            "timeout", device.name, round(max_min), "max_shed")
 
         self._restore_device(device)
-        self.max_shed_timers.pop(device.name, None)
 
         self._notify_telegram(
             f"*Power Manager:* ⏰ Timeout {max_min:.0f} min raggiunto!\n"
             f"Riacceso forzatamente: *{device.name}*\n"
-            f"Controlla la situazione."
+            f"Controlla la situazione.",
+            "timeout",
         )
         self._notify_alexa(
             f"Attenzione, {device.name} era spento da "
             f"{max_min:.0f} minuti. L'ho riacceso. "
-            f"Controlla la situazione."
+            f"Controlla la situazione.",
+            "timeout",
         )
 
-        remaining_shed = [d for d in self.devices
-                          if d.state == DeviceState.SHED]
-        if not remaining_shed:
+        if not self.devices.count(DeviceState.SHED):
             self.shed_active = False
             self.restore_in_progress = False
+            self.restore_started_at = None
         self._publish_state()
 
     # =====================================================================
@@ -737,10 +3819,9 @@ class PowerManager(hass.Hass):
 
     def _luna_is_charging(self):
         """Verifica se la carica forzata Luna2000 è attiva."""
-        if not self.entity_exists(self.luna_switch):
+        if not self._cached_exists(self.luna_switch):
             return False
-        return self.get_state(
-            self.luna_switch) == "on"
+        return self._cached_state(self.luna_switch) == "on"
 
     def _luna_get_power(self):
         """
@@ -748,10 +3829,10 @@ class PowerManager(hass.Hass):
         Usa sensor.battery_power_dashboard: negativo = sta caricando.
         Ritorna il valore assoluto (positivo) se sta caricando, 0 altrimenti.
         """
-        if not self.entity_exists(self.luna_power_sensor):
+        if not self._cached_exists(self.luna_power_sensor):
             return 0.0
         try:
-            raw = float(self.get_state(self.luna_power_sensor))
+            raw = float(self._cached_state(self.luna_power_sensor))
             if raw < 0:
                 return abs(raw)  # caricando: -1616 → 1616
             return 0.0  # scaricando o fermo: non conta
@@ -763,10 +3844,10 @@ class PowerManager(hass.Hass):
         Legge la potenza di carica CONFIGURATA dallo slider (W).
         Usata per save/restore del valore impostato dall'utente.
         """
-        if not self.entity_exists(self.luna_power_slider):
+        if not self._cached_exists(self.luna_power_slider):
             return 0.0
         try:
-            return float(self.get_state(self.luna_power_slider))
+            return float(self._cached_state(self.luna_power_slider))
         except (ValueError, TypeError):
             return 0.0
 
@@ -817,7 +3898,7 @@ class PowerManager(hass.Hass):
                     f"*Power Manager:* 🔋 Luna2000 carica ridotta\n"
                     f"Reale: {actual_power:.0f}W → "
                     f"slider: {configured:.0f}W → {new_power:.0f}W\n"
-                    f"Liberati ~{reduced:.0f}W")
+                    f"Liberati ~{reduced:.0f}W", "luna")
             else:
                 # Riduzione a 0 = ferma
                 self._luna_stop_charging()
@@ -826,7 +3907,7 @@ class PowerManager(hass.Hass):
                          f"(reale {actual_power:.0f}W → OFF)")
                 self._notify_telegram(
                     f"*Power Manager:* 🔋 Luna2000 carica fermata\n"
-                    f"Assorbiva {actual_power:.0f}W")
+                    f"Assorbiva {actual_power:.0f}W", "luna")
             return reduced
         else:
             # Non basta ridurre, ferma tutto
@@ -837,11 +3918,14 @@ class PowerManager(hass.Hass):
             self._notify_telegram(
                 f"*Power Manager:* 🔋 Luna2000 carica fermata\n"
                 f"Assorbiva {actual_power:.0f}W, "
-                f"servono ancora {excess_watts - actual_power:.0f}W")
+                f"servono ancora {excess_watts - actual_power:.0f}W", "luna")
             return actual_power
 
-    def _luna_set_power(self, watts):
+    def _luna_set_power(self, watts, sync=True):
         """Imposta la potenza di carica Luna2000."""
+        if sync and self.luna_controller is not None:
+            self.luna_controller.reset(self._clock(), watts)
+        self._record_decision("luna", value=round(watts), detail="set")
         if self.dry_run:
             self.log(f"  DRY RUN: imposterei Luna2000 a {watts:.0f}W")
             return
@@ -854,8 +3938,11 @@ class PowerManager(hass.Hass):
         except Exception as e:
             self.log(f"Luna2000 set_power: {e}", level="WARNING")
 
-    def _luna_stop_charging(self):
+    def _luna_stop_charging(self, sync=True):
         """Ferma la carica forzata Luna2000."""
+        if sync and self.luna_controller is not None:
+            self.luna_controller.reset(self._clock(), 0)
+        self._record_decision("luna", value=0, detail="stop")
         if self.dry_run:
             self.log("  DRY RUN: fermerei carica Luna2000")
             return
@@ -867,6 +3954,20 @@ class PowerManager(hass.Hass):
         except Exception as e:
             self.log(f"Luna2000 stop: {e}", level="WARNING")
 
+    def _luna_start_charging(self):
+        """Riattiva la carica forzata Luna2000."""
+        self._record_decision("luna", detail="start")
+        if self.dry_run:
+            self.log("  DRY RUN: riattiverei carica Luna2000")
+            return
+        try:
+            self.call_service(
+                "input_boolean/turn_on",
+                entity_id=self.luna_switch
+            )
+        except Exception as e:
+            self.log(f"Luna2000 start: {e}", level="WARNING")
+
     def _luna_restore(self):
         """
         Ripristina la carica Luna2000 alla fine del restore.
@@ -883,6 +3984,8 @@ class PowerManager(hass.Hass):
         """
         if not self.luna_reduced or not self.luna_was_charging:
             return
+        if self.luna_controller is not None:
+            return  # la carica risale gradualmente con _luna_control
 
         current_power = self._get_grid_power()
         margin = self.green_threshold - current_power
@@ -905,7 +4008,7 @@ class PowerManager(hass.Hass):
             self._notify_telegram(
                 f"*Power Manager:* 🔋 Luna2000 carica NON ripristinata\n"
                 f"Margine disponibile: {margin:.0f}W (troppo poco)\n"
-                f"Riattiva manualmente quando possibile.")
+                f"Riattiva manualmente quando possibile.", "luna")
             self.luna_reduced = False
             self.luna_was_charging = False
             self.luna_pre_shed_power = 0.0
@@ -937,13 +4040,13 @@ class PowerManager(hass.Hass):
                     f"*Power Manager:* 🔋 Luna2000 carica ripristinata\n"
                     f"Potenza: {restore_power:.0f}W "
                     f"(era {self.luna_pre_shed_power:.0f}W)\n"
-                    f"Ridotta per margine disponibile: {margin:.0f}W")
+                    f"Ridotta per margine disponibile: {margin:.0f}W", "luna")
             else:
                 self.log(f"  LUNA2000: carica ripristinata a "
                          f"{restore_power:.0f}W (originale)")
                 self._notify_telegram(
                     f"*Power Manager:* 🔋 Luna2000 carica ripristinata\n"
-                    f"Potenza: {restore_power:.0f}W")
+                    f"Potenza: {restore_power:.0f}W", "luna")
         except Exception as e:
             self.log(f"Luna2000 restore: {e}", level="WARNING")
 
@@ -951,6 +4054,77 @@ class PowerManager(hass.Hass):
         self.luna_was_charging = False
         self.luna_pre_shed_power = 0.0
 
+    def _luna_control(self, power):
+        """
+        Regolazione continua della carica (luna_controller). Parte
+        quando la rete supera il 110% con la carica attiva; da li il
+        PI insegue il target (luna_target_margin sotto il 110%), modula
+        lo slider e, col ritorno del margine, riporta la
+        carica al valore impostato dall'utente (luna_pre_shed_power),
+        poi si ferma. Finche ci sono device spenti la carica non sale:
+        il restore dei device ha la precedenza.
+        """
+        ctrl = self.luna_controller
+        now = self._clock()
+        if (self.luna_control_last is not None
+                and now - self.luna_control_last < self.luna_control_interval):
+            return
+        target = self.available_power - self.luna_target_margin
+
+        if not self.luna_reduced:
+            if (power < self.available_power
+                    or not self._luna_is_charging()):
+                return
+            configured = self._luna_get_configured_power()
+            actual = self._luna_get_power()
+            if configured <= 0 or actual <= 0:
+                return
+            self.luna_was_charging = True
+            self.luna_pre_shed_power = configured
+            self.luna_reduced = True
+            # Un intervallo "indietro": la prima correzione e immediata
+            ctrl.reset(now - self.luna_control_interval,
+                       min(actual, configured), written=configured)
+            self.log(f"  LUNA2000: regolazione attiva "
+                     f"(rete {power:.0f}W, target {target:.0f}W, "
+                     f"carica {configured:.0f}W)")
+            self._request_snapshot()
+        elif ctrl.written is None:
+            # Dopo un riavvio: riparte dallo stato attuale
+            current = (self._luna_get_configured_power()
+                       if self._luna_is_charging() else 0.0)
+            ctrl.reset(now, current)
+
+        self.luna_control_last = now
+        ceiling = self.luna_pre_shed_power
+        watts = ctrl.update(
+            now, power, target, ceiling,
+            allow_increase=not self.devices.count(DeviceState.SHED))
+        if watts >= ceiling and power < target:
+            ctrl.changed(ceiling)
+            self._luna_apply(ceiling)
+            self.log(f"  LUNA2000: carica tornata a {ceiling:.0f}W, "
+                     f"regolazione terminata")
+            self._notify_telegram(
+                f"*Power Manager:* 🔋 Luna2000 carica ripristinata\n"
+                f"Potenza: {ceiling:.0f}W", "luna")
+            self.luna_reduced = False
+            self.luna_was_charging = False
+            self.luna_pre_shed_power = 0.0
+            self._request_snapshot()
+        elif ctrl.changed(watts):
+            self._luna_apply(watts)
+
+    def _luna_apply(self, watts):
+        """Porta la carica a `watts` (0 = ferma) senza toccare il PI."""
+        if watts <= 0:
+            if self._luna_is_charging():
+                self._luna_stop_charging(sync=False)
+            return
+        self._luna_set_power(watts, sync=False)
+        if not self._luna_is_charging():
+            self._luna_start_charging()
+
     # =====================================================================
     # SMART SHED v6
     # =====================================================================
@@ -963,6 +4137,7 @@ class PowerManager(hass.Hass):
         # Prima di toccare qualsiasi device, ridurre/fermare
         # la carica batteria se attiva
         luna_reduced = self._luna_try_reduce(excess_watts)
+        self.shed_luna_watts = luna_reduced
         excess_watts -= luna_reduced
         if excess_watts <= 0:
             self.shed_active = True
@@ -976,10 +4151,10 @@ class PowerManager(hass.Hass):
         luna_name = (f"Luna2000 (-{luna_reduced:.0f}W)"
                      if luna_reduced > 0 else None)
 
-        min_active = self._get_min_active_power()
+        min_active = self.settings.min_active_power
         candidates = []
 
-        for d in sorted(self.devices, key=lambda x: x.priority):
+        for d in self.devices.by_priority:
             if not d.enabled or d.state == DeviceState.SHED:
                 continue
             if not include_all and not d.shed_in_yellow:
@@ -1002,10 +4177,15 @@ class PowerManager(hass.Hass):
                 f"*Power Manager:* ⚠️ Nessun dispositivo attivo "
                 f"sopra {min_active:.0f}W da spegnere!\n"
                 f"Eccesso residuo: {excess_watts:.0f}W - "
-                f"Intervento manuale necessario."
+                f"Intervento manuale necessario.",
+                "shed", critical=True,
             )
             return [luna_name] if luna_name else []
 
+        if self.shed_strategy == "optimal":
+            return self._optimal_shed(
+                candidates, excess_watts, include_all, luna_name)
+
         # Un solo device basta?
         for d, pw in candidates:
             if pw >= excess_watts:
@@ -1043,6 +4223,31 @@ class PowerManager(hass.Hass):
         )
         return shed_names
 
+    def _optimal_shed(self, candidates, excess_watts, include_all, luna_name):
+        """Strategia "optimal": vedi solve_shed_set."""
+        if include_all:
+            candidates = [(d, pw) for d, pw in candidates if d.shed_in_red]
+        chosen = solve_shed_set(
+            candidates, excess_watts,
+            priority_weight=self.shed_priority_weight)
+
+        shed_names = [luna_name] if luna_name else []
+        reduced = 0.0
+        for d, pw in chosen:
+            self._shed_device(d)
+            reduced += pw
+            shed_names.append(d.name)
+        if chosen:
+            self.shed_active = True
+            self.shed_cycle_count += 1
+        self.log(
+            f"  Ottimo: spenti {len(chosen)}: "
+            f"ridotti ~{reduced:.0f}W (eccesso: {excess_watts:.0f}W, "
+            f"sovra-riduzione {max(reduced - excess_watts, 0):.0f}W) "
+            f"[ciclo #{self.shed_cycle_count}]"
+        )
+        return shed_names
+
     def _force_shed_all(self, shed_names):
         # Ferma Luna2000 se ancora attiva
         if self._luna_is_charging():
@@ -1058,8 +4263,8 @@ class PowerManager(hass.Hass):
                 self.log(f"  FORCE: Luna2000 fermata "
                          f"(reale {luna_pw:.0f}W)")
 
-        min_active = self._get_min_active_power()
-        for d in sorted(self.devices, key=lambda x: x.priority):
+        min_active = self.settings.min_active_power
+        for d in self.devices.by_priority:
             if d.enabled and d.state != DeviceState.SHED:
                 if self._is_device_on(d):
                     pw = self._get_device_power(d)
@@ -1082,21 +4287,55 @@ class PowerManager(hass.Hass):
         self.current_check = "1"
         self.log(f"1 CHECK - Rete: {power:.0f}W, supero: {pct:.0f}%. "
                  f"Nessun intervento.")
-
-        self.yellow_check2_timer = self.run_in(
-            self._yellow_check2_callback, 180)
-        self.yellow_check3_timer = self.run_in(
-            self._yellow_check3_callback, 3600)
-        self.yellow_check4_timer = self.run_in(
-            self._yellow_check4_callback, 9000)
+        self._schedule_yellow_checks()
         self._publish_state()
 
+    def _schedule_yellow_checks(self):
+        """
+        Pianifica i check 2-4 sul tempo gia accumulato dal contatore:
+        dopo rientri brevi si riparte dal consumo residuo, e se una
+        soglia e gia superata parte subito solo il check piu avanzato.
+        Richiamata a ogni cambio di fascia in gialla: sotto il 110% il
+        contatore non consuma tolleranza, quindi i check restano sospesi
+        finche la rete non torna in fascia. I check gia eseguiti in
+        questa permanenza in gialla non si ripetono.
+        """
+        self.meter.advance(self._clock())
+        checks = (
+            ("2", "yellow_check2", self._yellow_check2_callback),
+            ("3", "yellow_check3", self._yellow_check3_callback),
+            ("4", "yellow_check4", self._yellow_check4_callback),
+        )
+        for _, name, _ in checks:
+            self._cancel(name)
+        if self.meter.band == MeterBudget.NONE:
+            return
+        used = self.meter.yellow_used
+        done = self.current_check
+        if done not in ("2", "3", "4"):
+            done = "1"
+        passed = None
+        for (number, name, callback), mark in zip(
+                checks, self.yellow_check_marks):
+            if number <= done:
+                continue
+            if mark <= used:
+                passed = (name, callback, mark)
+                continue
+            self._schedule(name, callback, mark - used)
+        if passed is not None:
+            name, callback, mark = passed
+            self.log(f"  Tolleranza gialla gia usata {used:.0f}s "
+                     f"(>= {mark}s): check anticipato.")
+            self._schedule(name, callback, 1)
+
     def _yellow_check2_callback(self, kwargs):
         if self.current_zone != PowerZone.YELLOW:
             return
         power = self._get_grid_power()
         pct = self._calc_excess_percent(power)
         self.current_check = "2"
+        self._request_snapshot()
         self.log(f"2 CHECK - Rete: {power:.0f}W, supero: {pct:.0f}%. "
                  f"Nessun intervento.")
         self._publish_state()
@@ -1107,6 +4346,7 @@ class PowerManager(hass.Hass):
         power = self._get_grid_power()
         pct = self._calc_excess_percent(power)
         self.current_check = "3"
+        self._request_snapshot()
         self.log(f"3 CHECK - Rete: {power:.0f}W, supero: {pct:.0f}%")
 
         if power <= self.shed_target:
@@ -1115,17 +4355,23 @@ class PowerManager(hass.Hass):
             return
 
         excess = power - self.shed_target
-        shed_names = self._smart_shed(excess, include_all=False)
+        self.actions.begin()
+        try:
+            shed_names = self._smart_shed(excess, include_all=False)
+        finally:
+            self.actions.flush()
         nc_active = self._get_non_controllable_power()
 
         if shed_names:
             lista = ", ".join(shed_names)
+            remaining = self._format_remaining(self._meter_remaining())
             self._notify_alexa(
-                f"Attenzione, supero potenza del {pct:.0f} percento "
-                f"da un'ora. Ho spento: {lista}."
+                f"Attenzione, supero potenza del {pct:.0f} percento, "
+                f"distacco tra {remaining}. Ho spento: {lista}."
                 + (f" Valuta di spegnere anche "
                    f"{', '.join(nc_active.keys())}!"
-                   if nc_active else "")
+                   if nc_active else ""),
+                "yellow",
             )
         self._send_check_telegram(
             "3", "Rischio distacco", pct, power, shed_names, nc_active)
@@ -1135,37 +4381,39 @@ class PowerManager(hass.Hass):
 
     def _yellow_recheck_callback(self, kwargs):
         if self.current_zone != PowerZone.YELLOW:
-            self.yellow_recheck_timer = None
             return
 
         power = self._get_grid_power()
         excess = power - self.shed_target
         if excess <= 0:
             self.log("  Recheck: rientrato!")
-            self.yellow_recheck_timer = None
             return
 
         pct = self._calc_excess_percent(power)
         self.log(f"  Recheck: eccesso {excess:.0f}W")
 
-        shed_names = self._smart_shed(excess, include_all=False)
+        self.actions.begin()
+        try:
+            shed_names = self._smart_shed(excess, include_all=False)
+        finally:
+            self.actions.flush()
         if shed_names:
             lista = ", ".join(shed_names)
             self._notify_alexa(
-                f"Ancora in supero potenza. Ho spento anche: {lista}.")
+                f"Ancora in supero potenza. Ho spento anche: {lista}.",
+                "yellow")
             self._notify_telegram(
                 f"*Power Manager:* 🟡 Recheck Zona Gialla\n"
-                f"Supero: {pct:.0f}% - Ho spento: {lista}")
+                f"Supero: {pct:.0f}% - Ho spento: {lista}", "yellow")
         self._schedule_yellow_recheck()
 
     def _schedule_yellow_recheck(self):
-        if self.yellow_recheck_timer is not None:
-            try:
-                self.cancel_timer(self.yellow_recheck_timer)
-            except Exception:
-                pass
-        self.yellow_recheck_timer = self.run_in(
-            self._yellow_recheck_callback, 300)
+        # Con poca tolleranza residua si ricontrolla piu spesso
+        remaining = self._meter_remaining()
+        delay = 300
+        if remaining is not None:
+            delay = min(300, max(remaining / 4, 30))
+        self._schedule("yellow_recheck", self._yellow_recheck_callback, delay)
 
     def _yellow_check4_callback(self, kwargs):
         if self.current_zone != PowerZone.YELLOW:
@@ -1173,6 +4421,7 @@ class PowerManager(hass.Hass):
         power = self._get_grid_power()
         pct = self._calc_excess_percent(power)
         self.current_check = "4"
+        self._request_snapshot()
 
         if power <= self.shed_target:
             self.log("  4 check: gia sotto target.")
@@ -1182,24 +4431,40 @@ class PowerManager(hass.Hass):
         self.log(f"4 CHECK SAFETY NET! Rete: {power:.0f}W")
 
         excess = power - self.shed_target
-        shed_names = self._smart_shed(excess, include_all=True)
-        if self._get_grid_power() > self.shed_target:
-            shed_names = self._force_shed_all(shed_names)
+        self.actions.begin()
+        try:
+            shed_names = self._smart_shed(excess, include_all=True)
+            if self._residual_power(power, shed_names) > self.shed_target:
+                shed_names = self._force_shed_all(shed_names)
+        finally:
+            self.actions.flush()
 
         nc_active = self._get_non_controllable_power()
 
-        msg = (f"Attenzione critica! Distacco tra 30 minuti! "
+        remaining = self._format_remaining(self._meter_remaining())
+        msg = (f"Attenzione critica! Distacco tra {remaining}! "
                f"Supero del {pct:.0f} percento. ")
         if shed_names:
             msg += f"Ho spento: {', '.join(shed_names)}. "
         if nc_active:
             msg += f"Spegni subito {', '.join(nc_active.keys())}!"
-        self._notify_alexa(msg)
+        self._notify_alexa(msg, "yellow", critical=True)
 
         self._send_check_telegram(
             "4", "DISTACCO IMMINENTE", pct, power, shed_names, nc_active)
         self._publish_state()
 
+    def _residual_power(self, power, shed_names):
+        """
+        Rete attesa dopo il piano di _smart_shed: i comandi partono solo
+        al flush del batch, quindi la rete letta ora e ancora quella di
+        prima dello shed.
+        """
+        planned = self.shed_luna_watts + sum(
+            d.last_known_power for d in map(self.devices.get, shed_names)
+            if d is not None)
+        return power - planned
+
     # =====================================================================
     # ZONA ROSSA
     # =====================================================================
@@ -1208,19 +4473,22 @@ class PowerManager(hass.Hass):
         pct = self._calc_excess_percent(power)
         self.current_check = "ROSSO"
 
+        time_str = self._format_remaining(self._meter_remaining())
         if self.came_from_yellow:
-            time_str = "4 minuti (da gialla)"
-        else:
-            time_str = "2 minuti"
+            time_str += " (da gialla)"
 
         self.log(f"ZONA ROSSA! Rete: {power:.0f}W, supero: {pct:.0f}%. "
                  f"Distacco in {time_str}!")
 
         excess = power - self.shed_target
-        shed_names = self._smart_shed(excess, include_all=True)
-
-        if self._get_grid_power() > self.shed_target:
-            shed_names = self._force_shed_all(shed_names)
+        self.actions.begin()
+        try:
+            shed_names = self._smart_shed(excess, include_all=True)
+            if self._residual_power(power, shed_names) > self.shed_target:
+                shed_names = self._force_shed_all(shed_names)
+        finally:
+            calls = self.actions.flush()
+        self._record_red_dispatch(calls)
 
         nc_active = self._get_non_controllable_power()
 
@@ -1230,13 +4498,26 @@ class PowerManager(hass.Hass):
             msg += f"Ho spento: {', '.join(shed_names)}. "
         if nc_active:
             msg += f"Spegni subito {', '.join(nc_active.keys())}!"
-        self._notify_alexa(msg)
+        self._notify_alexa(msg, "red", critical=True)
 
         header = f"Distacco in {time_str}!"
         self._send_check_telegram(
             "ROSSO", header, pct, power, shed_names, nc_active)
         self._publish_state()
 
+    def _record_red_dispatch(self, calls):
+        """Tempo dal campione rosso all'ultimo comando di shed inviato."""
+        if self.power_event_at is None:
+            return
+        elapsed_ms = (time.perf_counter() - self.power_event_at) * 1000
+        stats = self.red_dispatch
+        stats["count"] += 1
+        stats["last_ms"] = round(elapsed_ms, 1)
+        stats["max_ms"] = round(max(stats["max_ms"] or 0, elapsed_ms), 1)
+        stats["last_calls"] = calls
+        self.log(f"  Comandi di shed inviati in {elapsed_ms:.1f} ms "
+                 f"({calls} chiamate)")
+
     # =====================================================================
     # RESTORE v6: SMART SEQUENZIALE CON VERIFICA
     # =====================================================================
@@ -1244,11 +4525,14 @@ class PowerManager(hass.Hass):
     def _schedule_restore(self):
         if self.restore_in_progress:
             return
+        if self.restore_started_at is None:
+            self.restore_started_at = self._clock()
+            self.restore_steps = 0
         delay = self.stable_minutes_before_restore * 60
         self.log(f"Verde. Attendo {self.stable_minutes_before_restore} min "
                  f"stabili prima del restore.")
-        self.restore_timer = self.run_in(
-            self._check_stability_then_restore, delay)
+        self._schedule(
+            "restore", self._check_stability_then_restore, delay)
         self.restore_in_progress = True
 
     def _check_stability_then_restore(self, kwargs):
@@ -1257,16 +4541,16 @@ class PowerManager(hass.Hass):
             return
 
         if self.green_stable_since is None:
-            self.restore_timer = self.run_in(
-                self._check_stability_then_restore, 60)
+            self._schedule(
+                "restore", self._check_stability_then_restore, 60)
             return
 
         stable = (datetime.now() - self.green_stable_since).total_seconds()
         required = self.stable_minutes_before_restore * 60
 
         if stable < required:
-            self.restore_timer = self.run_in(
-                self._check_stability_then_restore,
+            self._schedule(
+                "restore", self._check_stability_then_restore,
                 min(required - stable + 5, 60))
             return
 
@@ -1281,8 +4565,8 @@ class PowerManager(hass.Hass):
         rientrano nel margine disponibile.
         """
         shed_devices = [
-            d for d in sorted(self.devices, key=lambda x: -x.priority)
-            if d.state == DeviceState.SHED and d.auto_restore and d.enabled
+            d for d in self.devices.in_state(DeviceState.SHED, reverse=True)
+            if d.auto_restore and d.enabled
         ]
 
         current_power = self._get_grid_power()
@@ -1290,20 +4574,19 @@ class PowerManager(hass.Hass):
 
         fits = []
         exceeds = []
+        expected = {d: self._expected_power(d) for d in shed_devices}
         for d in shed_devices:
-            if d.last_known_power <= margin:
+            if expected[d] <= margin:
                 fits.append(d)
-                margin -= d.last_known_power
+                margin -= expected[d]
             else:
                 exceeds.append(d)
 
         self.restore_queue = fits + exceeds
 
         if self.restore_queue:
-            names_fits = [f"{d.name}({d.last_known_power:.0f}W)"
-                          for d in fits]
-            names_exc = [f"{d.name}({d.last_known_power:.0f}W)"
-                         for d in exceeds]
+            names_fits = [f"{d.name}({expected[d]:.0f}W)" for d in fits]
+            names_exc = [f"{d.name}({expected[d]:.0f}W)" for d in exceeds]
             self.log(f"  Coda restore: "
                      f"rientrano=[{', '.join(names_fits)}] "
                      f"eccedono=[{', '.join(names_exc)}]")
@@ -1316,11 +4599,29 @@ class PowerManager(hass.Hass):
             self.restore_queue = []
             return
 
+        # Riaccesi nel frattempo (timeout massimo) escono dalla coda
+        self.restore_queue = [d for d in self.restore_queue
+                              if d.state == DeviceState.SHED]
         if not self.restore_queue:
             self._on_restore_complete()
             return
 
-        device = self.restore_queue[0]
+        # Salta i device ancora in backoff per restore falliti
+        now_ts = self._clock()
+        ready = [d for d in self.restore_queue
+                 if not d.history.hold(now_ts)]
+        if not ready:
+            wait = min(d.history.not_before
+                       for d in self.restore_queue) - now_ts + 1
+            self.log(f"  Restore in attesa: "
+                     f"{', '.join(d.name for d in self.restore_queue)} "
+                     f"in backoff. Riprovo tra {wait:.0f}s")
+            self._schedule(
+                "restore", self._restore_next_in_queue, wait)
+            self._publish_state()
+            return
+
+        device = ready[0]
 
         # Rispetta durata minima shed
         if device.shed_time:
@@ -1330,109 +4631,208 @@ class PowerManager(hass.Hass):
                 self.log(f"  {device.name}: shed da {shed_secs:.0f}s, "
                          f"min={self.min_shed_duration}s. "
                          f"Attendo {wait:.0f}s.")
-                self.restore_timer = self.run_in(
-                    self._restore_next_in_queue, wait)
+                self._schedule(
+                    "restore", self._restore_next_in_queue, wait)
                 return
 
-        # Verifica margine PRIMA di riaccendere
+        # Verifica margine PRIMA di riaccendere: consumo a regime
+        # sotto il 110%, spunto di avvio sotto la soglia rossa
         current_power = self._get_grid_power()
-        projected = current_power + device.last_known_power
+        projected = current_power + self._expected_power(device)
+        surge = current_power + self._expected_surge(device)
 
-        if projected >= self.available_power:
-            restore_int = self._get_restore_interval()
-            backoff = restore_int * max(self.shed_cycle_count, 1)
+        if projected >= self.available_power or surge >= self.red_threshold:
+            backoff = self._restore_backoff([device])
             self.log(f"  {device.name}: proiezione {projected:.0f}W "
-                     f">= {self.available_power:.0f}W. "
+                     f"(spunto {surge:.0f}W) oltre "
+                     f"{self.available_power:.0f}W/"
+                     f"{self.red_threshold:.0f}W. "
                      f"Riprovo tra {backoff:.0f}s "
-                     f"(backoff x{max(self.shed_cycle_count, 1)})")
-            self.restore_timer = self.run_in(
-                self._restore_next_in_queue, backoff)
+                     f"(fallimenti di fila: {device.history.streak})")
+            self._schedule(
+                "restore", self._restore_next_in_queue, backoff)
             return
 
-        # Riaccendi
-        self.last_restored_device = device
-        self.restore_queue.pop(0)
-        self._restore_device(device)
-
-        if device.needs_manual_restart:
+        # Riaccendi: il primo in coda piu quelli che ci stanno insieme
+        batch = self._plan_restore_batch(current_power, ready)
+        self.actions.begin()
+        try:
+            for d in batch:
+                self.restore_queue.remove(d)
+                self._restore_device(d)
+        finally:
+            self.actions.flush()
+        self.last_restored_batch = batch
+        self.restore_steps += 1
+        projected = current_power + sum(
+            self._expected_power(d) for d in batch)
+
+        manual = [d.name for d in batch if d.needs_manual_restart]
+        if manual:
             self._notify_alexa(
-                f"Ho riacceso la presa di {device.name} ma ricordati "
-                f"di riavviare il programma manualmente.")
+                f"Ho riacceso la presa di {', '.join(manual)} ma "
+                f"ricordati di riavviare il programma manualmente.", "restore")
 
+        names = ", ".join(d.name for d in batch)
         self._notify_telegram(
-            f"*Power Manager:* 🔺 Riacceso *{device.name}*\n"
+            f"*Power Manager:* 🔺 Riacceso *{names}*\n"
             f"Rete: {current_power:.0f}W -> "
             f"proiezione ~{projected:.0f}W\n"
-            f"Rimangono spenti: {len(self.restore_queue)}")
+            f"Rimangono spenti: {len(self.restore_queue)}", "restore")
 
         # Programma verifica a meta intervallo
-        restore_int = self._get_restore_interval()
+        restore_int = self.settings.restore_interval
         half_interval = restore_int / 2
         self.log(f"  Verifica tra {half_interval:.0f}s")
-        self.restore_check_timer = self.run_in(
-            self._on_restore_verify, half_interval)
+        self._schedule(
+            "restore_check", self._on_restore_verify, half_interval)
+
+    def _plan_restore_batch(self, current_power, queue):
+        """
+        Primo device in coda (gia verificato) piu i successivi il cui
+        consumo a regime e spunto, sommati, stanno nel margine verso
+        110% e soglia rossa ridotto di restore_batch_safety. Gli spunti
+        si sommano: i device ripartono tutti insieme.
+        """
+        head = queue[0]
+        batch = [head]
+        steady = self._expected_power(head)
+        surge = self._expected_surge(head)
+        safety = self.restore_batch_safety
+        steady_room = (self.available_power - current_power) * safety
+        surge_room = (self.red_threshold - current_power) * safety
+        now = datetime.now()
+        for d in queue[1:]:
+            if self.restore_batch_max and len(batch) >= self.restore_batch_max:
+                break
+            if (d.shed_time and (now - d.shed_time).total_seconds()
+                    < self.min_shed_duration):
+                continue
+            d_steady = self._expected_power(d)
+            d_surge = self._expected_surge(d)
+            if (steady + d_steady <= steady_room
+                    and surge + d_surge <= surge_room):
+                batch.append(d)
+                steady += d_steady
+                surge += d_surge
+        if len(batch) > 1:
+            self.log(f"  Restore di gruppo: {len(batch)} device, "
+                     f"~{steady:.0f}W (margine {steady_room:.0f}W "
+                     f"x{safety})")
+        return batch
+
+    def _back_out_batch(self, power):
+        """
+        Dopo un restore di gruppo finito fuori dal verde: rispegne il
+        sottoinsieme minimo del gruppo (consumo reale misurato) che
+        riporta la rete sotto la soglia verde.
+        """
+        batch = [d for d in self.last_restored_batch
+                 if d.state == DeviceState.ON_BY_USER]
+        if not batch:
+            return []
+        candidates = [(d, self._get_device_power(d)) for d in batch]
+        excess = power - self.green_threshold
+        chosen = solve_shed_set(
+            candidates, excess, priority_weight=self.shed_priority_weight)
+        self.actions.begin()
+        try:
+            for d, _ in chosen:
+                self._shed_device(d)
+        finally:
+            self.actions.flush()
+        return [d.name for d, _ in chosen]
+
+    def _restore_backoff(self, devices):
+        """Attesa prima di ritentare: il backoff piu lungo dei device."""
+        base = self.settings.restore_interval
+        hour = datetime.now().hour
+        return max((d.history.backoff(base, self.restore_backoff_max, hour)
+                    for d in devices), default=base)
+
+    def _on_restore_failed(self, device):
+        """Device rispento poco dopo il restore: entra in backoff."""
+        history = device.history
+        until = datetime.fromtimestamp(history.not_before)
+        self.log(f"  {device.name}: restore fallito "
+                 f"({history.failures}/"
+                 f"{history.failures + history.successes}, "
+                 f"{history.streak} di fila). "
+                 f"Niente restore prima delle {until:%H:%M:%S}")
+        self._record_decision("restore", device.name, history.streak, "failed")
+        self._request_profile_save()
 
     def _on_restore_verify(self, kwargs):
         """v6: Verifica potenza dopo riaccensione."""
-        self.restore_check_timer = None
         power = self._get_grid_power()
         zone = self._classify_zone(power)
-        device = self.last_restored_device
 
         self.log(f"  Verifica post-restore: rete={power:.0f}W, "
                  f"zona={zone.value}")
 
         if zone == PowerZone.GREEN and power <= self.green_threshold:
             # OK! Aspetta fine intervallo poi prossimo
-            restore_int = self._get_restore_interval()
+            restore_int = self.settings.restore_interval
             remaining = restore_int / 2
             if self.restore_queue:
                 self.log(f"  OK. Prossimo restore tra {remaining:.0f}s")
-                self.restore_timer = self.run_in(
-                    self._restore_next_in_queue, remaining)
+                self._schedule(
+                    "restore", self._restore_next_in_queue, remaining)
             else:
                 self._on_restore_complete()
 
         elif zone == PowerZone.RED:
-            # CRITICO: ri-spegni l'ultimo riacceso
-            if device and device.state == DeviceState.ON_BY_USER:
-                self.log(f"  ROSSA! Ri-spengo {device.name}")
-                self._shed_device(device)
+            # CRITICO: ri-spegni il minimo indispensabile del gruppo
+            names = self._back_out_batch(power)
+            if names:
+                self.log(f"  ROSSA! Ri-spengo {', '.join(names)}")
                 self._notify_telegram(
                     f"*Power Manager:* 🔴 Risupero dopo restore!\n"
-                    f"Ri-spento: *{device.name}*\n"
-                    f"Rete: {power:.0f}W")
+                    f"Ri-spento: *{', '.join(names)}*\n"
+                    f"Rete: {power:.0f}W", "restore", critical=True)
             self.restore_in_progress = False
             self.restore_queue = []
 
         elif zone == PowerZone.YELLOW:
-            # Ri-spegni l'ultimo, logica gialla parte da sola
-            if device and device.state == DeviceState.ON_BY_USER:
-                self.log(f"  GIALLA! Ri-spengo {device.name}")
-                self._shed_device(device)
+            # Ri-spegni il minimo del gruppo, logica gialla parte da sola
+            names = self._back_out_batch(power)
+            if names:
+                self.log(f"  GIALLA! Ri-spengo {', '.join(names)}")
                 self._notify_telegram(
                     f"*Power Manager:* 🟡 Risupero dopo restore!\n"
-                    f"Ri-spento: *{device.name}*\n"
-                    f"Rete: {power:.0f}W - Avvio check gialli.")
+                    f"Ri-spento: *{', '.join(names)}*\n"
+                    f"Rete: {power:.0f}W - Avvio check gialli.", "restore")
             self.restore_in_progress = False
             self.restore_queue = []
 
         else:
             # Tra verde e gialla: STOP, troppo rischioso
             remaining_names = ', '.join(d.name for d in self.restore_queue)
-            restore_int = self._get_restore_interval()
-            backoff = restore_int * max(self.shed_cycle_count, 1)
+            backoff = self._restore_backoff(self.last_restored_batch)
             self.log(f"  Rete {power:.0f}W tra verde e gialla. "
                      f"STOP restore, riprovo tra {backoff:.0f}s.")
             self._notify_telegram(
                 f"*Power Manager:* ⚠️ Restore in pausa\n"
                 f"Rete: {power:.0f}W - troppo vicino alla soglia.\n"
                 f"Rimangono spenti: {remaining_names}\n"
-                f"Riprovo tra {backoff:.0f}s")
-            self.restore_timer = self.run_in(
-                self._restore_next_in_queue, backoff)
+                f"Riprovo tra {backoff:.0f}s", "restore")
+            self._schedule(
+                "restore", self._restore_next_in_queue, backoff)
 
     def _on_restore_complete(self):
+        if self.restore_started_at is not None:
+            elapsed = self._clock() - self.restore_started_at
+            stats = self.restore_stats
+            stats["count"] += 1
+            stats["last_s"] = round(elapsed)
+            stats["mean_s"] = round(
+                elapsed if stats["mean_s"] is None
+                else stats["mean_s"] + (elapsed - stats["mean_s"]) / stats[
+                    "count"])
+            stats["last_steps"] = self.restore_steps
+            self.log(f"Tempo al restore completo: {elapsed / 60:.1f} min "
+                     f"in {self.restore_steps} passi")
+            self.restore_started_at = None
         self.shed_active = False
         self.restore_in_progress = False
         self.current_check = None
@@ -1443,39 +4843,297 @@ class PowerManager(hass.Hass):
         # Ripristina Luna2000 per ultima (dopo tutti i device)
         self._luna_restore()
 
-        manual = [d for d in self.devices
-                  if d.state == DeviceState.SHED
-                  and (d.needs_manual_restart or not d.auto_restore)]
+        manual = [d for d in self.devices.in_state(DeviceState.SHED)
+                  if d.needs_manual_restart or not d.auto_restore]
 
         if manual:
             names = ", ".join(d.name for d in manual)
             self._notify_alexa(
-                f"Tutti riaccesi. Riavvia manualmente: {names}.")
+                f"Tutti riaccesi. Riavvia manualmente: {names}.", "restore")
             self._notify_telegram(
                 f"*Power Manager:* ✅ Restore completato\n"
-                f"Riavvia: {names}")
+                f"Riavvia: {names}", "restore")
         else:
             self._notify_alexa(
-                "Ho riacceso tutti gli elettrodomestici.")
+                "Ho riacceso tutti gli elettrodomestici.", "restore")
             self._notify_telegram(
-                "*Power Manager:* ✅ Restore completato - Tutti riaccesi")
+                "*Power Manager:* ✅ Restore completato - Tutti riaccesi",
+                "restore")
 
-        for d in self.devices:
-            if d.state == DeviceState.SHED:
-                d.state = DeviceState.UNKNOWN
+        for d in self.devices.in_state(DeviceState.SHED):
+            d.state = DeviceState.UNKNOWN
 
         self.log("Restore completato!")
         self._publish_state()
 
+    # =====================================================================
+    # PROFILI DI CONSUMO
+    # =====================================================================
+
+    def _expected_power(self, device):
+        """Consumo atteso a regime dopo il restore."""
+        if device.profile.trained(self.profile_min_cycles):
+            return device.profile.mean
+        return device.last_known_power
+
+    def _expected_surge(self, device):
+        """Spunto atteso nei primi secondi dopo il restore."""
+        profile = device.profile
+        if profile.trained(self.profile_min_cycles) and profile.surge:
+            return max(profile.surge, profile.mean)
+        return self._expected_power(device)
+
+    def _setup_profile_listeners(self):
+        # Un listener per sensore, anche se condiviso da piu device
+        self.power_listeners = {}
+        for d in self.devices:
+            self._listen_device_power(d.power_sensor)
+
+    def _listen_device_power(self, sensor):
+        if sensor and sensor not in self.power_listeners:
+            self.power_listeners[sensor] = self.listen_state(
+                self._on_device_power, sensor)
+
+    def _change_power_sensor(self, device, old):
+        """Sensore cambiato da dashboard: il profilo va riappreso."""
+        if old and all(d.power_sensor != old for d in self.devices):
+            handle = self.power_listeners.pop(old, None)
+            if handle is not None:
+                self.cancel_listen_state(handle)
+        self._listen_device_power(device.power_sensor)
+        device.profile = PowerProfile()
+        self._request_profile_save()
+
+    def _on_device_power(self, entity, attribute, old, new, kwargs):
+        self.state_cache.update(entity, new)
+        device = self.devices.by_power_sensor(entity)
+        if device is None or device.state == DeviceState.SHED:
+            return
+        try:
+            power = max(float(new), 0.0)
+        except (ValueError, TypeError):
+            return
+        if device.profile.observe(
+                self._clock(), power, self.settings.min_active_power,
+                self.profile_surge_window):
+            self._request_profile_save()
+
+    def _profile_data(self):
+        return {
+            "profiles": {d.name: [
+                round(v, 1) if isinstance(v, float) else v
+                for v in d.profile.to_list()]
+                for d in self.devices if d.profile.cycles},
+            "history": {d.name: d.history.to_list() for d in self.devices
+                        if d.history.successes or d.history.failures},
+        }
+
+    def _load_profiles(self):
+        data = self.profile_store.load()
+        if not data:
+            return
+        loaded = 0
+        for name, values in data.get("profiles", {}).items():
+            device = self.devices.get(name)
+            if device is not None:
+                device.profile.load(values)
+                loaded += 1
+        for name, values in data.get("history", {}).items():
+            device = self.devices.get(name)
+            if device is not None:
+                device.history.load(values)
+        self.log(f"Profili di consumo caricati: {loaded}")
+
+    def _request_profile_save(self):
+        if self.profile_store is None or "profile_save" in self.deadlines:
+            return
+        self._schedule(
+            "profile_save", self._flush_profiles,
+            max(self.profile_store.next_write_in(), 1))
+
+    def _flush_profiles(self, kwargs):
+        if self.profile_store.save(self._profile_data()) == "deferred":
+            self._request_profile_save()
+
+    # =====================================================================
+    # SNAPSHOT (RIAVVIO A CALDO)
+    # =====================================================================
+
+    def _snapshot_data(self):
+        shed = {}
+        for d in self.devices.in_state(DeviceState.SHED):
+            shed[d.name] = {
+                "shed_time": (d.shed_time.timestamp()
+                              if d.shed_time else None),
+                "last_known_power": round(d.last_known_power, 1),
+                "pre_shed_state": d.pre_shed_state,
+            }
+        return {
+            "shed_active": self.shed_active,
+            "shed_cycle_count": self.shed_cycle_count,
+            "shed_devices": shed,
+            "restore_in_progress": self.restore_in_progress,
+            "restore_queue": [d.name for d in self.restore_queue],
+            "luna": [self.luna_was_charging,
+                     round(self.luna_pre_shed_power, 1), self.luna_reduced],
+            "meter": self.meter.to_list(),
+        }
+
+    def _snapshot_meter(self, band):
+        """Consumo di tolleranza su disco ai cambi di fascia e, in fascia,
+        ogni snapshot_meter_interval secondi."""
+        if self.snapshot_store is None or self.meter.band == band:
+            return
+        self._request_snapshot()
+        if self.meter.band == MeterBudget.NONE:
+            self._cancel("meter_snapshot")
+        elif band == MeterBudget.NONE:
+            interval = self.snapshot_meter_interval
+            self._schedule("meter_snapshot", self._flush_snapshot,
+                           interval, interval=interval)
+
+    def _request_snapshot(self):
+        """Segna lo stato come cambiato: scrittura entro ~1s, coalescente."""
+        if self.snapshot_store is None or "snapshot" in self.deadlines:
+            return
+        self._schedule(
+            "snapshot", self._flush_snapshot,
+            max(self.snapshot_store.next_write_in(), 1))
+
+    def _flush_snapshot(self, kwargs):
+        self.meter.advance(self._clock())
+        if self.snapshot_store.save(self._snapshot_data()) == "deferred":
+            self._request_snapshot()
+
+    def _save_snapshot_now(self):
+        if self.snapshot_store is not None:
+            self.meter.advance(self._clock())
+            self.snapshot_store.save(self._snapshot_data(), force=True)
+
+    def _restore_snapshot(self):
+        """
+        Riallinea lo stato salvato con quello reale delle entity:
+        resta SHED solo chi e ancora spento (in dry run tutti), i
+        timeout massimi ripartono col tempo residuo e il restore
+        riprende da dove era rimasto.
+        """
+        if self.snapshot_store is None:
+            return
+        data = self.snapshot_store.load()
+        if not data:
+            return
+        max_age = self.args.get("snapshot_max_age", 86400)
+        age = self._clock() - data.get("saved_at", 0)
+        if age > max_age:
+            self.log(f"Snapshot ignorato: vecchio di {age / 3600:.1f} h")
+            return
+
+        now = datetime.now()
+        max_time = self.settings.max_shed_time
+        resumed = []
+        for name, info in data.get("shed_devices", {}).items():
+            device = self.devices.get(name)
+            if device is None or not device.enabled:
+                continue
+            if not self.dry_run and self._is_device_on(device):
+                continue  # riacceso a mano durante il riavvio
+            shed_ts = info.get("shed_time")
+            device.shed_time = (datetime.fromtimestamp(shed_ts)
+                                if shed_ts else now)
+            device.last_known_power = info.get("last_known_power", 0.0)
+            device.pre_shed_state = info.get("pre_shed_state")
+            device.state = DeviceState.SHED
+            elapsed = (now - device.shed_time).total_seconds()
+            self._start_max_shed_timer(device, max(max_time - elapsed, 1))
+            resumed.append(device)
+
+        luna = data.get("luna") or [False, 0.0, False]
+        (self.luna_was_charging, self.luna_pre_shed_power,
+         self.luna_reduced) = luna
+        self.shed_cycle_count = data.get("shed_cycle_count", 0)
+        self.shed_active = bool(resumed) or self.luna_reduced
+        self.meter.load(data.get("meter"), self._clock())
+
+        self.log(f"Snapshot ripreso ({age:.0f}s fa): "
+                 f"{len(resumed)} device spenti "
+                 f"[{', '.join(d.name for d in resumed)}], "
+                 f"ciclo #{self.shed_cycle_count}")
+        if not self.shed_active:
+            return
+
+        # Restore: riprende subito solo se la rete e gia in verde;
+        # altrimenti lo pianifica il normale rientro in zona verde.
+        power = self._get_grid_power()
+        if self._classify_zone(power) != PowerZone.GREEN:
+            return
+        self.green_stable_since = now
+        queue = [d for d in (self.devices.get(n)
+                             for n in data.get("restore_queue", ()))
+                 if d is not None and d.state == DeviceState.SHED]
+        if data.get("restore_in_progress") and queue:
+            self.restore_queue = queue
+            self.restore_in_progress = True
+            delay = self.settings.restore_interval / 2
+            self.log(f"  Restore ripreso tra {delay:.0f}s: "
+                     f"{', '.join(d.name for d in queue)}")
+            self._schedule(
+                "restore", self._restore_next_in_queue, delay)
+        else:
+            self._schedule_restore()
+
     # =====================================================================
     # NOTIFICHE
     # =====================================================================
 
-    def _notify_alexa(self, message):
+    def _notify_alexa(self, message, category="info", critical=False):
+        self._route_notification("alexa", category, message, critical)
+
+    def _notify_telegram(self, message, category="info", critical=False):
+        if self.telegram_sender is None:
+            self.log("Telegram: bot token non configurato!", level="WARNING")
+            return
+        self._route_notification("telegram", category, message, critical)
+
+    def _route_notification(self, channel, category, message, critical):
+        result = self.notifications.submit(
+            channel, category, message, critical)
+        if result == "sent":
+            return
+        self.log(f"  {channel} ({category}): "
+                 f"{'duplicato' if result == 'duplicate' else 'nel digest'}"
+                 f" - {message[:60]}...")
+        if result == "deferred" and "notify_digest" not in self.deadlines:
+            self._schedule("notify_digest", self._flush_notifications,
+                           self.notifications.next_flush_in())
+
+    def _flush_notifications(self, kwargs):
+        self.notifications.flush()
+        delay = self.notifications.next_flush_in()
+        if delay is not None:
+            self._schedule("notify_digest", self._flush_notifications, delay)
+
+    def _format_digest(self, channel, category, count, window, last):
+        minutes = max(round(window / 60), 1)
+        if channel == "alexa":
+            return (f"{count} avvisi negli ultimi {minutes} minuti. "
+                    f"L'ultimo: {last}")
+        last = last.replace("*Power Manager:* ", "", 1)
+        return (f"*Power Manager:* 📋 {count} eventi {category} "
+                f"negli ultimi {minutes} min, l'ultimo:\n{last}")
+
+    def _deliver_notification(self, channel, message):
+        if channel == "alexa":
+            self._send_alexa(message)
+        else:
+            self._send_telegram(message)
+
+    def _send_alexa(self, message):
         """Alexa: DND SEMPRE rispettato. Solo Telegram bypassa DND."""
-        if self._is_dnd_active():
+        if self.settings.dnd_active(datetime.now()):
             self.log(f"  DND: {message[:60]}...")
+            self._record_notify("alexa_dnd", message)
             return
+        self._record_notify("alexa", message)
         try:
             self.call_service(
                 self.alexa_notify_service,
@@ -1485,28 +5143,10 @@ class PowerManager(hass.Hass):
         except Exception as e:
             self.log(f"Alexa: {e}", level="WARNING")
 
-    def _notify_telegram(self, message):
-        if not self.telegram_bot_token:
-            self.log("Telegram: bot token non configurato!", level="WARNING")
-            return
-        try:
-            url = (f"https://api.telegram.org/"
-                   f"bot{self.telegram_bot_token}/sendMessage")
-            payload = json_module.dumps({
-                "chat_id": self.telegram_chat_id,
-                "text": message,
-                "parse_mode": "Markdown",
-            }).encode("utf-8")
-            req = urllib.request.Request(
-                url, data=payload,
-                headers={"Content-Type": "application/json"})
-            response = urllib.request.urlopen(req, timeout=10)
-            if response.getcode() == 200:
-                self.log(f"  TG: {message[:60]}...")
-            else:
-                self.log(f"TG HTTP {response.getcode()}", level="WARNING")
-        except Exception as e:
-            self.log(f"TG errore: {e}", level="WARNING")
+    def _send_telegram(self, message):
+        """Accoda il messaggio: l'invio avviene nel thread TelegramSender."""
+        self._record_notify("telegram", message)
+        self.telegram_sender.send(message)
 
     def _send_check_telegram(self, check_num, header, pct, power,
                               shed_names, nc_active):
@@ -1522,101 +5162,206 @@ class PowerManager(hass.Hass):
         if nc_active:
             for name, pw in nc_active.items():
                 msg += f"⚠️ {name}: {pw:.0f}W (non controllabile)\n"
-        self._notify_telegram(msg)
+        if check_num == "ROSSO":
+            self._notify_telegram(msg, "red", critical=True)
+        else:
+            self._notify_telegram(msg, "yellow", critical=check_num == "4")
 
-    def _is_dnd_active(self):
-        """
-        DND letto da dashboard (input_datetime).
-        Fallback su valori apps.yaml se helper non esistono.
-        DND si applica SOLO ad Alexa, MAI a Telegram.
-        """
-        now = datetime.now().time()
-        periods = self._get_dnd_periods()
-        for start_str, end_str in periods:
-            try:
-                start = datetime.strptime(start_str, "%H:%M").time()
-                end = datetime.strptime(end_str, "%H:%M").time()
-            except (ValueError, TypeError):
-                continue
-            if start <= end:
-                if start <= now <= end:
-                    return True
-            else:
-                # Attraversa mezzanotte (es. 23:00 → 08:00)
-                if now >= start or now <= end:
-                    return True
-        return False
+    # =====================================================================
+    # DECISIONI: GIORNALE E METRICHE
+    # =====================================================================
+    # Ogni decisione passa da _record_decision: un record nel giornale
+    # e i contatori dell'endpoint metriche, entrambi opzionali.
+
+    def _record_decision(self, kind, device=None, value=None, detail=None,
+                         power=None):
+        """Solo append/incrementi in memoria: nessun I/O."""
+        if self.metrics is not None:
+            self._count_decision(kind, device, detail)
+        if self.journal is None:
+            return
+        if power is None:
+            power = self._get_grid_power()
+        self.journal.record(
+            round(self._clock(), 3), kind, self.current_zone.value,
+            round(power), device, value, detail)
+
+    def _record_notify(self, channel, message):
+        head = message.split("\n", 1)[0].replace("*", "").strip()
+        self._record_decision("notify", detail=f"{channel}: {head[:80]}")
+
+    def _count_decision(self, kind, device, detail):
+        labels = self.metric_labels
+        if kind == "shed":
+            name, labels = "sheds_total", labels + (("device", device),)
+        elif kind == "restore":
+            name = ("reshed_after_restore_total" if detail == "failed"
+                    else "restores_total")
+            labels += (("device", device),)
+        elif kind == "timeout":
+            name = "max_shed_timeouts_total"
+            labels += (("device", device),)
+        elif kind == "notify":
+            channel = detail.split(":", 1)[0]
+            if channel == "alexa_dnd":
+                return  # non inviata
+            name, labels = "notifications_total", labels + (
+                ("channel", channel),)
+        elif kind == "zone":
+            name = "zone_changes_total"
+            labels += (("zone", detail.split("->")[-1]),)
+        elif kind == "luna":
+            name, labels = "luna_actions_total", labels + (
+                ("action", detail),)
+        else:
+            return  # tipo senza contatore
+        self.metrics.count(name, labels)
 
-    def _get_dnd_periods(self):
-        """Legge i 2 periodi DND da dashboard, fallback su apps.yaml."""
-        periods = []
-        # Periodo 1
-        s1 = self._get_dnd_helper("input_datetime.pm_dnd1_start", "23:00")
-        e1 = self._get_dnd_helper("input_datetime.pm_dnd1_end", "08:00")
-        periods.append((s1, e1))
-        # Periodo 2
-        s2 = self._get_dnd_helper("input_datetime.pm_dnd2_start", "14:00")
-        e2 = self._get_dnd_helper("input_datetime.pm_dnd2_end", "16:00")
-        periods.append((s2, e2))
-        return periods
-
-    def _get_dnd_helper(self, entity_id, fallback):
-        """Legge un input_datetime come HH:MM, con fallback."""
-        if self.entity_exists(entity_id):
-            val = self.get_state(entity_id)
-            if val and val not in ("unknown", "unavailable"):
-                # input_datetime con has_time restituisce "HH:MM:SS"
-                return val[:5]  # prendi solo HH:MM
-        return fallback
+    def _export_gauges(self, grid_power, pct, shed_count, device_powers,
+                       luna_configured):
+        labels = self.metric_labels
+        reduced = 0.0
+        if self.luna_reduced:
+            reduced = max(self.luna_pre_shed_power - luna_configured, 0.0)
+        gauges = [
+            ("grid_power_watts", labels, grid_power),
+            ("excess_percent", labels, round(pct, 1)),
+            ("shed_devices", labels, shed_count),
+            ("shed_cycles", labels, self.shed_cycle_count),
+            ("restore_queue_length", labels, len(self.restore_queue)),
+            ("luna_reduced_watts", labels, reduced),
+        ]
+        current = self.current_zone
+        gauges.extend(("zone", labels + (("zone", z.value),),
+                       int(z == current)) for z in PowerZone)
+        gauges.extend(("device_power_watts", labels + (("device", name),),
+                       details["power"])
+                      for name, details in device_powers.items())
+        self.metrics.set_gauges(self.site_id, gauges)
 
     # =====================================================================
     # TIMER
     # =====================================================================
-
-    def _cancel_yellow_timers(self):
-        for attr in ("yellow_check2_timer", "yellow_check3_timer",
-                      "yellow_check4_timer", "yellow_recheck_timer"):
-            timer = getattr(self, attr, None)
-            if timer is not None:
-                try:
-                    self.cancel_timer(timer)
-                except Exception:
-                    pass
-                setattr(self, attr, None)
-
-    def _cancel_restore(self):
-        if self.restore_timer is not None:
+    # Tutte le scadenze stanno in self.deadlines; AppDaemon vede un solo
+    # timer, armato sulla prossima scadenza e riarmato dopo ogni giro.
+
+    def _schedule(self, name, callback, delay, interval=None, **kwargs):
+        """Come run_in, ma con nome: riprogrammare sostituisce."""
+        self.deadlines.schedule(
+            name, self._clock() + max(float(delay), 0.0), callback,
+            kwargs, interval)
+        self._arm_deadlines()
+
+    def _cancel(self, name):
+        # Il timer AppDaemon gia armato scatta a vuoto e si riarma
+        return self.deadlines.cancel(name)
+
+    def _arm_deadlines(self):
+        due = self.deadlines.next_due()
+        if due is None or (self.deadline_armed is not None
+                           and self.deadline_armed <= due):
+            return
+        if self.deadline_handle is not None:
             try:
-                self.cancel_timer(self.restore_timer)
+                self.cancel_timer(self.deadline_handle)
             except Exception:
                 pass
-            self.restore_timer = None
-        if self.restore_check_timer is not None:
+        self.deadline_armed = due
+        self.deadline_handle = self.run_in(
+            self._on_deadline_tick, max(due - self._clock(), 0))
+
+    def _on_deadline_tick(self, kwargs):
+        self.deadline_handle = None
+        self.deadline_armed = None
+        now = self._clock() + 0.001  # tolleranza arrotondamenti float
+        while True:
+            item = self.deadlines.pop_due(now)
+            if item is None:
+                break
+            name, callback, cb_kwargs = item
             try:
-                self.cancel_timer(self.restore_check_timer)
-            except Exception:
-                pass
-            self.restore_check_timer = None
+                callback(cb_kwargs)
+            except Exception as e:
+                self.log(f"Scadenza {name}: {e}", level="ERROR")
+        self._arm_deadlines()
+
+    def _cancel_yellow_timers(self):
+        self.deadlines.cancel_prefix("yellow_")
+
+    def _cancel_restore(self):
+        self._cancel("restore")
+        self._cancel("restore_check")
         self.restore_in_progress = False
         self.restore_queue = []
 
+    # =====================================================================
+    # PROFILING
+    # =====================================================================
+    # Opt-in: senza `profiling: true` nessun metodo viene avvolto e il
+    # costo e nullo. Attivo, ogni punto d'ingresso misura durata e
+    # chiamate HA, con riepilogo su sensor.power_manager_profiling.
+
+    def _setup_profiling(self):
+        self.profiler = None
+        if not self.args.get("profiling", False):
+            return
+        self.profiler = CallProfiler(
+            slow_ms=self.args.get("profiling_slow_ms", 1000),
+            on_slow=self._on_slow_call,
+        )
+        for counter, method in (("get_state", "get_state"),
+                                ("call_service", "call_service"),
+                                ("set_state", "set_state"),
+                                ("http", "_send_telegram")):
+            setattr(self, method,
+                    self.profiler.counting(counter, getattr(self, method)))
+        for name in self.PROFILED_CALLBACKS:
+            setattr(self, name, self.profiler.wrap(name, getattr(self, name)))
+        interval = self.args.get("profiling_interval", 60)
+        self._schedule("profiling", self._publish_profiling, interval,
+                       interval=interval)
+        self.log(f"Profiling attivo: {len(self.PROFILED_CALLBACKS)} "
+                 f"callback, riepilogo ogni {interval}s")
+
+    def _on_slow_call(self, name, elapsed_ms, counts):
+        calls = ", ".join(f"{k} {v}" for k, v in counts.items() if v)
+        self.log(f"Profiling: {name} lento, {elapsed_ms:.0f} ms"
+                 f" ({calls or 'nessuna chiamata HA'})", level="WARNING")
+
+    def _publish_profiling(self, kwargs):
+        stats = self.profiler.stats()
+        slowest = max(stats, key=lambda n: stats[n]["p99_ms"], default=None)
+        self.set_state(
+            self._ns("sensor.power_manager_profiling"),
+            state=stats[slowest]["p99_ms"] if slowest else 0,
+            attributes={
+                "friendly_name": "Power Manager profiling",
+                "icon": "mdi:timer-sand",
+                "unit_of_measurement": "ms",
+                "slowest": slowest,
+                "callbacks": stats,
+                "telegram_requests": (self.telegram_sender.requests
+                                      if self.telegram_sender else None),
+            },
+        )
+
     # =====================================================================
     # TEST MODE
     # =====================================================================
 
     def _setup_test_mode(self):
         for helper, attr in [
-            ("input_boolean.pm_test_mode", "test_mode"),
-            ("input_boolean.pm_dry_run", "dry_run"),
+            (self._ns("input_boolean.pm_test_mode"), "test_mode"),
+            (self._ns("input_boolean.pm_dry_run"), "dry_run"),
         ]:
             if self.entity_exists(helper):
                 self.listen_state(
                     self._on_test_toggle, helper, attr_name=attr)
                 setattr(self, attr, self.get_state(helper) == "on")
 
-        if self.test_mode and self.entity_exists("input_number.pm_test_power"):
-            self.listen_state(
-                self._on_test_power_change, "input_number.pm_test_power")
+        test_power = self._ns("input_number.pm_test_power")
+        if self.test_mode and self.entity_exists(test_power):
+            self.listen_state(self._on_test_power_change, test_power)
 
         if self.test_mode:
             self.log("TEST MODE ATTIVA")
@@ -1629,7 +5374,8 @@ class PowerManager(hass.Hass):
         self.log(f"{attr}: {'ON' if new == 'on' else 'OFF'}")
         if attr == "test_mode" and new == "on":
             self.listen_state(
-                self._on_test_power_change, "input_number.pm_test_power")
+                self._on_test_power_change,
+                self._ns("input_number.pm_test_power"))
 
     def _on_test_power_change(self, entity, attribute, old, new, kwargs):
         if not self.test_mode:
@@ -1658,7 +5404,7 @@ class PowerManager(hass.Hass):
                         device_name=device.name, field=field)
                     val = self.get_state(helper)
                     if val and val not in ("unknown", "unavailable", ""):
-                        setattr(device, field, val)
+                        self.devices.set_field(device, field, val)
 
             enabled_helper = f"input_boolean.{prefix}_enabled"
             if self.entity_exists(enabled_helper):
@@ -1673,26 +5419,38 @@ class PowerManager(hass.Hass):
             return
         name = kwargs.get("device_name")
         field = kwargs.get("field")
-        for d in self.devices:
-            if d.name == name:
-                setattr(d, field, new)
-                self.log(f"{name}.{field} = {new}")
-                break
+        device = self.devices.get(name)
+        if device is not None:
+            old_value = getattr(device, field, None)
+            self.devices.set_field(device, field, new)
+            self.state_cache.prime(new)
+            if field == "power_sensor" and new != old_value:
+                self._change_power_sensor(device, old_value)
+            self.log(f"{name}.{field} = {new}")
 
     def _on_dashboard_enable_change(self, entity, attribute, old, new, kwargs):
-        name = kwargs.get("device_name")
-        for d in self.devices:
-            if d.name == name:
-                d.enabled = (new == "on")
-                break
+        device = self.devices.get(kwargs.get("device_name"))
+        if device is not None:
+            device.enabled = (new == "on")
 
     # =====================================================================
     # PUBBLICA STATO
     # =====================================================================
 
-    def _publish_state(self):
-        shed_list = [d.name for d in self.devices
-                     if d.state == DeviceState.SHED]
+    def _clock(self):
+        return datetime.now().timestamp()
+
+    def _write_zone_sensor(self, state, attributes):
+        self.set_state(
+            self._ns("sensor.power_manager_zone"),
+            state=state, attributes=attributes)
+
+    def _flush_zone_sensor(self, kwargs):
+        self.zone_publisher.flush()
+
+    def _publish_state(self, force=False):
+        shed_list = [d.name for d in
+                     self.devices.in_state(DeviceState.SHED)]
         nc_active = self._get_non_controllable_power()
         grid_power = self._get_grid_power()
         pct = self._calc_excess_percent(grid_power)
@@ -1710,22 +5468,32 @@ class PowerManager(hass.Hass):
             ).total_seconds() / 60
 
         device_powers = {}
+        avoided = 0
         for d in self.devices:
             pw = self._get_device_power(d)
-            device_powers[d.name] = {
+            details = device_powers[d.name] = {
                 "power": round(pw, 1),
                 "state": d.state.value,
                 "enabled": d.enabled,
                 "priority": d.priority,
                 "last_known_power": round(d.last_known_power, 1),
             }
+            if d.profile.cycles:
+                details["profile"] = d.profile.stats()
+            history = d.history
+            if history.successes or history.failures:
+                details["restore"] = history.stats()
+                avoided += history.avoided
 
         restore_queue_names = [d.name for d in self.restore_queue]
-
-        self.set_state(
-            "sensor.power_manager_zone",
-            state=self.current_zone.value,
-            attributes={
+        luna_configured = self._luna_get_configured_power()
+        if self.metrics is not None:
+            self._export_gauges(grid_power, pct, len(shed_list),
+                                device_powers, luna_configured)
+
+        result = self.zone_publisher.offer(
+            self.current_zone.value,
+            {
                 "friendly_name": "Power Manager - Zona",
                 "icon": {
                     "green": "mdi:check-circle",
@@ -1749,14 +5517,106 @@ class PowerManager(hass.Hass):
                     round(stable_min, 1) if stable_min else None),
                 "restore_in_progress": self.restore_in_progress,
                 "restore_queue": restore_queue_names,
+                "restore_time": self.restore_stats,
+                "restore_avoided_cycles": avoided,
                 "shed_cycle_count": self.shed_cycle_count,
                 "test_mode": self.test_mode,
                 "dry_run": self.dry_run,
                 "device_details": device_powers,
                 "luna2000_charging": self._luna_is_charging(),
                 "luna2000_actual_power": self._luna_get_power(),
-                "luna2000_configured_power": self._luna_get_configured_power(),
+                "luna2000_configured_power": luna_configured,
                 "luna2000_reduced": self.luna_reduced,
                 "luna2000_pre_shed_power": self.luna_pre_shed_power,
+                "luna2000_controller": (self.luna_controller.stats()
+                                        if self.luna_controller else None),
+                "state_cache": self.state_cache.stats(),
+                "publisher": self.zone_publisher.stats(),
+                "telegram": (self.telegram_sender.stats()
+                             if self.telegram_sender else None),
+                "meter": dict(self.meter.stats(),
+                              check_marks=self.yellow_check_marks),
+                "red_dispatch": self.red_dispatch,
+                "deadlines": {
+                    "pending": len(self.deadlines),
+                    "next": (self.deadlines.peek() or (None,))[0],
+                    "fired": self.deadlines.fired,
+                },
+                "prediction": (self.overload_predictor.stats()
+                               if self.overload_predictor else None),
+                "journal": self.journal.stats() if self.journal else None,
+                "power_source": (self.power_source.stats()
+                                 if self.power_source else None),
+                "notifications": self.notifications.stats(),
             },
+            force=force,
         )
+        if result == "deferred" and "publish_flush" not in self.deadlines:
+            self._schedule(
+                "publish_flush", self._flush_zone_sensor,
+                max(self.zone_publisher.next_flush_in(), 1))
+
+
+class PowerSite(PowerManager):
+    """
+    Un contatore gestito da un'app PowerManager in modalita multi-sito.
+
+    Riusa tutta la logica di PowerManager; le chiamate HA passano
+    dall'app ospite (niente hass.Hass.__init__ per sito), i listener
+    sono condivisi per entity e i sensori pubblicati hanno il nome del
+    sito: sensor.power_manager_<sito>_zone, sensor.pm_<sito>_elapsed_time,
+    timer.pm_<sito>_distacco_countdown, input_*.pm_<sito>_*.
+    """
+
+    def __init__(self, host, site_id, args):
+        self.host = host
+        self.site_id = site_id
+        self.site_name = args.get("name", site_id)
+        self.args = args
+
+    def initialize(self):
+        self.state_cache = self.host.state_cache
+        self.deadlines = SiteDeadlines(self.host.deadlines, self.site_id)
+        self.telegram_senders = {}  # chiusi dall'ospite
+        self.metrics_exporters = {}
+        self._setup()
+
+    def terminate(self):
+        pass
+
+    def _get_telegram_sender(self, token, chat_id):
+        return self.host._get_telegram_sender(token, chat_id)
+
+    def _get_metrics_exporter(self, host, port):
+        return self.host._get_metrics_exporter(host, port)
+
+    def _send_telegram(self, message):
+        super()._send_telegram(message.replace(
+            "*Power Manager:*", f"*Power Manager - {self.site_name}:*", 1))
+
+    # --- API HA delegate all'ospite ---
+
+    def listen_state(self, callback, entity_id, **kwargs):
+        return self.host._listen_shared(callback, entity_id, **kwargs)
+
+    def cancel_listen_state(self, handle):
+        return self.host._cancel_shared(handle)
+
+    def get_state(self, entity_id, **kwargs):
+        return self.host.get_state(entity_id, **kwargs)
+
+    def entity_exists(self, entity_id, **kwargs):
+        return self.host.entity_exists(entity_id, **kwargs)
+
+    def set_state(self, entity_id, **kwargs):
+        return self.host.set_state(entity_id, **kwargs)
+
+    def call_service(self, service, **kwargs):
+        return self.host.call_service(service, **kwargs)
+
+    def _arm_deadlines(self):
+        # Il timer AppDaemon e dell'ospite, unico per tutti i siti
+        self.host._arm_deadlines()
+
+    def log(self, message, level="INFO", **kwargs):
+        self.host.log(f"[{self.site_id}] {message}", level=level, **kwargs)
@@ -0,0 +1,280 @@
+"""
+=============================================================================
+  POWER MANAGER - Benchmark latenza evento potenza -> shed
+=============================================================================
+
+  Misura tempo (p50/p99) e chiamate HA (get_state, call_service,
+  set_state) per invocazione di:
+    on_power_change, _smart_shed, _force_shed_all,
+    _build_restore_queue, _publish_state
+  su configurazioni sintetiche (default 5, 50, 500 device) e frequenze
+  di campionamento 1-50 Hz, con il backend FakeHass di tools/sim.py.
+
+  Fasi per ogni configurazione:
+    - stream: campioni di rete alla frequenza indicata (verde/giallo/
+      rosso a rotazione) per --duration secondi simulati
+    - shed:   --iterations cicli shed completo + coda di restore,
+      con tutti i device riaccesi prima di ogni ciclo
+
+  Confronto con una baseline (stessi --duration e --iterations):
+    - chiamate HA: il FakeHass e deterministico, quindi invocazioni e
+      totali get_state/call_service/set_state devono coincidere
+    - tempi: p99 oltre --tolerance volte la baseline, solo con almeno
+      --min-samples campioni e oltre --noise-floor us di differenza
+
+  Uso:
+    python tools/bench.py --output bench.json
+    python tools/bench.py --compare baseline.json --tolerance 1.25
+
+=============================================================================
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import VirtualClock, load_power_manager  # noqa: E402
+
+MEASURED = ("on_power_change", "_smart_shed", "_force_shed_all",
+            "_build_restore_queue", "_publish_state")
+COUNTED = ("get_state", "call_service", "set_state")
+
+
+def make_config(n_devices, seed=1):
+    """Configurazione sintetica con n device controllabili."""
+    rng = random.Random(seed)
+    devices = []
+    states = {"sensor.bench_grid": "0"}
+    for i in range(n_devices):
+        power = rng.choice((150, 400, 800, 1200, 1800, 2200))
+        devices.append({
+            "name": f"Device {i}",
+            "entity_id": f"switch.bench_{i}",
+            "priority": i % 10 + 1,
+            "estimated_power": power,
+            "power_sensor": f"sensor.bench_{i}_power",
+            "shed_in_yellow": i % 4 != 0,
+        })
+        states[f"switch.bench_{i}"] = "on"
+        states[f"sensor.bench_{i}_power"] = str(power)
+    args = {
+        "power_sensor": "sensor.bench_grid",
+        "contract_power": 4500,
+        "devices": devices,
+        "non_controllable": [
+            {"name": "Forno", "estimated_power": 2500,
+             "power_sensor": "sensor.bench_oven"}],
+    }
+    states["sensor.bench_oven"] = "0"
+    return args, states
+
+
+class Recorder:
+    """Avvolge i metodi dell'istanza e registra tempi e chiamate HA."""
+
+    def __init__(self, app):
+        self.app = app
+        self.samples = {name: [] for name in MEASURED}
+        self.calls = {name: dict.fromkeys(COUNTED, 0) for name in MEASURED}
+        for name in MEASURED:
+            setattr(app, name, self._wrap(name, getattr(app, name)))
+
+    def _wrap(self, name, method):
+        counters = self.app.sim_counters
+        samples = self.samples[name]
+        calls = self.calls[name]
+
+        def wrapper(*args, **kwargs):
+            before = [counters[c] for c in COUNTED]
+            start = time.perf_counter_ns()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter_ns() - start)
+                for c, b in zip(COUNTED, before):
+                    calls[c] += counters[c] - b
+        return wrapper
+
+    def results(self):
+        out = {}
+        for name, samples in self.samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            n = len(ordered)
+            entry = {
+                "calls": n,
+                "p50_us": round(ordered[n // 2] / 1000, 2),
+                "p99_us": round(
+                    ordered[min(int(n * 0.99), n - 1)] / 1000, 2),
+                "max_us": round(ordered[-1] / 1000, 2),
+                "mean_us": round(sum(ordered) / n / 1000, 2),
+            }
+            for c in COUNTED:
+                entry[f"{c}_per_call"] = round(self.calls[name][c] / n, 2)
+                entry[f"{c}_total"] = self.calls[name][c]
+            out[name] = entry
+        return out
+
+
+def _new_app(n_devices):
+    args, states = make_config(n_devices)
+    clock = VirtualClock(datetime(2026, 1, 1, 12))
+    module = load_power_manager(clock)
+    app = module.PowerManager(args, states, clock=clock)
+    return app, clock, module
+
+
+def bench_stream(n_devices, rate_hz, duration):
+    """Campioni di rete a rate_hz: zona a rotazione ogni 20 s."""
+    app, clock, _ = _new_app(n_devices)
+    recorder = Recorder(app)  # prima di initialize: listener avvolti
+    app.initialize()
+    profile = (3000.0, 5200.0, 6200.0, 3500.0)  # verde/giallo/rosso/verde
+    rng = random.Random(2)
+    step = timedelta(seconds=1.0 / rate_hz)
+    for i in range(int(duration * rate_hz)):
+        clock.advance_to(clock.now + step)
+        base = profile[int(i / rate_hz // 20) % len(profile)]
+        app.sim_set(app.power_sensor, f"{base + rng.gauss(0, 40):.1f}")
+    return recorder.results()
+
+
+def bench_shed(n_devices, iterations):
+    """Ciclo completo di shed in zona rossa + costruzione coda restore."""
+    app, clock, module = _new_app(n_devices)
+    recorder = Recorder(app)
+    app.initialize()
+    on_by_user = module.DeviceState.ON_BY_USER
+    excess = 1500.0 + 50.0 * n_devices
+    for _ in range(iterations):
+        app._cancel_all_max_shed_timers()
+        for d in app.devices:
+            d.state = on_by_user
+            app.sim_set(d.entity_id, "on")
+        app.shed_active = False
+        app.sim_set(app.power_sensor, f"{app.red_threshold + excess:.1f}")
+        app._smart_shed(excess, include_all=True)
+        app._force_shed_all([])
+        app._build_restore_queue()
+        app._publish_state()
+        clock.advance_to(clock.now + timedelta(seconds=1))
+    return recorder.results()
+
+
+def run(device_counts, rates, duration, iterations):
+    results = []
+    for n in device_counts:
+        for rate in rates:
+            for method, entry in bench_stream(n, rate, duration).items():
+                results.append(dict(phase="stream", devices=n,
+                                    rate_hz=rate, method=method, **entry))
+        for method, entry in bench_shed(n, iterations).items():
+            results.append(dict(phase="shed", devices=n, rate_hz=None,
+                                method=method, **entry))
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "duration_s": duration,
+            "iterations": iterations,
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance, min_samples=200,
+            noise_floor_us=100.0):
+    """
+    Regressioni rispetto alla baseline: chiamate HA diverse (esatte)
+    oppure p99 oltre `tolerance` volte la baseline, se entrambe le
+    misure hanno almeno `min_samples` campioni e la differenza supera
+    `noise_floor_us`.
+    """
+    def key(r):
+        return (r["phase"], r["devices"], r["rate_hz"], r["method"])
+
+    counted = ["calls"] + [f"{c}_total" for c in COUNTED]
+    base = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in current["results"]:
+        old = base.get(key(r))
+        if not old:
+            continue
+        where = {"phase": r["phase"], "devices": r["devices"],
+                 "rate_hz": r["rate_hz"], "method": r["method"]}
+        for field in counted:
+            if field in old and r[field] != old[field]:
+                regressions.append(dict(
+                    where, field=field, baseline=old[field],
+                    current=r[field]))
+        if (min(r["calls"], old["calls"]) >= min_samples
+                and r["p99_us"] > old["p99_us"] * tolerance
+                and r["p99_us"] - old["p99_us"] > noise_floor_us):
+            regressions.append(dict(
+                where, field="p99_us", baseline=old["p99_us"],
+                current=r["p99_us"]))
+    return regressions
+
+
+def _int_list(text):
+    return [int(x) for x in text.split(",") if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark del percorso evento potenza -> shed")
+    parser.add_argument("--devices", type=_int_list, default=[5, 50, 500])
+    parser.add_argument("--rates", type=_int_list, default=[1, 10, 50])
+    parser.add_argument("--duration", type=float, default=60,
+                        help="secondi simulati per frequenza")
+    parser.add_argument("--iterations", type=int, default=50,
+                        help="cicli di shed per configurazione")
+    parser.add_argument("--output", help="file JSON (default: stdout)")
+    parser.add_argument("--compare", help="JSON baseline da confrontare")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="p99 ammesso rispetto alla baseline")
+    parser.add_argument("--min-samples", type=int, default=200,
+                        help="campioni minimi per confrontare i tempi")
+    parser.add_argument("--noise-floor", type=float, default=100.0,
+                        help="differenza p99 (us) sotto cui e rumore")
+    opts = parser.parse_args(argv)
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        meta = baseline.get("meta", {})
+        if (meta.get("duration_s") != opts.duration
+                or meta.get("iterations") != opts.iterations):
+            parser.error(
+                f"baseline con duration {meta.get('duration_s')} e "
+                f"iterations {meta.get('iterations')}: le chiamate si "
+                f"confrontano solo a parita di carico")
+
+    report = run(opts.devices, opts.rates, opts.duration, opts.iterations)
+    if baseline is not None:
+        report["regressions"] = compare(
+            report, baseline, opts.tolerance, opts.min_samples,
+            opts.noise_floor)
+
+    text = json.dumps(report, indent=2)
+    if opts.output:
+        with open(opts.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
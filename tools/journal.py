@@ -0,0 +1,131 @@
+"""
+=============================================================================
+  POWER MANAGER - Lettura del giornale decisioni
+=============================================================================
+
+  Rilegge in streaming il giornale scritto con `journal_path` (file
+  corrente e ruotati .1, .2, ...) con DecisionJournal.read() di
+  power_manager.py, quindi con lo stesso schema dell'app.
+
+  Senza opzioni stampa un riepilogo: record per tipo, shed / restore /
+  timeout e minuti spenti per device, tempo per zona, notifiche per
+  canale. Con --list stampa i record (--json come JSON lines).
+
+  Uso:
+    python tools/journal.py /config/appdaemon/power_manager_journal.jsonl
+    python tools/journal.py --kind shed --device Forno --since 24 --list j
+    python tools/journal.py --json --list journal.jsonl > decisions.jsonl
+
+=============================================================================
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import VirtualClock, load_power_manager  # noqa: E402
+
+
+def read_records(path, kinds=None, since=None, device=None):
+    module = load_power_manager(VirtualClock(datetime.now()))
+    for record in module.DecisionJournal.read(path, kinds, since):
+        if device is None or record["device"] == device:
+            yield record
+
+
+def summarize(records):
+    """Aggregati di una sequenza di record (ordinata nel tempo)."""
+    kinds = Counter()
+    devices = defaultdict(lambda: {"shed": 0, "restore": 0, "failed": 0,
+                                   "timeout": 0, "shed_minutes": 0.0})
+    shed_at = {}
+    zone_seconds = Counter()
+    zone, zone_since = None, None
+    channels = Counter()
+    first = last = None
+
+    for r in records:
+        t = r["t"]
+        first = t if first is None else first
+        last = t
+        kinds[r["kind"]] += 1
+        name = r["device"]
+        if r["kind"] == "zone":
+            if zone is not None:
+                zone_seconds[zone] += t - zone_since
+            zone, zone_since = r["zone"], t
+        elif r["kind"] == "shed":
+            devices[name]["shed"] += 1
+            shed_at[name] = t
+        elif r["kind"] == "restore":
+            if r["detail"] == "failed":
+                devices[name]["failed"] += 1
+                continue
+            devices[name]["restore"] += 1
+            if name in shed_at:
+                devices[name]["shed_minutes"] += (t - shed_at.pop(name)) / 60
+        elif r["kind"] == "timeout":
+            devices[name]["timeout"] += 1
+        elif r["kind"] == "notify":
+            channels[(r["detail"] or "").split(":", 1)[0]] += 1
+    if zone is not None:
+        zone_seconds[zone] += last - zone_since
+
+    for entry in devices.values():
+        entry["shed_minutes"] = round(entry["shed_minutes"], 1)
+    return {
+        "from": _fmt(first),
+        "to": _fmt(last),
+        "records": dict(kinds),
+        "devices": dict(sorted(devices.items())),
+        "zone_minutes": {z: round(s / 60, 1)
+                         for z, s in sorted(zone_seconds.items())},
+        "notifications": dict(channels),
+    }
+
+
+def _fmt(t):
+    return None if t is None else datetime.fromtimestamp(t).isoformat(
+        sep=" ", timespec="seconds")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Lettura del giornale decisioni di PowerManager")
+    parser.add_argument("journal", help="file indicato in journal_path")
+    parser.add_argument("--kind", action="append",
+                        help="solo questo tipo (ripetibile): zone, shed, "
+                             "restore, luna, notify, timeout")
+    parser.add_argument("--device", help="solo record di questo device")
+    parser.add_argument("--since", type=float,
+                        help="solo le ultime N ore")
+    parser.add_argument("--list", action="store_true",
+                        help="stampa i record invece del riepilogo")
+    parser.add_argument("--json", action="store_true",
+                        help="con --list: record come JSON lines")
+    opts = parser.parse_args(argv)
+
+    since = time.time() - opts.since * 3600 if opts.since else None
+    records = read_records(opts.journal, opts.kind, since, opts.device)
+    if not opts.list:
+        print(json.dumps(summarize(records), indent=2, ensure_ascii=False))
+        return
+    for r in records:
+        if opts.json:
+            print(json.dumps(r, ensure_ascii=False))
+            continue
+        detail = "  ".join(f"{k}={r[k]}" for k in
+                           ("device", "value", "detail")
+                           if r[k] is not None)
+        print(f"{_fmt(r['t'])}  {r['kind']:<8} {r['zone']:<6} "
+              f"{r['power']:>6}W  {detail}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+=============================================================================
+  POWER MANAGER - Simulatore Modbus-TCP di un meter di rete
+=============================================================================
+
+  Server Modbus-TCP minimo (funzioni 3 e 4) che espone la potenza di
+  rete in un registro, per provare `power_source: {type: modbus}` senza
+  inverter. La codifica (formato, ordine delle word, scale) e quella di
+  ModbusPowerSource in power_manager.py: con le stesse opzioni l'app
+  rilegge esattamente il valore impostato.
+
+  La potenza e costante (--power) oppure segue una traccia CSV di
+  tools/replay.py in tempo reale (--speed per accelerare). Da Python:
+  ModbusSimulator(...).start(), poi set_power(W).
+
+  Uso:
+    python tools/modbus_sim.py --port 5020 --power 3500
+    python tools/modbus_sim.py --port 5020 --address 37113 \\
+        --format int32 --scale -1 --trace trace.csv --speed 10
+
+  apps.yaml di prova:
+    power_source:
+      type: modbus
+      host: 127.0.0.1
+      port: 5020
+      address: 37113
+      format: int32
+      scale: -1
+
+=============================================================================
+"""
+
+import argparse
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from replay import read_trace  # noqa: E402
+from sim import VirtualClock, load_power_manager  # noqa: E402
+
+
+class ModbusSimulator:
+    """Registri in memoria serviti via Modbus-TCP da un thread."""
+
+    def __init__(self, host="127.0.0.1", port=5020, unit=1, address=0,
+                 format="int16", word_order="big", scale=1.0):
+        module = load_power_manager(VirtualClock(datetime.now()))
+        self.count, self.code = module.ModbusPowerSource.FORMATS[format]
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.address = address
+        self.word_order = word_order
+        self.scale = scale
+        self.registers = {}
+        self.requests = 0
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self.set_power(0)
+
+    def set_power(self, watts):
+        """Scrive `watts` nel registro, come lo rilegge l'app."""
+        raw = watts / self.scale
+        if self.code != "f":
+            raw = int(round(raw))
+        words = list(struct.unpack(f">{self.count}H",
+                                   struct.pack(">" + self.code, raw)))
+        if self.word_order == "little":
+            words.reverse()
+        with self._lock:
+            for i, word in enumerate(words):
+                self.registers[self.address + i] = word
+
+    def start(self):
+        simulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def setup(self):
+                with simulator._lock:
+                    simulator._clients.add(self.request)
+
+            def finish(self):
+                with simulator._lock:
+                    simulator._clients.discard(self.request)
+
+            def handle(self):
+                while True:
+                    header = self._recv(7)
+                    if header is None:
+                        return
+                    tid, _, length, unit = struct.unpack(">HHHB", header)
+                    body = self._recv(length - 1)
+                    if body is None:
+                        return
+                    reply = simulator._reply(unit, body)
+                    self.request.sendall(struct.pack(
+                        ">HHHB", tid, 0, len(reply) + 1, unit) + reply)
+
+            def _recv(self, size):
+                data = b""
+                while len(data) < size:
+                    try:
+                        chunk = self.request.recv(size - len(data))
+                    except OSError:
+                        return None
+                    if not chunk:
+                        return None
+                    data += chunk
+                return data
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer(
+            (self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]  # con port=0
+        threading.Thread(target=self._server.serve_forever,
+                         name="modbus-sim", daemon=True).start()
+
+    def stop(self):
+        """Ferma il server e chiude le connessioni (meter irraggiungibile)."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _reply(self, unit, body):
+        function = body[0]
+        if function not in (3, 4) or len(body) != 5:
+            return bytes((function | 0x80, 1))  # funzione non supportata
+        address, count = struct.unpack(">HH", body[1:5])
+        with self._lock:
+            self.requests += 1
+            words = [self.registers.get(address + i, 0)
+                     for i in range(count)]
+        return bytes((function, 2 * count)) + struct.pack(
+            f">{count}H", *words)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulatore Modbus-TCP della potenza di rete")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--unit", type=int, default=1)
+    parser.add_argument("--address", type=int, default=0)
+    parser.add_argument("--format", default="int16",
+                        help="int16, uint16, int32, uint32, float32")
+    parser.add_argument("--word-order", default="big",
+                        help="big o little (registri a 32 bit)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="come `scale` di power_source")
+    parser.add_argument("--power", type=float, default=0.0,
+                        help="potenza costante in W")
+    parser.add_argument("--trace",
+                        help="CSV di potenza (formato di tools/replay.py)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="con --trace: fattore di accelerazione")
+    parser.add_argument("--entity", default="sensor.power_meter",
+                        help="con --trace: colonna della rete (o grid)")
+    opts = parser.parse_args(argv)
+
+    simulator = ModbusSimulator(
+        opts.host, opts.port, opts.unit, opts.address, opts.format,
+        opts.word_order, opts.scale)
+    simulator.set_power(opts.power)
+    simulator.start()
+    print(f"Modbus-TCP su {opts.host}:{simulator.port} unit {opts.unit}, "
+          f"registro {opts.address} ({opts.format})", file=sys.stderr)
+    try:
+        if not opts.trace:
+            while True:
+                time.sleep(3600)
+        first = started = None
+        for ts, values in read_trace(opts.trace, opts.entity):
+            power = dict(values).get(opts.entity)
+            if power is None:
+                continue
+            if first is None:
+                first, started = ts, time.monotonic()
+            wait = ((ts - first).total_seconds() / opts.speed
+                    - (time.monotonic() - started))
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                simulator.set_power(float(power))
+            except ValueError:
+                continue
+            print(f"{ts.isoformat(sep=' ')}  {float(power):.0f} W",
+                  file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
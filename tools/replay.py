@@ -0,0 +1,389 @@
+"""
+=============================================================================
+  POWER MANAGER - Replay offline di tracce di potenza
+=============================================================================
+
+  Fa girare la logica reale di PowerManager (zone, shed, restore,
+  Luna2000, notifiche) su una traccia registrata, senza AppDaemon:
+  backend FakeHass e orologio virtuale (tools/sim.py), quindi run_in,
+  check gialli e restore scattano in tempo simulato.
+
+  Formati traccia (CSV):
+    - "largo":  timestamp,<entity>,<entity>,...
+                la colonna "grid" e un alias del power_sensor.
+    - export storico HA:  entity_id,state,last_changed
+  Timestamp ISO 8601 oppure epoch in secondi.
+
+  Lo spegnimento di un device viene applicato alla traccia: finche e
+  SHED la sua potenza registrata (o last_known_power se manca la
+  colonna) viene tolta dalla potenza di rete.
+
+  Uso:
+    python tools/replay.py --config apps.yaml trace.csv
+    python tools/replay.py --config apps.yaml --json trace.csv > out.jsonl
+
+=============================================================================
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import VirtualClock, load_power_manager  # noqa: E402
+
+TIME_COLUMNS = ("timestamp", "time", "last_changed", "last_updated")
+
+
+def parse_time(value):
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        pass
+    ts = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).astimezone().replace(tzinfo=None)
+    return ts
+
+
+def read_trace(path, grid_entity):
+    """
+    Legge una traccia CSV e genera le righe (datetime, [(entity,
+    valore), ...]) in ordine di tempo. Il formato e riconosciuto
+    dall'intestazione; il CSV largo (gia ordinato) e letto in
+    streaming, quindi anche un mese a 1 s non sta tutto in memoria.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader)]
+        if "entity_id" in header and "state" in header:
+            yield from _read_long(reader, header, grid_entity)
+        else:
+            yield from _read_wide(reader, header, grid_entity)
+
+
+def _read_wide(reader, header, grid_entity):
+    time_col = next((i for i, h in enumerate(header)
+                     if h.lower() in TIME_COLUMNS), 0)
+    columns = [(i, grid_entity if h == "grid" else h)
+               for i, h in enumerate(header) if i != time_col]
+    width = len(header)
+    for row in reader:
+        if not row:
+            continue
+        if len(row) == width:
+            yield parse_time(row[time_col]), [
+                (entity_id, row[i]) for i, entity_id in columns if row[i]]
+        else:
+            yield parse_time(row[time_col]), [
+                (entity_id, row[i]) for i, entity_id in columns
+                if i < len(row) and row[i]]
+
+
+def _read_long(reader, header, grid_entity):
+    entity_col = header.index("entity_id")
+    state_col = header.index("state")
+    time_col = next(i for i, h in enumerate(header) if h in TIME_COLUMNS)
+    events = []
+    for row in reader:
+        if not row:
+            continue
+        entity_id = row[entity_col].strip()
+        if entity_id == "grid":
+            entity_id = grid_entity
+        events.append((parse_time(row[time_col]), entity_id,
+                       row[state_col].strip()))
+    events.sort(key=lambda e: e[0])
+    for ts, group in itertools.groupby(events, key=lambda e: e[0]):
+        yield ts, [(entity_id, value) for _, entity_id, value in group]
+
+
+def load_app_config(path, app_name=None):
+    """Blocco app da apps.yaml (PyYAML) o da un file JSON."""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".json"):
+            data = json.load(f)
+        else:
+            import yaml  # dipendenza opzionale, solo per apps.yaml
+            data = yaml.safe_load(f)
+    if "module" in data:
+        return data
+    if app_name:
+        return data[app_name]
+    for block in data.values():
+        if isinstance(block, dict) and block.get("class") == "PowerManager":
+            return block
+    raise ValueError(f"Nessuna app PowerManager in {path}")
+
+
+class ReplayEngine:
+    """
+    Guida un PowerManager reale con una traccia registrata e produce
+    la timeline delle decisioni (zone, shed, restore, Luna2000,
+    notifiche).
+    """
+
+    def __init__(self, args, initial_states=None, start=None,
+                 keep_log=False, exact=False):
+        self.args = dict(args)
+        self.exact = exact
+        self.args.pop("telegram_bot_token", None)  # niente rete
+        self.timeline = []
+        self.log_lines = [] if keep_log else None
+        self.clock = VirtualClock(start or datetime(2026, 1, 1))
+        self.module = load_power_manager(self.clock)
+        self._recorded = {}
+        self._zone = None
+        self._shed = set()
+        self.samples = 0
+        self.dispatched = 0
+        self.silent = 0
+        self._last_dispatched = None
+        self._sent = {}
+
+        engine = self
+
+        class ReplayPowerManager(self.module.PowerManager):
+            # Niente bot: passa comunque da dedup, limiti e digest
+            def _notify_telegram(self, message, category="info",
+                                 critical=False):
+                self._route_notification(
+                    "telegram", category, message, critical)
+
+            def _send_telegram(self, message):
+                self._record_notify("telegram", message)
+                engine._record("notify", channel="telegram", message=message)
+
+        states = self._default_states()
+        states.update(initial_states or {})
+        self.app = ReplayPowerManager(
+            self.args, states, clock=self.clock, log_sink=self._on_log)
+        self.app.sim_service_hook = self._on_service
+        self._red = self.module.PowerZone.RED
+        self._shed_state = self.module.DeviceState.SHED
+        self._device_by_sensor = {
+            d["power_sensor"]: d["name"]
+            for d in self.args.get("devices", []) if d.get("power_sensor")}
+
+    def _default_states(self):
+        states = {self.args.get("power_sensor", "sensor.power_meter"): "0"}
+        for d in self.args.get("devices", []):
+            # Device acceso all'avvio (per gli invertiti: switch OFF)
+            states[d["entity_id"]] = "off" if d.get("inverted") else "on"
+            if d.get("power_sensor"):
+                states[d["power_sensor"]] = "0"
+        for d in self.args.get("non_controllable", []):
+            if d.get("power_sensor"):
+                states[d["power_sensor"]] = "0"
+        return states
+
+    # --- esecuzione ---
+
+    def run(self, rows):
+        """Esegue le righe (datetime, [(entity, valore), ...]) in ordine."""
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return self.timeline
+        self.clock.now = first[0]
+        self.app.initialize()
+        self._observe()
+        numeric_entities = set(self._device_by_sensor)
+        numeric_entities.add(self.app.power_sensor)
+        recorded = self._recorded
+        for ts, updates in itertools.chain([first], rows):
+            self.clock.advance_to(ts, on_fire=self._observe)
+            self.samples += len(updates)
+            numeric = False
+            changed = False
+            for entity_id, value in updates:
+                if entity_id in numeric_entities:
+                    try:
+                        recorded[entity_id] = float(value)
+                        numeric = True
+                        continue
+                    except ValueError:
+                        pass
+                self.app.sim_set(entity_id, value.strip())
+                changed = True
+            if numeric:
+                changed = self._apply_trace() or changed
+            if changed:
+                self._observe()
+        return self.timeline
+
+    def finish(self, until):
+        """Lascia scorrere il tempo (restore, timeout) fino a `until`."""
+        self.clock.advance_to(until, on_fire=self._observe)
+        return self.timeline
+
+    def _apply_trace(self):
+        """
+        Pubblica rete e sensori device tenendo conto dei device SHED.
+        Ritorna True se e stato inviato almeno un evento all'app.
+        """
+        removed = 0.0
+        shed = self._shed_state
+        dry_run = self.app.dry_run
+        for d in self.app.devices:
+            recorded = self._recorded.get(d.power_sensor)
+            if d.state is shed and not dry_run:
+                removed += (recorded if recorded is not None
+                            else d.last_known_power)
+                recorded = 0.0
+            if (recorded is not None
+                    and self._sent.get(d.power_sensor) != recorded):
+                self._sent[d.power_sensor] = recorded
+                self._set_number(d.power_sensor, recorded)
+        grid = self._recorded.get(self.app.power_sensor)
+        if grid is None:
+            return True
+        power = max(grid - removed, 0.0)
+        if not self.exact and self._equivalent(power):
+            self._set_silent(self.app.power_sensor, power)
+            return False
+        self._set_number(self.app.power_sensor, power)
+        self._last_dispatched = power
+        return True
+
+    def _equivalent(self, power):
+        """
+        True se il campione non puo cambiare alcuna decisione rispetto
+        all'ultimo inviato: stessa zona, stesso lato delle soglie verde
+        e 110% (fascia del contatore) e zona diversa da ROSSA. Basta
+        aggiornare lo stato senza evento (la cache dell'app resta
+        allineata per i timer).
+        """
+        app = self.app
+        last = self._last_dispatched
+        if last is None or app.current_zone is self._red:
+            return False
+        if (app.overload_predictor is not None
+                or app.luna_controller is not None):
+            return False  # previsione e regolatore usano ogni campione
+        return (app._classify_zone(power) is app.current_zone
+                and (power <= app.green_threshold)
+                == (last <= app.green_threshold)
+                and (power >= app.available_power)
+                == (last >= app.available_power))
+
+    def _set_silent(self, entity_id, value):
+        text = f"{value:.1f}"
+        self.silent += 1
+        self.app._sim_states[entity_id] = text
+        self.app.state_cache.update(entity_id, text)
+
+    def _set_number(self, entity_id, value):
+        text = f"{value:.1f}"
+        if self.app._sim_states.get(entity_id) != text:
+            self.dispatched += 1
+            self.app.sim_set(entity_id, text)
+
+    # --- timeline ---
+
+    def _record(self, event, **data):
+        entry = {"time": self.clock.now.isoformat(), "event": event}
+        entry.update(data)
+        self.timeline.append(entry)
+
+    def _observe(self):
+        zone = self.app.current_zone.value
+        if zone != self._zone:
+            if self._zone is not None:
+                self._record("zone", old=self._zone, new=zone,
+                             grid_power=self._grid_value())
+            self._zone = zone
+        shed = {d.name for d in self.app.devices
+                if d.state is self.module.DeviceState.SHED}
+        if shed != self._shed:
+            for name in sorted(shed - self._shed):
+                self._record("shed", device=name,
+                             grid_power=self._grid_value())
+            for name in sorted(self._shed - shed):
+                self._record("restore", device=name,
+                             grid_power=self._grid_value())
+            self._shed = shed
+
+    def _grid_value(self):
+        try:
+            return float(self.app._sim_states.get(self.app.power_sensor))
+        except (TypeError, ValueError):
+            return None
+
+    def _on_service(self, service, data):
+        if service.startswith("notify/"):
+            self._record("notify", channel=service,
+                         message=data.get("message"))
+            return
+        entity_id = data.get("entity_id")
+        if entity_id and entity_id in (self.app.luna_switch,
+                                       self.app.luna_power_slider):
+            self._record("luna", service=service, entity_id=entity_id,
+                         value=data.get("value"))
+
+    def _on_log(self, ts, level, message):
+        if self.log_lines is not None:
+            self.log_lines.append(f"{ts.isoformat()} {level} {message}")
+
+    def summary(self):
+        counts = {}
+        for entry in self.timeline:
+            counts[entry["event"]] = counts.get(entry["event"], 0) + 1
+        return {"samples": self.samples, "dispatched": self.dispatched,
+                "silent": self.silent,
+                "events": counts,
+                "service_calls": self.app.sim_counters["call_service"],
+                "state_writes": self.app.sim_counters["set_state"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay di tracce di potenza su PowerManager")
+    parser.add_argument("trace", help="CSV (largo o export storico HA)")
+    parser.add_argument("--config", required=True,
+                        help="apps.yaml o JSON con il blocco dell'app")
+    parser.add_argument("--app", help="nome del blocco in apps.yaml")
+    parser.add_argument("--tail", type=float, default=0,
+                        help="secondi simulati dopo l'ultimo campione")
+    parser.add_argument("--json", action="store_true",
+                        help="timeline come JSON lines")
+    parser.add_argument("--log", action="store_true",
+                        help="stampa anche il log dell'app")
+    parser.add_argument("--exact", action="store_true",
+                        help="invia ogni campione (niente salto dei "
+                             "campioni equivalenti)")
+    opts = parser.parse_args(argv)
+
+    args = load_app_config(opts.config, opts.app)
+    engine = ReplayEngine(args, keep_log=opts.log, exact=opts.exact)
+    events = read_trace(
+        opts.trace, args.get("power_sensor", "sensor.power_meter"))
+    started = datetime.now()
+    engine.run(events)
+    if opts.tail and engine.samples:
+        engine.finish(engine.clock.now + timedelta(seconds=opts.tail))
+    elapsed = (datetime.now() - started).total_seconds()
+
+    if opts.log:
+        for line in engine.log_lines:
+            print(line, file=sys.stderr)
+    for entry in engine.timeline:
+        if opts.json:
+            print(json.dumps(entry, ensure_ascii=False))
+        else:
+            detail = ", ".join(f"{k}={v}" for k, v in entry.items()
+                               if k not in ("time", "event"))
+            detail = detail.replace("\n", " | ")
+            print(f"{entry['time']}  {entry['event']:<8} {detail}")
+    summary = engine.summary()
+    summary["wall_seconds"] = round(elapsed, 3)
+    print(json.dumps(summary), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
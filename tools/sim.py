@@ -0,0 +1,211 @@
+"""
+=============================================================================
+  POWER MANAGER - Backend simulato (senza AppDaemon / Home Assistant)
+=============================================================================
+
+  FakeHass sostituisce hass.Hass: stati in memoria, listen_state,
+  call_service con effetti sulle entity, run_in/run_every su un
+  orologio virtuale. load_power_manager() carica power_manager.py
+  sopra questo backend, con datetime.now() agganciato all'orologio
+  virtuale, cosi timer e verifiche scattano in tempo simulato.
+
+  Usato da tools/replay.py e tools/bench.py.
+
+=============================================================================
+"""
+
+import heapq
+import importlib.util
+import itertools
+import os
+import sys
+import types
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class VirtualClock:
+    """Orologio simulato con coda di timer (heap)."""
+
+    def __init__(self, start):
+        self.now = start
+        self._heap = []
+        self._seq = itertools.count()
+        self._cancelled = set()
+
+    def schedule(self, when, callback, kwargs, interval=None):
+        handle = next(self._seq)
+        heapq.heappush(self._heap, (when, handle, callback, kwargs, interval))
+        return handle
+
+    def cancel(self, handle):
+        self._cancelled.add(handle)
+
+    def pending(self):
+        return len(self._heap) - len(self._cancelled)
+
+    def next_due(self):
+        while self._heap and self._heap[0][1] in self._cancelled:
+            self._cancelled.discard(heapq.heappop(self._heap)[1])
+        return self._heap[0][0] if self._heap else None
+
+    def advance_to(self, when, on_fire=None):
+        """Porta l'orologio a `when` eseguendo i timer scaduti in ordine."""
+        while True:
+            due = self.next_due()
+            if due is None or due > when:
+                break
+            _, handle, callback, kwargs, interval = heapq.heappop(self._heap)
+            self.now = max(self.now, due)
+            if interval:
+                heapq.heappush(self._heap, (
+                    due + timedelta(seconds=interval), handle,
+                    callback, kwargs, interval))
+            callback(kwargs)
+            if on_fire is not None:
+                on_fire()
+        self.now = max(self.now, when)
+
+
+class FakeHass:
+    """
+    Sostituto minimale di appdaemon.plugins.hass.hassapi.Hass.
+    Conta le chiamate get_state/call_service/set_state per i benchmark.
+    """
+
+    def __init__(self, args, states=None, clock=None, log_sink=None):
+        self.args = args
+        self.name = args.get("name", "power_manager")
+        self._sim_clock = clock or VirtualClock(datetime(2026, 1, 1))
+        self._sim_states = dict(states or {})
+        self._sim_listeners = {}
+        self._sim_listen_seq = itertools.count()
+        self._sim_log_sink = log_sink
+        self.sim_service_log = []
+        self.sim_published = {}
+        self.sim_counters = {"get_state": 0, "call_service": 0,
+                             "set_state": 0, "entity_exists": 0}
+        self.sim_service_hook = None
+
+    # --- stato ---
+
+    def get_state(self, entity_id, attribute=None, **kwargs):
+        self.sim_counters["get_state"] += 1
+        return self._sim_states.get(entity_id)
+
+    def entity_exists(self, entity_id, **kwargs):
+        self.sim_counters["entity_exists"] += 1
+        return entity_id in self._sim_states
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        self.sim_counters["set_state"] += 1
+        self.sim_published[entity_id] = (state, attributes)
+
+    def sim_set(self, entity_id, value):
+        """Cambia uno stato e notifica i listener (come un evento HA)."""
+        old = self._sim_states.get(entity_id)
+        if old == value:
+            return
+        self._sim_states[entity_id] = value
+        for handle, callback, kwargs in list(
+                self._sim_listeners.get(entity_id, ())):
+            callback(entity_id, "state", old, value, kwargs)
+
+    def listen_state(self, callback, entity_id, **kwargs):
+        handle = (entity_id, next(self._sim_listen_seq))
+        self._sim_listeners.setdefault(entity_id, []).append(
+            (handle, callback, kwargs))
+        return handle
+
+    def cancel_listen_state(self, handle):
+        entity_id = handle[0]
+        self._sim_listeners[entity_id] = [
+            entry for entry in self._sim_listeners.get(entity_id, ())
+            if entry[0] != handle]
+
+    # --- servizi ---
+
+    def call_service(self, service, **data):
+        self.sim_counters["call_service"] += 1
+        self.sim_service_log.append((self._sim_clock.now, service, data))
+        if self.sim_service_hook is not None:
+            self.sim_service_hook(service, data)
+        domain, _, action = service.partition("/")
+        entities = data.get("entity_id")
+        if isinstance(entities, str):
+            entities = [entities]
+        for entity_id in entities or ():
+            if action == "turn_on":
+                self.sim_set(entity_id, "on")
+            elif action == "turn_off":
+                self.sim_set(entity_id, "off")
+            elif action == "set_value":
+                self.sim_set(entity_id, str(data.get("value")))
+            elif action == "set_hvac_mode":
+                self.sim_set(entity_id, data.get("hvac_mode"))
+            elif action == "set_datetime" and "time" in data:
+                self.sim_set(entity_id, data["time"])
+
+    # --- scheduler ---
+
+    def run_in(self, callback, delay, **kwargs):
+        when = self._sim_clock.now + timedelta(seconds=float(delay))
+        return self._sim_clock.schedule(when, callback, kwargs)
+
+    def run_every(self, callback, start, interval, **kwargs):
+        when = self._sim_clock.now
+        if start != "now":
+            when = start
+        return self._sim_clock.schedule(
+            when, callback, kwargs, interval=interval)
+
+    def cancel_timer(self, handle):
+        self._sim_clock.cancel(handle)
+
+    # --- log ---
+
+    def log(self, message, level="INFO", **kwargs):
+        if self._sim_log_sink is not None:
+            self._sim_log_sink(self._sim_clock.now, level, message)
+
+
+def load_power_manager(clock, path=None):
+    """
+    Carica power_manager.py come modulo privato sopra FakeHass.
+    datetime.now() del modulo restituisce l'ora dell'orologio virtuale.
+    """
+    path = path or os.path.join(REPO_DIR, "power_manager.py")
+    fake_api = types.ModuleType("appdaemon.plugins.hass.hassapi")
+    fake_api.Hass = FakeHass
+    fakes = {
+        "appdaemon": types.ModuleType("appdaemon"),
+        "appdaemon.plugins": types.ModuleType("appdaemon.plugins"),
+        "appdaemon.plugins.hass": types.ModuleType("appdaemon.plugins.hass"),
+        "appdaemon.plugins.hass.hassapi": fake_api,
+    }
+    fakes["appdaemon"].plugins = fakes["appdaemon.plugins"]
+    fakes["appdaemon.plugins"].hass = fakes["appdaemon.plugins.hass"]
+    fakes["appdaemon.plugins.hass"].hassapi = fake_api
+
+    saved = {name: sys.modules.get(name) for name in fakes}
+    sys.modules.update(fakes)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            f"_pm_sim_{id(clock)}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for name, previous in saved.items():
+            if previous is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = previous
+
+    class VirtualDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock.now
+
+    module.datetime = VirtualDatetime
+    return module
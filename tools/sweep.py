@@ -0,0 +1,392 @@
+"""
+=============================================================================
+  POWER MANAGER - Backtest di parametri su tracce registrate
+=============================================================================
+
+  Prova una griglia di parametri di apps.yaml (prodotto cartesiano) su
+  una traccia di potenza e ordina le combinazioni per esito:
+    - trips:     distacchi previsti dalla tolleranza del contatore
+                 (MeterBudget dell'app) con il Power Manager attivo
+    - shed_min:  minuti-device di carichi spenti
+    - sheds / restores: cicli di spegnimento e riaccensione
+    - notify:    notifiche inviate (Telegram e Alexa, dopo i limiti)
+    - yellow_min / red_min: minuti in zona gialla / rossa
+  e, senza controllo, sulla traccia grezza:
+    - raw_trips, raw_yellow_min, raw_red_min
+
+  Due passi:
+    1. esposizione: zone (_classify_zone con isteresi) e fasce del
+       contatore su tutta la traccia, vettoriali con NumPy (senza
+       NumPy, stesso risultato con un ciclo Python). Le combinazioni
+       che non escono mai dal verde non hanno nulla da simulare.
+    2. replay completo (tools/replay.py) delle altre combinazioni, in
+       parallelo su un pool di processi.
+
+  Nomi accettati anche con il prefisso degli helper (pm_restore_interval
+  = restore_interval, pm_min_active_power = min_active_power, ...).
+  La griglia viene da --param (ripetibile) e/o da un file JSON/YAML
+  {parametro: [valori]}.
+
+  Uso:
+    python tools/sweep.py --config apps.yaml trace.csv \\
+        --param hysteresis=100,200,300 \\
+        --param stable_minutes_before_restore=2,5,10 \\
+        --param pm_restore_interval=60,180
+    python tools/sweep.py --config apps.yaml --grid grid.yaml --top 10 \\
+        --sort trips,notify,shed_min --json trace.csv > ranking.jsonl
+
+=============================================================================
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from replay import ReplayEngine, load_app_config, read_trace  # noqa: E402
+from sim import VirtualClock, load_power_manager  # noqa: E402
+
+try:
+    import numpy as np  # opzionale: esposizione vettoriale
+except ImportError:
+    np = None
+
+OUTCOME = ("trips", "shed_min", "sheds", "restores", "notify",
+           "yellow_min", "red_min")
+EXPOSURE = ("raw_trips", "raw_yellow_min", "raw_red_min")
+DEFAULT_SORT = "trips,shed_min,sheds,notify"
+GREEN, YELLOW, RED = 0, 1, 2
+
+
+# --- griglia ---
+
+def parse_values(text):
+    """"100,200,300" -> [100, 200, 300] (numeri o stringhe)."""
+    values = []
+    for item in text.split(","):
+        item = item.strip()
+        try:
+            values.append(json.loads(item))
+        except ValueError:
+            values.append(item)
+    return values
+
+
+def expand_grid(spec):
+    """{parametro: [valori]} -> lista di dict, prodotto cartesiano."""
+    names = [_key(name) for name in spec]
+    return [dict(zip(names, combo))
+            for combo in itertools.product(*spec.values())]
+
+
+def _key(name):
+    """Nome helper (pm_restore_interval) -> chiave apps.yaml."""
+    return name[3:] if name.startswith("pm_") else name
+
+
+def load_grid(path):
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".json"):
+            return json.load(f)
+        import yaml  # dipendenza opzionale, solo per la griglia YAML
+        return yaml.safe_load(f)
+
+
+# --- passo 1: esposizione sulla traccia grezza ---
+
+def read_grid_power(path, grid_entity):
+    """Istanti (epoch) e potenza di rete della traccia."""
+    times, powers = [], []
+    for ts, updates in read_trace(path, grid_entity):
+        for entity_id, value in updates:
+            if entity_id != grid_entity:
+                continue
+            try:
+                power = max(float(value), 0.0)
+            except ValueError:
+                continue
+            times.append(ts.timestamp())
+            powers.append(power)
+    return times, powers
+
+
+def classify_zones(power, settings):
+    """
+    Zona per campione (0 verde, 1 gialla, 2 rossa) con la stessa
+    isteresi di PowerManager._classify_zone, partendo dal verde.
+
+    Sopra la rossa, sotto il rientro verde e nella fascia 110-133% la
+    zona non dipende dalla precedente; nella fascia tra rientro verde
+    e 110% resta quella precedente, ma dalla rossa si scende in gialla.
+    Quindi: zone "forzate", riportate in avanti sui campioni di fascia.
+    """
+    forced = np.full(len(power), -1, dtype=np.int8)
+    forced[power <= settings.green_threshold] = GREEN
+    forced[power >= settings.available_power] = YELLOW
+    forced[power >= settings.red_threshold] = RED
+    index = np.where(forced >= 0, np.arange(len(power)), -1)
+    np.maximum.accumulate(index, out=index)
+    zones = np.where(index >= 0, forced[index], GREEN).astype(np.int8)
+    zones[(forced < 0) & (zones == RED)] = YELLOW
+    return zones
+
+
+def _classify_zones_python(power, settings):
+    zones, zone = [], GREEN
+    for p in power:
+        if p >= settings.red_threshold:
+            zone = RED
+        elif p <= settings.green_threshold:
+            zone = GREEN
+        elif p >= settings.available_power or zone == RED:
+            zone = YELLOW
+        zones.append(zone)
+    return zones
+
+
+def exposure(times, powers, settings, meter):
+    """
+    Esposizione senza Power Manager: minuti in gialla / rossa e
+    distacchi previsti dalla tolleranza del contatore. `meter` e un
+    MeterBudget nuovo; viene avanzato solo ai cambi di fascia.
+    """
+    if not powers:
+        return dict(dict.fromkeys(EXPOSURE, 0), left_green=False)
+    if np is not None:
+        t = np.asarray(times, dtype=float)
+        p = np.asarray(powers, dtype=float)
+        zones = classify_zones(p, settings)
+        dt = np.diff(t, append=t[-1])
+        seconds = np.bincount(zones, weights=dt, minlength=3)
+        bands = ((p >= settings.available_power).astype(np.int8)
+                 + (p >= settings.red_threshold))
+        starts = np.flatnonzero(np.diff(bands, prepend=-1))
+        segments = zip(t[starts].tolist(), p[starts].tolist())
+        left_green = bool(zones.any())
+    else:
+        zones = _classify_zones_python(powers, settings)
+        seconds = [0.0, 0.0, 0.0]
+        for i in range(len(times) - 1):
+            seconds[zones[i]] += times[i + 1] - times[i]
+        segments = zip(times, powers)
+        left_green = any(zones)
+
+    for t_start, power in segments:
+        meter.update(t_start, power, settings.available_power,
+                     settings.red_threshold)
+    meter.advance(times[-1])
+    return {"raw_trips": meter.trips,
+            "raw_yellow_min": round(float(seconds[YELLOW]) / 60, 1),
+            "raw_red_min": round(float(seconds[RED]) / 60, 1),
+            "left_green": left_green}
+
+
+# --- passo 2: replay completo (nel pool) ---
+
+def evaluate(task):
+    """Replay di una combinazione; eseguito nei processi del pool."""
+    args, trace, tail = task
+    rows = read_trace(trace, args.get("power_sensor", "sensor.power_meter"))
+    first = next(rows, None)
+    if first is None:
+        return dict.fromkeys(OUTCOME, 0)
+    engine = ReplayEngine(args)
+    engine.run(itertools.chain([first], rows))
+    last = engine.clock.now
+    end = last + timedelta(seconds=tail)
+    engine.finish(end)
+    app = engine.app
+    app.meter.advance(app._clock())
+    result = outcome(engine.timeline, first[0], last, end)
+    result["trips"] = app.meter.trips
+    return result
+
+
+def outcome(timeline, start, last, end):
+    """
+    Esito dalla timeline del replay. Le zone contano fino all'ultimo
+    campione (`last`, come l'esposizione grezza), i device ancora
+    spenti fino a `end`.
+    """
+    counts = Counter()
+    shed_at = {}
+    shed_seconds = 0.0
+    zone_seconds = Counter()
+    zone, since = "green", start
+    for entry in timeline:
+        t = datetime.fromisoformat(entry["time"])
+        event = entry["event"]
+        counts[event] += 1
+        if event == "shed":
+            shed_at[entry["device"]] = t
+        elif event == "restore" and entry["device"] in shed_at:
+            shed_seconds += (t - shed_at.pop(entry["device"])
+                             ).total_seconds()
+        elif event == "zone" and t <= last:
+            zone_seconds[zone] += (t - since).total_seconds()
+            zone, since = entry["new"], t
+    shed_seconds += sum((end - t).total_seconds()
+                        for t in shed_at.values())
+    zone_seconds[zone] += (last - since).total_seconds()
+    return {
+        "trips": 0,
+        "shed_min": round(shed_seconds / 60, 1),
+        "sheds": counts["shed"],
+        "restores": counts["restore"],
+        "notify": counts["notify"],
+        "yellow_min": round(zone_seconds["yellow"] / 60, 1),
+        "red_min": round(zone_seconds["red"] / 60, 1),
+    }
+
+
+# --- sweep ---
+
+def sweep(args, trace, combos, tail=3600, workers=None, progress=None):
+    """
+    Esito di ogni combinazione: lista di dict con "params", le colonne
+    di EXPOSURE e di OUTCOME e "replayed" (False se saltata).
+    """
+    if args.get("sites"):
+        raise ValueError("sweep su un solo contatore: niente `sites`")
+    module = load_power_manager(VirtualClock(datetime.now()))
+    grid_entity = args.get("power_sensor", "sensor.power_meter")
+    times, powers = read_grid_power(trace, grid_entity)
+    # Previsione e regolatore Luna2000 agiscono anche in verde
+    always_replay = bool(args.get("predict_horizon")
+                         or args.get("luna_controller"))
+
+    results, tasks = [], []
+    for params in combos:
+        combo_args = dict(args)
+        combo_args.update(params)
+        settings = module.RuntimeSettings.compile(
+            lambda helper: None, combo_args)
+        meter = module.MeterBudget(
+            yellow_budget=combo_args.get("meter_yellow_budget", 10800),
+            red_budget=combo_args.get("meter_red_budget", 120),
+            recovery_rate=combo_args.get("meter_recovery_rate", 1.0),
+        )
+        result = {"params": params}
+        result.update(exposure(times, powers, settings, meter))
+        result["replayed"] = always_replay or result.pop("left_green")
+        if result["replayed"]:
+            tasks.append((len(results), (combo_args, trace, tail)))
+        else:
+            result.update(dict.fromkeys(OUTCOME, 0))
+        results.append(result)
+
+    finished = 0
+
+    def done(index, outcome_):
+        nonlocal finished
+        results[index].update(outcome_)
+        finished += 1
+        if progress is not None:
+            progress(finished, len(tasks))
+
+    if workers == 1 or len(tasks) <= 1:
+        for index, task in tasks:
+            done(index, evaluate(task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            outcomes = pool.map(evaluate, [task for _, task in tasks])
+            for (index, _), outcome_ in zip(tasks, outcomes):
+                done(index, outcome_)
+    return results
+
+
+def rank(results, sort=DEFAULT_SORT):
+    """Ordina per le colonne di `sort` (crescenti) e numera."""
+    columns = [c.strip() for c in sort.split(",") if c.strip()]
+    for column in columns:
+        if column not in OUTCOME + EXPOSURE:
+            raise ValueError(f"colonna sconosciuta: {column}")
+    ranked = sorted(results, key=lambda r: [r[c] for c in columns])
+    for position, result in enumerate(ranked, 1):
+        result["rank"] = position
+    return ranked
+
+
+def format_table(ranked, names):
+    columns = ["rank"] + names + list(OUTCOME) + list(EXPOSURE)
+    rows = [[str(r["rank"])] + [str(r["params"][n]) for n in names]
+            + [str(r[c]) for c in OUTCOME + EXPOSURE] for r in ranked]
+    widths = [max([len(c)] + [len(row[i]) for row in rows])
+              for i, c in enumerate(columns)]
+    lines = ["  ".join(c.rjust(w) for c, w in zip(columns, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    lines += ["  ".join(v.rjust(w) for v, w in zip(row, widths))
+              for row in rows]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Backtest di parametri di PowerManager su tracce")
+    parser.add_argument("trace", help="CSV (formato di tools/replay.py)")
+    parser.add_argument("--config", required=True,
+                        help="apps.yaml o JSON con il blocco dell'app")
+    parser.add_argument("--app", help="nome del blocco in apps.yaml")
+    parser.add_argument("--param", action="append", default=[],
+                        metavar="NOME=V1,V2",
+                        help="valori di un parametro (ripetibile)")
+    parser.add_argument("--grid", help="JSON/YAML {parametro: [valori]}")
+    parser.add_argument("--tail", type=float, default=3600,
+                        help="secondi simulati dopo l'ultimo campione "
+                             "(restore e timeout in sospeso)")
+    parser.add_argument("--workers", type=int,
+                        help="processi del pool (default: CPU)")
+    parser.add_argument("--sort", default=DEFAULT_SORT,
+                        help="colonne di ordinamento, crescenti")
+    parser.add_argument("--top", type=int, help="solo le prime N")
+    parser.add_argument("--json", action="store_true",
+                        help="classifica come JSON lines")
+    opts = parser.parse_args(argv)
+
+    spec = load_grid(opts.grid) if opts.grid else {}
+    for item in opts.param:
+        name, sep, values = item.partition("=")
+        if not sep:
+            parser.error(f"--param {item}: atteso NOME=V1,V2,...")
+        spec[name.strip()] = parse_values(values)
+    if not spec:
+        parser.error("nessun parametro: usa --param o --grid")
+    try:
+        rank([], opts.sort)
+    except ValueError as e:
+        parser.error(f"--sort: {e}")
+
+    args = load_app_config(opts.config, opts.app)
+    combos = expand_grid(spec)
+    print(f"{len(combos)} combinazioni, NumPy "
+          f"{'si' if np is not None else 'no'}", file=sys.stderr)
+
+    def progress(done, total):
+        print(f"\r  replay {done}/{total}", end="", file=sys.stderr,
+              flush=True)
+
+    started = time.monotonic()
+    results = sweep(args, opts.trace, combos, opts.tail, opts.workers,
+                    progress)
+    ranked = rank(results, opts.sort)[:opts.top]
+    elapsed = time.monotonic() - started
+    replayed = sum(r["replayed"] for r in results)
+    print(f"\n  {replayed} replay, {len(results) - replayed} senza "
+          f"uscite dal verde, {elapsed:.1f}s", file=sys.stderr)
+
+    if opts.json:
+        for result in ranked:
+            print(json.dumps(result, ensure_ascii=False))
+        return
+    print(format_table(ranked, [_key(name) for name in spec]))
+
+
+if __name__ == "__main__":
+    main()